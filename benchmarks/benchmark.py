@@ -0,0 +1,188 @@
+""" Benchmarks the overhead of pygrid for many jobs
+
+The jobs are submitted to stub ``qsub``, ``qstat`` and ``qdel`` executables
+from the ``stubs`` folder, which only record the submitted tasks and never
+run them. The benchmark times
+
+- map: writing the temp folder and submitting the jobs
+- get_progress_queued: a progress check while all jobs are waiting
+- get_progress_done: the first progress check after 90% of the jobs finished
+- get_progress_refresh: another progress check without changes
+- restart: resubmitting the 10% failed jobs
+- get_results: loading all results
+
+for every number of jobs and argument type. With ``small`` arguments, every
+job gets a small array. With ``large`` arguments, all jobs share an 8MB array
+in addition. The timings are written as JSON and can be compared with an
+earlier run to find regressions::
+
+    python benchmarks/benchmark.py --output new.json
+    python benchmarks/benchmark.py --jobs 100 10000 --compare old.json
+
+"""
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import pygrid
+from pygrid.file_handling import _save_data, _append_journal, _get_info
+from pygrid.file_handling import _get_path
+
+_STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+_OPERATIONS = ['map', 'get_progress_queued', 'get_progress_done',
+               'get_progress_refresh', 'restart', 'get_results']
+
+
+def benchmark_function(x, data=None):
+    return x.sum()
+
+
+def _get_args(njobs, arg_type):
+    if arg_type == 'small':
+        return [{'x': numpy.arange(i, i + 8.)} for i in range(njobs)]
+    data = numpy.ones(1 << 20)
+    return [{'x': numpy.arange(i, i + 8.), 'data': data} for i in
+            range(njobs)]
+
+
+def _finish_jobs(temp_folder, njobs, state_folder):
+    # writes results for 90% of the jobs and removes the tasks from the stub
+    # queue, so that the remaining jobs count as failed. the result files are
+    # links to a single file to keep this fast
+    ids = [id for id in range(njobs) if id % 10 != 9]
+    template = os.path.join(temp_folder, 'result_template')
+    _save_data(template, numpy.zeros(8))
+    shard = _get_info(temp_folder).get('shard')
+    for id in ids:
+        os.link(template, _get_path(temp_folder, 'result', id, shard))
+    os.remove(template)
+    _append_journal(temp_folder, [(id, 'ok', 0.) for id in ids])
+    for name in os.listdir(state_folder):
+        if not name.startswith('.'):
+            os.remove(os.path.join(state_folder, name))
+
+
+def _run(njobs, arg_type, work_folder):
+    # runs all operations once and returns their durations in seconds
+    state_folder = os.path.join(work_folder, 'state')
+    temp_folder = os.path.join(work_folder, 'temp_pygrid')
+    os.makedirs(state_folder)
+    os.environ['PYGRID_STUB_STATE'] = state_folder
+    args = _get_args(njobs, arg_type)
+
+    times = {}
+    start = time.time()
+    pygrid.map(benchmark_function, args, temp_folder=temp_folder,
+               interactive=False)
+    times['map'] = time.time() - start
+    del args
+
+    start = time.time()
+    pygrid.get_progress(temp_folder)
+    times['get_progress_queued'] = time.time() - start
+
+    _finish_jobs(temp_folder, njobs, state_folder)
+    for operation in ['get_progress_done', 'get_progress_refresh']:
+        start = time.time()
+        pygrid.get_progress(temp_folder)
+        times[operation] = time.time() - start
+
+    start = time.time()
+    pygrid.restart(temp_folder)
+    times['restart'] = time.time() - start
+
+    start = time.time()
+    pygrid.get_results(temp_folder)
+    times['get_results'] = time.time() - start
+
+    shutil.rmtree(work_folder)
+    return times
+
+
+def run_benchmarks(jobs, arg_types, repeat=1):
+    """ Runs the benchmarks and returns a dict that can be saved as JSON
+
+    The time of each operation is the minimum over the repetitions.
+    """
+    os.environ['PATH'] = _STUBS + os.pathsep + os.environ['PATH']
+    results = []
+    for njobs in jobs:
+        for arg_type in arg_types:
+            best = {}
+            for i in range(repeat):
+                times = _run(njobs, arg_type, tempfile.mkdtemp())
+                for operation, seconds in times.items():
+                    best[operation] = min(best.get(operation, seconds),
+                                          seconds)
+            for operation in _OPERATIONS:
+                results.append({'njobs': njobs, 'args': arg_type,
+                                'operation': operation,
+                                'seconds': best[operation]})
+                print('%8d jobs %6s args %22s: %9.3fs' % (
+                    njobs, arg_type, operation, best[operation]))
+    return {'pygrid': pygrid.__version__,
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results}
+
+
+def compare(results, baseline, tolerance):
+    """ Returns the results that are slower than in baseline by tolerance
+
+    Very short operations vary a lot, so operations that take less than 50ms
+    in both runs are not compared.
+    """
+    old = dict(((r['njobs'], r['args'], r['operation']), r['seconds']) for r
+               in baseline['results'])
+    slower = []
+    for r in results['results']:
+        key = (r['njobs'], r['args'], r['operation'])
+        if key not in old or max(old[key], r['seconds']) < 0.05:
+            continue
+        if r['seconds'] > old[key] * tolerance:
+            slower.append(dict(r, baseline=old[key]))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--jobs', type=int, nargs='+',
+                        default=[100, 10000, 1000000],
+                        help='numbers of jobs (default: 100 10000 1000000)')
+    parser.add_argument('--args', nargs='+', default=['small', 'large'],
+                        choices=['small', 'large'], help='argument types')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='repetitions, the fastest one is kept')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slowdown factor that counts as regression')
+    options = parser.parse_args()
+
+    results = run_benchmarks(options.jobs, options.args, options.repeat)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if options.compare is not None:
+        with open(options.compare) as f:
+            slower = compare(results, json.load(f), options.tolerance)
+        for r in slower:
+            print('Regression: %d jobs %s args %s took %.3fs instead of '
+                  '%.3fs' % (r['njobs'], r['args'], r['operation'],
+                             r['seconds'], r['baseline']))
+        if len(slower) > 0:
+            sys.exit(1)
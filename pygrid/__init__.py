@@ -4,7 +4,15 @@
 
 __version__ = '1.0.0'
 
-from .map import map, restart
+from .map import map, imap, imap_unordered, map_reduce, restart
 from .progress import get_progress
+from .stats import get_stats
+from .retry import get_failures
+from .reduce import get_reduced
+from .pipeline import pipeline
 from .file_handling import get_results, get_args, delete_folder
 from .file_handling import delete_all_folders
+from .results import Results
+from .executor import GridExecutor
+from . import cache
+from . import backends
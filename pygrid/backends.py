@@ -0,0 +1,624 @@
+""" Implements the scheduler backends of pygrid
+
+A backend submits array jobs, queries the states of their tasks and cancels
+them, each with a single scheduler command. The backend of a PyGrid folder is
+chosen with the ``backend`` argument of :py:meth:`~pygrid.map` by one of the
+names in ``pygrid.backends.BACKENDS``. Use :py:meth:`register` to add a
+backend, e.g. a :py:class:`FakeBackend` with other settings.
+"""
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import re
+import subprocess
+import getpass
+import threading
+import random
+import time
+import signal
+import math
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+
+def _expand_task_ranges(tasks):
+    # expands task ranges like 1-5000:1 or 1,3,5-7 to a set of task ids
+    task_ids = set()
+    for task_range in tasks.split(','):
+        if '-' in task_range:
+            first, rest = task_range.split('-')
+            last, step = (rest.split(':') + ['1'])[:2]
+            task_ids.update(range(int(first), int(last) + 1, int(step)))
+        else:
+            task_ids.add(int(task_range))
+    return task_ids
+
+
+class Backend(object):
+    """ Base class for scheduler backends
+
+    The job script of a submission runs ``execute_job.py`` with the job id and
+    the task id, which the backend provides in the variables
+    ``job_id_variable`` and ``task_id_variable``.
+    """
+
+    job_id_variable = '${JOB_ID}'
+    task_id_variable = '${SGE_TASK_ID}'
+
+    def write_header(self, f, ntasks, cluster_params, log_files=True):
+        """ Writes the scheduler directives of a job script with ntasks
+
+        The output of each task goes to the files ``log_output_<task id>`` and
+        ``log_error_<task id>`` in the temp folder. If log_files is False, the
+        script redirects the output itself and the scheduler should discard
+        it.
+        """
+        raise NotImplementedError()
+
+    def submit(self, temp_folder, script, ntasks, hold=None):
+        """ Submits the job script as an array job and returns its qid
+
+        If hold is the qid of an array job with the same number of tasks,
+        each task waits until the task with the same id of that job is done.
+        Raises an exception with the scheduler output if the submission
+        failed.
+        """
+        raise NotImplementedError()
+
+    def get_task_states(self, qids):
+        """ Returns the running and waiting task ids for each of the qids
+
+        The returned dict maps each qid to a tuple of two sets.
+        """
+        raise NotImplementedError()
+
+    def cancel(self, qids, first=None, last=None):
+        """ Cancels the jobs, or only the tasks first to last of them """
+        raise NotImplementedError()
+
+    def get_failures(self, qid, cluster_params):
+        """ Returns the reasons why tasks of a finished job failed
+
+        The returned dict maps task ids to ``'memory'``, ``'timeout'`` or
+        ``'node'``, as far as the scheduler accounting tells. cluster_params
+        are the parameters the job was submitted with.
+        """
+        return {}
+
+    def scale_params(self, cluster_params, resource, factor):
+        """ Returns the cluster_params with the limit of a resource scaled
+
+        resource is ``'memory'`` or ``'timeout'``. Parameters that do not set
+        a limit of the resource are returned unchanged.
+        """
+        return list(cluster_params)
+
+
+class SGEBackend(Backend):
+    """ Backend for gridengine using qsub, qstat and qdel """
+
+    def write_header(self, f, ntasks, cluster_params, log_files=True):
+        f.write('#$ -cwd\n')
+        f.write('#$ -t 1-' + str(ntasks) + '\n')
+        if log_files:
+            f.write('#$ -e log_error_$TASK_ID\n')
+            f.write('#$ -o log_output_$TASK_ID\n')
+        else:
+            f.write('#$ -e /dev/null\n')
+            f.write('#$ -o /dev/null\n')
+        f.write('#$ -S /bin/bash\n')
+        for p in cluster_params:
+            f.write('#$ ' + p + '\n')
+
+    def submit(self, temp_folder, script, ntasks, hold=None):
+        command = ['qsub', script]
+        if hold is not None:
+            command[1:1] = ['-hold_jid_ad', hold]
+        output = subprocess.Popen(
+            command, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+            cwd=temp_folder).communicate()[0]
+
+        # output should be Your job-array 1234.1-...
+        try:
+            ref, qid_string = output.split(' job-array ')
+        except ValueError:
+            raise Exception(output)
+        if ref != 'Your' or '.' not in qid_string:
+            raise Exception(output)
+        return qid_string.split('.')[0]
+
+    def get_task_states(self, qids):
+        # qstat can not list the tasks of given jobs, so only the jobs of the
+        # current user are requested
+        if len(qids) == 0:
+            return {}
+        p = subprocess.Popen(['qstat', '-xml', '-u', getpass.getuser()],
+                             stdout=subprocess.PIPE)
+        try:
+            return _parse_qstat_xml(p.stdout, qids)
+        finally:
+            p.communicate()
+
+    def cancel(self, qids, first=None, last=None):
+        command = ['qdel'] + list(qids)
+        if first is not None:
+            command += ['-t', str(first) + '-' + str(last)]
+        subprocess.Popen(command, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+
+    def get_failures(self, qid, cluster_params):
+        # accounting may not be available to users
+        try:
+            output = subprocess.Popen(['qacct', '-j', qid],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE).communicate()[0]
+        except OSError:
+            return {}
+        memory_limit = time_limit = None
+        for p in cluster_params:
+            for key, value in re.findall(_SGE_RESOURCE, p):
+                if key in _SGE_MEMORY:
+                    memory_limit = _parse_memory(value)
+                elif key in _SGE_TIME:
+                    time_limit = _parse_time(value)
+        failures = {}
+        for task in _parse_qacct(output):
+            reason = _classify_qacct(task, memory_limit, time_limit)
+            if reason is not None:
+                failures[int(task['taskid'])] = reason
+        return failures
+
+    def scale_params(self, cluster_params, resource, factor):
+        keys = _SGE_MEMORY if resource == 'memory' else _SGE_TIME
+
+        def scale(match):
+            key, value = match.group(1), match.group(2)
+            if key not in keys:
+                return match.group(0)
+            elif resource == 'memory':
+                value = _format_memory(_parse_memory(value) * factor)
+            else:
+                value = _format_time(_parse_time(value) * factor)
+            return key + '=' + value
+
+        return [re.sub(_SGE_RESOURCE, scale, p) for p in cluster_params]
+
+
+# the resources of gridengine that limit memory and runtime
+_SGE_MEMORY = ['h_vmem', 's_vmem', 'h_data', 's_data', 'vf', 'virtual_free',
+               'mem_free']
+_SGE_TIME = ['h_rt', 's_rt', 'h_cpu', 's_cpu']
+_SGE_RESOURCE = r'\b(\w+)=([0-9.:]+[KkMmGgTt]?)'
+# units of memory values of gridengine, k and K are different
+_MEMORY_UNITS = {'': 1, 'k': 1e3, 'K': 1024, 'm': 1e6, 'M': 1024 ** 2,
+                 'g': 1e9, 'G': 1024 ** 3, 't': 1e12, 'T': 1024 ** 4}
+
+
+def _parse_memory(value):
+    # returns the number of bytes of a value like 10G or 1.5GB
+    value = value.rstrip('B')
+    if value[-1:] in _MEMORY_UNITS:
+        return float(value[:-1]) * _MEMORY_UNITS[value[-1]]
+    return float(value)
+
+
+def _format_memory(size):
+    # the largest unit with a whole number, slurm does not accept fractions.
+    # otherwise megabytes, rounded up
+    for unit in ['T', 'G', 'M']:
+        if size >= _MEMORY_UNITS[unit] and size % _MEMORY_UNITS[unit] == 0:
+            return '%d%s' % (size // _MEMORY_UNITS[unit], unit)
+    return '%dM' % math.ceil(size / _MEMORY_UNITS['M'])
+
+
+def _parse_time(value):
+    # returns the number of seconds of a value like 1:30:00 or 5400
+    seconds = 0.
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part or 0)
+    return seconds
+
+
+def _format_time(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
+
+
+def _parse_qacct(output):
+    # returns a dict with the fields of each task in the output of qacct -j
+    tasks = []
+    for block in output.split('=' * 62)[1:]:
+        task = {}
+        for line in block.splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                task[fields[0]] = fields[1].strip()
+        if 'taskid' in task:
+            tasks.append(task)
+    return tasks
+
+
+def _classify_qacct(task, memory_limit, time_limit):
+    # gridengine kills tasks that exceed their memory or runtime limit and
+    # does not tell which one. the used resources are compared to the limits
+    failed = int(task.get('failed', '0').split()[0])
+    exit_status = int(task.get('exit_status', '0').split()[0])
+    if failed == 0 and exit_status == 0:
+        return None
+    maxvmem = task.get('maxvmem')
+    wallclock = task.get('ru_wallclock')
+    if (memory_limit is not None and maxvmem is not None and
+            _parse_memory(maxvmem) >= 0.95 * memory_limit):
+        return 'memory'
+    elif (time_limit is not None and wallclock is not None and
+            float(wallclock.rstrip('s')) >= 0.95 * time_limit):
+        return 'timeout'
+    elif exit_status == 152:
+        # SIGXCPU, sent when the soft runtime limit is reached
+        return 'timeout'
+    elif failed not in [0, 100]:
+        # the task could not be started or finished on its node. 100 means
+        # that the job itself failed
+        return 'node'
+    return None
+
+
+def _parse_qstat_xml(source, qids):
+    # parses the output of qstat -xml. pending tasks of array jobs are
+    # reported as ranges like 1-5000:1 and get expanded
+    states = dict((qid, (set(), set())) for qid in qids)
+    for event, elem in ElementTree.iterparse(source):
+        if elem.tag != 'job_list':
+            continue
+        qid = elem.findtext('JB_job_number')
+        tasks = elem.findtext('tasks')
+        state = elem.findtext('state', '')
+        elem.clear()
+        if qid not in states or tasks is None:
+            continue
+        if 'd' in state or 'E' in state:
+            # consider jobs that are deleted or in error state as done
+            continue
+        elif 'q' in state:
+            states[qid][1].update(_expand_task_ranges(tasks))
+        else:
+            # running, transferring, suspended
+            states[qid][0].update(_expand_task_ranges(tasks))
+    return states
+
+
+class SlurmBackend(Backend):
+    """ Backend for SLURM using sbatch, squeue and scancel """
+
+    job_id_variable = '${SLURM_ARRAY_JOB_ID}'
+    task_id_variable = '${SLURM_ARRAY_TASK_ID}'
+
+    def write_header(self, f, ntasks, cluster_params, log_files=True):
+        f.write('#SBATCH --array=1-' + str(ntasks) + '\n')
+        if log_files:
+            f.write('#SBATCH --error=log_error_%a\n')
+            f.write('#SBATCH --output=log_output_%a\n')
+        else:
+            f.write('#SBATCH --error=/dev/null\n')
+            f.write('#SBATCH --output=/dev/null\n')
+        for p in cluster_params:
+            f.write('#SBATCH ' + p + '\n')
+
+    def submit(self, temp_folder, script, ntasks, hold=None):
+        command = ['sbatch', '--parsable', script]
+        if hold is not None:
+            # a task whose task of hold failed is cancelled instead of
+            # waiting forever
+            command[2:2] = ['--dependency=aftercorr:' + hold,
+                            '--kill-on-invalid-dep=yes']
+        p = subprocess.Popen(command, stderr=subprocess.PIPE,
+                             stdout=subprocess.PIPE, cwd=temp_folder)
+        output, error = p.communicate()
+        # output should be 1234 or 1234;cluster
+        qid = output.strip().split(';')[0]
+        if p.returncode != 0 or not qid.isdigit():
+            raise Exception(output + error)
+        return qid
+
+    def get_task_states(self, qids):
+        if len(qids) == 0:
+            return {}
+        output = subprocess.Popen(
+            ['squeue', '-h', '-j', ','.join(qids), '-o', '%F %K %t'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0]
+        return _parse_squeue(output, qids)
+
+    def cancel(self, qids, first=None, last=None):
+        if first is not None:
+            qids = [qid + '_[' + str(first) + '-' + str(last) + ']' for qid in
+                    qids]
+        subprocess.Popen(['scancel'] + list(qids), stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE).communicate()
+
+    def get_failures(self, qid, cluster_params):
+        try:
+            output = subprocess.Popen(
+                ['sacct', '-n', '-P', '-j', qid, '-o', 'JobID,State'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE).communicate()[0]
+        except OSError:
+            return {}
+        failures = {}
+        for line in output.splitlines():
+            fields = line.split('|')
+            # the steps of a task have ids like 1234_5.batch
+            if len(fields) < 2 or '_' not in fields[0] or '.' in fields[0]:
+                continue
+            task_id = fields[0].split('_')[1]
+            state = fields[1].split()[0] if fields[1] else ''
+            if task_id.isdigit() and state in _SLURM_FAILURES:
+                failures[int(task_id)] = _SLURM_FAILURES[state]
+        return failures
+
+    def scale_params(self, cluster_params, resource, factor):
+        if resource == 'memory':
+            pattern = r'(--mem(?:-per-cpu)?[= ])([0-9.]+[KMGT]?)'
+        else:
+            pattern = r'(--time[= ]|-t )([0-9:-]+)'
+
+        def scale(match):
+            if resource == 'memory':
+                size = _parse_memory(match.group(2))
+                # without unit, slurm uses megabytes
+                if match.group(2)[-1].isdigit():
+                    size *= _MEMORY_UNITS['M']
+                value = _format_memory(size * factor)
+            else:
+                value = _format_slurm_time(
+                    _parse_slurm_time(match.group(2)) * factor)
+            return match.group(1) + value
+
+        return [re.sub(pattern, scale, p) for p in cluster_params]
+
+
+# the states of slurm accounting that tell why a task failed
+_SLURM_FAILURES = {'OUT_OF_MEMORY': 'memory', 'TIMEOUT': 'timeout',
+                   'DEADLINE': 'timeout', 'NODE_FAIL': 'node',
+                   'BOOT_FAIL': 'node', 'PREEMPTED': 'node'}
+
+
+def _parse_slurm_time(value):
+    # slurm times are minutes, minutes:seconds, hours:minutes:seconds or
+    # start with days-
+    days = 0
+    if '-' in value:
+        days, value = value.split('-')
+        days = int(days)
+        if value.count(':') < 2:
+            value += ':00' * (2 - value.count(':'))
+    elif value.count(':') == 0:
+        value += ':00'
+    if value.count(':') == 1:
+        value = '0:' + value
+    return days * 86400 + _parse_time(value)
+
+
+def _format_slurm_time(seconds):
+    seconds = int(round(seconds))
+    return '%d-%02d:%02d:%02d' % (seconds // 86400, seconds // 3600 % 24,
+                                  seconds // 60 % 60, seconds % 60)
+
+
+def _parse_squeue(output, qids):
+    # parses lines of squeue -o '%F %K %t'. pending tasks are reported as
+    # ranges like 5-5000%10, where %10 limits the number of running tasks
+    states = dict((qid, (set(), set())) for qid in qids)
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 3 or fields[0] not in states:
+            continue
+        qid, tasks, state = fields
+        tasks = tasks.strip('[]').split('%')[0]
+        if state == 'PD':
+            states[qid][1].update(_expand_task_ranges(tasks))
+        elif state in ['R', 'CF', 'S', 'RQ']:
+            states[qid][0].update(_expand_task_ranges(tasks))
+        else:
+            # consider completing, cancelled, failed, ... jobs as done
+            pass
+    return states
+
+
+class LocalBackend(Backend):
+    """ Backend that runs the tasks as processes on the local machine
+
+    The tasks are tracked by the process that submitted them. They are not
+    visible to other processes and tasks that did not start yet are lost when
+    the process ends.
+
+    Parameters
+    ----------
+    max_processes : int, optional
+        The number of tasks that run at the same time. Default is None, which
+        uses the number of CPU cores.
+    """
+
+    def __init__(self, max_processes=None):
+        if max_processes is None:
+            import multiprocessing
+            max_processes = multiprocessing.cpu_count()
+        self.max_processes = max_processes
+        # per qid a dict with the state of each task: 'waiting', a Popen
+        # object for running tasks, 'done' or 'lost'
+        self._tasks = {}
+        self._folders = {}
+        self._submitted = {}
+        self._holds = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._qid = 0
+        # the scripts that redirect their output themselves
+        self._no_log_files = set()
+
+    def write_header(self, f, ntasks, cluster_params, log_files=True):
+        if not log_files:
+            self._no_log_files.add(os.path.abspath(f.name))
+
+    def submit(self, temp_folder, script, ntasks, hold=None):
+        with self._lock:
+            self._qid += 1
+            qid = str(os.getpid()) + str(self._qid).zfill(4)
+            self._holds[qid] = hold
+            self._tasks[qid] = dict((task_id, 'waiting') for task_id in
+                                    range(1, ntasks + 1))
+            self._folders[qid] = (temp_folder, script)
+            self._submitted[qid] = time.time()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._dispatch)
+                self._thread.daemon = True
+                self._thread.start()
+        return qid
+
+    def _ready(self, qid, task_id):
+        # if a waiting task may be started. a held task waits until the task
+        # with the same id of the other job is done
+        hold = self._holds.get(qid)
+        return hold is None or self._tasks.get(hold, {}).get(task_id) in [
+            None, 'done', 'lost']
+
+    def _start(self, qid, task_id):
+        temp_folder, script = self._folders[qid]
+        env = dict(os.environ, JOB_ID=qid, SGE_TASK_ID=str(task_id))
+        if os.path.abspath(os.path.join(temp_folder,
+                                        script)) in self._no_log_files:
+            out_name = err_name = os.devnull
+        else:
+            out_name = os.path.join(temp_folder, 'log_output_' + str(task_id))
+            err_name = os.path.join(temp_folder, 'log_error_' + str(task_id))
+        with open(out_name, 'a') as out:
+            with open(err_name, 'a') as err:
+                # the task gets its own process group, so that cancel also
+                # stops the python process that bash starts
+                return subprocess.Popen(['bash', script], cwd=temp_folder,
+                                        env=env, stdout=out, stderr=err,
+                                        preexec_fn=os.setsid)
+
+    def _dispatch(self):
+        # starts waiting tasks in submission order while there are free slots
+        while True:
+            with self._lock:
+                running = 0
+                waiting = []
+                for qid in sorted(self._tasks):
+                    for task_id, state in self._tasks[qid].items():
+                        if state == 'waiting':
+                            waiting.append((qid, task_id))
+                        elif state not in ['done', 'lost']:
+                            if state.poll() is None:
+                                running += 1
+                            else:
+                                self._tasks[qid][task_id] = 'done'
+                if running + len(waiting) == 0:
+                    break
+                for qid, task_id in waiting:
+                    if running >= self.max_processes:
+                        break
+                    if self._ready(qid, task_id):
+                        self._tasks[qid][task_id] = self._start(qid, task_id)
+                        running += 1
+            time.sleep(0.1)
+
+    def get_task_states(self, qids):
+        states = {}
+        with self._lock:
+            for qid in qids:
+                states[qid] = (set(), set())
+                for task_id, state in self._tasks.get(qid, {}).items():
+                    if state == 'waiting':
+                        states[qid][1].add(task_id)
+                    elif (state not in ['done', 'lost'] and
+                            state.poll() is None):
+                        states[qid][0].add(task_id)
+        return states
+
+    def get_failures(self, qid, cluster_params):
+        with self._lock:
+            return dict((task_id, 'node') for task_id, state in
+                        self._tasks.get(qid, {}).items() if state == 'lost')
+
+    def cancel(self, qids, first=None, last=None):
+        with self._lock:
+            for qid in qids:
+                for task_id, state in self._tasks.get(qid, {}).items():
+                    if first is not None and not first <= task_id <= last:
+                        continue
+                    if state not in ['waiting', 'done', 'lost']:
+                        if state.poll() is None:
+                            os.killpg(state.pid, signal.SIGKILL)
+                            state.wait()
+                    self._tasks[qid][task_id] = 'done'
+
+
+class FakeBackend(LocalBackend):
+    """ Local backend that simulates queue delays and failing tasks
+
+    Allows to test the behaviour of large runs without a cluster.
+
+    Parameters
+    ----------
+    max_processes : int, optional
+        The number of tasks that run at the same time. Default is None, which
+        uses the number of CPU cores.
+    delay : float, optional
+        The number of seconds a task waits in the queue at least. Default is
+        1.
+    failure_rate : float, optional
+        The probability that a task is lost before it starts, as with a node
+        failure. Default is 0.
+    seed : int, optional
+        The seed for the random failures. Default is None.
+    """
+
+    def __init__(self, max_processes=None, delay=1, failure_rate=0,
+                 seed=None):
+        LocalBackend.__init__(self, max_processes)
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    def _ready(self, qid, task_id):
+        if not LocalBackend._ready(self, qid, task_id):
+            return False
+        if time.time() - self._submitted[qid] < self.delay:
+            return False
+        if self._random.random() < self.failure_rate:
+            # the task disappears without running
+            self._tasks[qid][task_id] = 'lost'
+            return False
+        return True
+
+
+BACKENDS = {'sge': SGEBackend(),
+            'slurm': SlurmBackend(),
+            'local': LocalBackend(),
+            'fake': FakeBackend()}
+
+
+def register(name, backend):
+    """ Registers a backend under a name
+
+    Parameters
+    ----------
+    name : string
+        The name that is passed as ``backend`` to :py:meth:`~pygrid.map`.
+    backend : Backend
+        The backend instance.
+    """
+    BACKENDS[name] = backend
+
+
+def _get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend `' + str(name) + '`.')
+    return BACKENDS[name]
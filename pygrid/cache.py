@@ -0,0 +1,172 @@
+""" Implements a result cache that is shared between pygrid runs """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+from os.path import join as pjoin
+from os.path import exists as pexists
+import shutil
+import hashlib
+import inspect
+import time
+import types
+
+from .file_handling import _hash_value, _cache_path, _append_journal
+from .file_handling import _get_info, _get_path, _copy_file
+
+DEFAULT_FOLDER = pjoin(os.path.expanduser('~'), '.pygrid_cache')
+
+
+def _get_cache_folder(cache):
+    # resolve the cache option of map to a folder or None
+    if cache is None or cache is False:
+        return None
+    elif cache is True:
+        return DEFAULT_FOLDER
+    return os.path.abspath(cache)
+
+
+def _hash_code(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names))
+    for const in code.co_consts:
+        # nested functions have code objects whose repr contains an address
+        if isinstance(const, types.CodeType):
+            _hash_code(h, const)
+        else:
+            h.update(repr(const))
+
+
+def _hash_function(function):
+    # hash the function source. if it is not available, hash the bytecode
+    h = hashlib.sha1(function.__name__)
+    try:
+        h.update(inspect.getsource(function))
+    except (IOError, TypeError):
+        _hash_code(h, function.__code__)
+    return h.hexdigest()
+
+
+def _get_job_keys(function, args, value_hashes=None):
+    # returns one cache key for each job. values that are shared between jobs
+    # are only hashed once
+    function_hash = _hash_function(function)
+    if value_hashes is None:
+        value_hashes = {}
+    keys = []
+    for arg in args:
+        h = hashlib.sha1(function_hash)
+        for name in sorted(arg):
+            if id(arg[name]) not in value_hashes:
+                value_hashes[id(arg[name])] = _hash_value(arg[name])
+            h.update(name + ':' + value_hashes[id(arg[name])] + ';')
+        keys.append(h.hexdigest())
+    return keys
+
+
+def _write_cache_keys(temp_folder, keys, append=False):
+    with open(pjoin(temp_folder, 'cache_keys'), 'ab' if append else 'wb') as f:
+        f.write(''.join([key + '\n' for key in keys]))
+
+
+def _get_cached(temp_folder, cache_folder, keys, first=0):
+    # copies the cached results into the temp folder. returns the ids of the
+    # jobs that still have to be run. keys start with the job id first. the
+    # results are not linked, so that writing to them can not change the cache
+    ids = []
+    hits = []
+    shard = _get_info(temp_folder).get('shard')
+    for id, key in enumerate(keys, first):
+        path = _cache_path(cache_folder, key)
+        filename = _get_path(temp_folder, 'result', id, shard)
+        try:
+            _copy_file(path, filename)
+        except IOError:
+            ids.append(id)
+            continue
+        # mark the entry as recently used for evict
+        os.utime(path, None)
+        hits.append((id, 'ok', 0))
+    if len(hits) > 0:
+        _append_journal(temp_folder, hits)
+    return ids
+
+
+def _get_entries(cache_folder):
+    # returns (last use, size, path) for all cache entries
+    entries = []
+    if not pexists(cache_folder):
+        return entries
+    for folder in os.listdir(cache_folder):
+        for name in os.listdir(pjoin(cache_folder, folder)):
+            if name.startswith('.'):
+                continue
+            path = pjoin(cache_folder, folder, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def usage(cache_folder=None):
+    """ Returns the number of cached results and their size
+
+    Parameters
+    ----------
+    cache_folder : string, optional
+        The cache folder. Default is None, which uses the default folder
+        ``~/.pygrid_cache``.
+
+    Returns
+    -------
+    output : tuple
+        The number of cached results and their total size in bytes.
+    """
+    entries = _get_entries(cache_folder or DEFAULT_FOLDER)
+    return len(entries), sum([size for _, size, _ in entries])
+
+
+def evict(cache_folder=None, max_size=None, max_age=None):
+    """ Deletes old cached results
+
+    Parameters
+    ----------
+    cache_folder : string, optional
+        The cache folder. Default is None, which uses the default folder
+        ``~/.pygrid_cache``.
+    max_size : int, optional
+        The maximal total size of the cache in bytes. The least recently used
+        results are deleted until the cache is small enough. Default is None.
+    max_age : float, optional
+        Results that were not used for more than this number of seconds are
+        deleted. Default is None.
+
+    Returns
+    -------
+    output : int
+        The number of deleted results.
+    """
+    entries = sorted(_get_entries(cache_folder or DEFAULT_FOLDER))
+    size = sum([size for _, size, _ in entries])
+    deleted = 0
+    for last_use, entry_size, path in entries:
+        if (max_age is not None and time.time() - last_use > max_age or
+                max_size is not None and size > max_size):
+            os.remove(path)
+            size -= entry_size
+            deleted += 1
+    return deleted
+
+
+def clear(cache_folder=None):
+    """ Deletes all cached results
+
+    Parameters
+    ----------
+    cache_folder : string, optional
+        The cache folder. Default is None, which uses the default folder
+        ``~/.pygrid_cache``.
+    """
+    cache_folder = cache_folder or DEFAULT_FOLDER
+    if pexists(cache_folder):
+        shutil.rmtree(cache_folder)
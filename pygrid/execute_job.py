@@ -5,37 +5,223 @@
 
 import sys
 import os
+import time
+import traceback
+import socket
+import resource
+import cProfile
+import copy
 
-from file_handling import _get_info, _get_common_args,  _get_job_args
-from file_handling import _save_data
+from file_handling import _get_info, _read_common_args,  _get_job_args
+from file_handling import _save_data, _get_job_map, _append_journal
+from file_handling import _cache_store, _get_cache_key, _claim_jobs
+from file_handling import _append_metrics, _get_args_size, _save_first
+from file_handling import _get_speculated, _get_reduce_map, _load_data
+from file_handling import _get_path, _resolve_blobs
+from snapshot import _load_snapshot
 
-if __name__ == '__main__':
-    assert(len(sys.argv) == 3)
+# common args per temp folder, kept by local worker processes that run many
+# tasks of the same map call. their blobs are not loaded yet. every job gets
+# its own copy and blobs, so that a job that changes an argument in place does
+# not change it for the later jobs
+_common_args_cache = {}
+
+
+def _times():
+    # wall clock time and cpu time of this process
+    times = os.times()
+    return time.time(), times[0] + times[1]
+
+
+def _elapsed(start, end):
+    return end[0] - start[0], end[1] - start[1]
 
-    # find out which id to run
-    with open('submit_map_' + sys.argv[1]) as f:
-        id = [int(id) for id in f.read().split()][int(sys.argv[2]) - 1]
 
-    # load args
-    common_args = _get_common_args('')
-    args = _get_job_args('', id, common_args)
+def _peak_rss():
+    # the maximal resident set size of this process in bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, mac os bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
 
-    # load info
-    info = _get_info('')
+
+def _run_jobs(temp_folder, ids):
+    # runs the jobs with the given ids and writes their result files. returns
+    # False if any of the jobs failed. the time that is spent on loading the
+    # common args and importing the module is added to the first job
+    setup_start = _times()
+
+    # load info and args. with stage, shared args are copied to the node
+    # once. if they can not be loaded, every job fails with the error
+    info = _get_info(temp_folder)
+    stage = info.get('stage')
+    setup_error = None
+    try:
+        if temp_folder not in _common_args_cache:
+            _common_args_cache.clear()
+            _common_args_cache[temp_folder] = _read_common_args(
+                temp_folder, stage, info['timestamp'])
+        common_args = _common_args_cache[temp_folder]
+    except BaseException:
+        common_args = None
+        setup_error = sys.exc_info()
+    import_start = _times()
 
     # change dir to function dir
     oldcwd = os.getcwd()
     os.chdir(info['path'])
 
-    # import function file
-    sys.path.append(info['path'])
-    module = __import__(info['module'])
+    try:
+        return _import_and_run(temp_folder, ids, info, stage, common_args,
+                               setup_error, setup_start, import_start)
+    finally:
+        # change directory back, also if the task is stopped by a job
+        os.chdir(oldcwd)
+
+
+def _import_and_run(temp_folder, ids, info, stage, common_args, setup_error,
+                    setup_start, import_start):
+    # imports the function and runs the jobs in the function dir. a snapshot
+    # of the function avoids importing its module. if the function can not
+    # be loaded, every job fails with the error
+    function = None
+    if setup_error is None:
+        try:
+            if info['path'] not in sys.path:
+                sys.path.append(info['path'])
+            if info.get('snapshot'):
+                function = _load_snapshot(temp_folder, info['timestamp'],
+                                          stage)
+            else:
+                module = __import__(info['module'])
+                function = getattr(module, info['function_name'])
+        except BaseException:
+            setup_error = sys.exc_info()
+    import_end = _times()
 
-    # execute job function
-    result = getattr(module, info['function_name'])(**args)
+    # execute job function for every id. a failing job must not keep the
+    # other jobs from running, also if its args can not be loaded
+    success = True
+    host = socket.gethostname()
+    for i, id in enumerate(ids):
+        filename = _get_path(temp_folder, 'result', id, info.get('shard'))
+        if info.get('speculate') is not None:
+            # a copy of a slow job may already be done. otherwise the start
+            # time tells when the job is slow
+            if id in _get_speculated(temp_folder) and os.path.exists(filename):
+                continue
+            _append_journal(temp_folder, [(id, 'started', time.time())])
+        metrics = {'id': id, 'host': host, 'result_size': 0, 'args_size': 0}
+        start = _times()
+        compute_start = None
+        try:
+            if setup_error is not None:
+                raise setup_error[0], setup_error[1], setup_error[2]
+            metrics['args_size'] = _get_args_size(temp_folder, id)
+            args = _get_job_args(temp_folder, id, _resolve_blobs(
+                temp_folder, copy.deepcopy(common_args), stage), stage)
+            if info.get('inputs') is not None:
+                # the result of the job with the same id in the previous
+                # stage of a pipeline. the job fails if that job failed
+                inputs = info['inputs']
+                args = dict(args, **{inputs['name']: _load_data(_get_path(
+                    os.path.join(temp_folder, inputs['folder']), 'result', id,
+                    inputs['shard']))})
+            compute_start = _times()
+            if info.get('profile'):
+                profiler = cProfile.Profile()
+                try:
+                    result = profiler.runcall(function, **args)
+                finally:
+                    profiler.dump_stats(os.path.join(temp_folder,
+                                                     'profile_' + str(id)))
+            else:
+                result = function(**args)
+        except BaseException:
+            # sys.exit in a job must not stop the other jobs of the task
+            compute_end = _times()
+            if compute_start is None:
+                compute_start = compute_end
+            sys.stderr.write('Job with id ' + str(id) + ' failed:\n')
+            traceback.print_exc()
+            metrics.update(status='failed', save_wall=0., save_cpu=0.)
+            success = False
+        else:
+            compute_end = _times()
+            # write results to file and note that the job is done. if a job
+            # runs twice, the first result is kept
+            if (info.get('speculate') is not None and
+                    id in _get_speculated(temp_folder)):
+                if not _save_first(filename, result):
+                    continue
+            else:
+                _save_data(filename, result)
+            if info.get('cache') is not None:
+                _cache_store(info['cache'], _get_cache_key(temp_folder, id),
+                             filename)
+            save_end = _times()
+            metrics['status'] = 'ok'
+            metrics['save_wall'], metrics['save_cpu'] = _elapsed(compute_end,
+                                                                 save_end)
+            metrics['result_size'] = os.path.getsize(filename)
+        if i == 0:
+            load = _elapsed(setup_start, import_start)
+            metrics['import_wall'], metrics['import_cpu'] = _elapsed(
+                import_start, import_end)
+        else:
+            load = (0., 0.)
+            metrics['import_wall'] = metrics['import_cpu'] = 0.
+        metrics['load_wall'] = load[0] + compute_start[0] - start[0]
+        metrics['load_cpu'] = load[1] + compute_start[1] - start[1]
+        metrics['compute_wall'], metrics['compute_cpu'] = _elapsed(
+            compute_start, compute_end)
+        metrics['peak_rss'] = _peak_rss()
+        _append_metrics(temp_folder, metrics)
+        _append_journal(temp_folder, [(id, metrics['status'],
+                                       metrics['compute_wall'])])
+
+    return success
+
+
+def _run_reduction(temp_folder, inputs, output):
+    # combines the result files inputs with the reducer of map_reduce and
+    # saves the value to output. a failing reducer fails the task
+    info = _get_info(temp_folder)
+    if info['path'] not in sys.path:
+        sys.path.append(info['path'])
+    module = __import__(info['reduce']['module'])
+    reducer = getattr(module, info['reduce']['function_name'])
+    value = _load_data(os.path.join(temp_folder, inputs[0]))
+    for name in inputs[1:]:
+        value = reducer(value, _load_data(os.path.join(temp_folder, name)))
+    _save_data(os.path.join(temp_folder, output), value)
+
+
+def _wait_for(filename):
+    # the job maps are written when the submission returned, which can be
+    # after the first tasks started
+    for i in range(60):
+        if os.path.exists(filename):
+            break
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    assert(len(sys.argv) in [3, 4])
 
-    # change directory back
-    os.chdir(oldcwd)
+    # find out which ids to run. workers take ids from the queue until it is
+    # empty
+    temp_folder = os.getcwd()
+    if len(sys.argv) == 4 and sys.argv[3] == 'reduce':
+        _wait_for(os.path.join(temp_folder, 'reduce_map_' + sys.argv[1]))
+        inputs, output = _get_reduce_map(temp_folder, sys.argv[1])[
+            int(sys.argv[2]) - 1]
+        _run_reduction(temp_folder, inputs, output)
+        sys.exit(0)
+    if _get_info(temp_folder).get('workers') is not None:
+        ids = _claim_jobs(temp_folder, sys.argv[1], sys.argv[2])
+    else:
+        _wait_for(os.path.join(temp_folder, 'submit_map_' + sys.argv[1]))
+        ids = _get_job_map(temp_folder, sys.argv[1])[int(sys.argv[2]) - 1]
 
-    # write results to file
-    _save_data('result_' + str(id), result)
+    if not _run_jobs(temp_folder, ids):
+        sys.exit(1)
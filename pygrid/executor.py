@@ -0,0 +1,244 @@
+""" Implements a concurrent.futures executor for pygrid """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import inspect
+import threading
+import time
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+from .file_handling import _get_result, _get_finished, _get_qids
+from .file_handling import _get_info
+from .map import _write_and_submit, _get_cluster_params
+from .progress import _get_progress, _get_task_states
+from .run import _wait_local
+from .backends import _get_backend
+
+# without concurrent.futures (the futures package on Python 2) the executor
+# can not be used, but pygrid can still be imported
+_Executor = futures.Executor if futures is not None else object
+
+
+class GridExecutor(_Executor):
+    """ Runs function calls as gridengine jobs and returns futures
+
+    Implements the ``concurrent.futures.Executor`` interface. Calls that are
+    submitted shortly after each other are submitted as one array job. One
+    background thread checks the progress of all submitted jobs and sets the
+    results of the futures. If a job fails, its future raises an exception.
+
+    On Python 2, the ``futures`` package is required.
+
+    Parameters
+    ----------
+    temp_folder : string, optional
+        A path to a folder where PyGrid will save the temporary files. Each
+        batch of jobs gets its own PyGrid folder in it. Default is
+        ``'temp_pygrid_executor'``.
+    use_cluster : bool, optional
+        If set to false, the jobs are run on the local machine. Default is
+        True.
+    cluster_params : list, optional
+        A list of strings with additional parameters to use when submitting the
+        jobs. Default is None.
+    chunksize : int or 'auto', optional
+        The number of jobs that are run in a single cluster task. Default is
+        1.
+    max_workers : int, optional
+        The number of local worker processes when ``use_cluster`` is False.
+        Default is None, which uses one worker per CPU core.
+    batch_delay : float, optional
+        The number of seconds to wait for more calls before a batch is
+        submitted. Default is 1.
+    poll_interval : float, optional
+        The number of seconds between progress checks. Default is 2.
+    backend : string, optional
+        The name of the scheduler backend. See :py:meth:`~pygrid.map`.
+        Default is ``'sge'``.
+
+    Examples
+    --------
+    >>> with pygrid.GridExecutor() as executor:
+    ...     results = list(executor.map(function, range(100)))
+    """
+
+    def __init__(self, temp_folder='temp_pygrid_executor', use_cluster=True,
+                 cluster_params=None, chunksize=1, max_workers=None,
+                 batch_delay=1, poll_interval=2, backend='sge'):
+        if futures is None:
+            raise ImportError('GridExecutor requires concurrent.futures. '
+                              'Install the futures package on Python 2.')
+        self._temp_folder = os.path.abspath(temp_folder)
+        self._use_cluster = use_cluster
+        self._cluster_params = _get_cluster_params(cluster_params)
+        self._chunksize = chunksize
+        self._max_workers = max_workers
+        self._batch_delay = batch_delay
+        self._poll_interval = poll_interval
+        self._backend = backend
+        _get_backend(backend)
+
+        # calls that are not submitted yet and the time of the first one
+        self._pending = []
+        self._pending_since = None
+        # submitted batches as dicts with the folder, the futures for the
+        # jobs that are not done and the AsyncResult of local workers
+        self._batches = []
+        self._batch_no = 0
+        self._shutdown = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, fn, *args, **kwargs):
+        """ Submits ``fn(*args, **kwargs)`` as a job and returns a future
+
+        ``fn`` has to be defined at the top level of a module, as for
+        :py:meth:`~pygrid.map`.
+        """
+        if not hasattr(fn, '__call__'):
+            raise ValueError('`fn` has to be callable.')
+        # pygrid calls the function with keyword arguments only
+        call_args = inspect.getcallargs(fn, *args, **kwargs)
+        future = futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Can not submit after shutdown.')
+            if len(self._pending) == 0:
+                self._pending_since = time.time()
+            self._pending.append((future, fn, call_args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll)
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def shutdown(self, wait=True):
+        """ Submits the remaining calls and stops accepting new ones
+
+        Parameters
+        ----------
+        wait : bool, optional
+            If True, wait until all jobs are done. Default is True.
+        """
+        with self._lock:
+            self._shutdown = True
+            thread = self._thread
+        if wait and thread is not None:
+            thread.join()
+
+    def _poll(self):
+        # the background thread. it submits pending calls and resolves the
+        # futures of all batches until shutdown and nothing is left to do
+        while True:
+            with self._lock:
+                if (len(self._pending) > 0 and (self._shutdown or
+                        time.time() - self._pending_since >=
+                        self._batch_delay)):
+                    pending = self._pending
+                    self._pending = []
+                else:
+                    pending = []
+                done = (self._shutdown and len(self._pending) == 0 and
+                        len(pending) == 0 and len(self._batches) == 0)
+            if done:
+                break
+            try:
+                if len(pending) > 0:
+                    self._submit(pending)
+                self._update()
+            except Exception as e:
+                # the futures would never be resolved without this thread
+                self._fail_all(pending, e)
+                break
+            if len(self._batches) > 0 or len(self._pending) > 0:
+                time.sleep(self._poll_interval)
+
+    def _fail_all(self, pending, e):
+        # sets the exception on every future that is not done and stops
+        # accepting new calls
+        with self._lock:
+            self._shutdown = True
+            pending = pending + self._pending
+            self._pending = []
+            batches = self._batches
+            self._batches = []
+        for future, fn, call_args in pending:
+            if not future.done():
+                future.set_exception(e)
+        for batch in batches:
+            for future in batch['futures'].values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def _submit(self, pending):
+        # submits one batch for each function. futures that were cancelled
+        # before are dropped
+        calls = {}
+        for future, fn, call_args in pending:
+            if future.set_running_or_notify_cancel():
+                calls.setdefault(fn, []).append((future, call_args))
+        for fn, fn_calls in calls.items():
+            while True:
+                self._batch_no += 1
+                folder = os.path.join(self._temp_folder,
+                                      'batch_' + str(self._batch_no))
+                if not os.path.exists(folder):
+                    break
+            try:
+                local = _write_and_submit(
+                    fn, [call_args for _, call_args in fn_calls], folder,
+                    self._use_cluster, self._cluster_params, self._chunksize,
+                    self._max_workers, None, None, self._backend, False,
+                    False, None, None, None, None, None,
+                    os.path.abspath(inspect.getfile(fn)))
+            except Exception as e:
+                for future, _ in fn_calls:
+                    future.set_exception(e)
+                continue
+            self._batches.append({
+                'folder': folder, 'local': local,
+                'futures': dict(enumerate([future for future, _ in
+                                           fn_calls]))})
+
+    def _update(self):
+        # resolves the futures of finished and failed jobs. the task states
+        # of all batches are queried with one call of the scheduler
+        qids = {}
+        for batch in self._batches:
+            if batch['local'] is None:
+                qids[batch['folder']] = _get_qids(batch['folder'])
+        task_states = _get_task_states(sum(qids.values(), []), self._backend)
+
+        for batch in list(self._batches):
+            if batch['local'] is None:
+                # each batch only gets the task states of its own qids
+                jobs = _get_progress(batch['folder'], dict(
+                    (qid, task_states[qid]) for qid in qids[batch['folder']]))
+                finished = jobs['finished']
+                failed = jobs['failed']
+            else:
+                # check if the workers are done before looking for results
+                ready = batch['local'].ready()
+                finished = _get_finished(batch['folder'])
+                failed = batch['futures'].keys() if ready else []
+                if ready:
+                    # the jobs of tasks that raised an error fail below
+                    _wait_local(batch['local'])
+            shard = _get_info(batch['folder']).get('shard')
+            for id in finished:
+                if id in batch['futures']:
+                    batch['futures'].pop(id).set_result(
+                        _get_result(batch['folder'], id, None, shard))
+            for id in failed:
+                if id in batch['futures']:
+                    batch['futures'].pop(id).set_exception(Exception(
+                        'Job ' + str(id) + ' in `' + batch['folder'] +
+                        '` failed. See the log files in the folder.'))
+            if len(batch['futures']) == 0:
+                self._batches.remove(batch)
+
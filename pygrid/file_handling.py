@@ -8,42 +8,162 @@ import os
 from os.path import join as pjoin
 from os.path import exists as pexists
 import cPickle as pickle
+from cStringIO import StringIO
+import struct
+import random
+import hashlib
+import socket
+import fcntl
 import time
+import errno
+import contextlib
+from multiprocessing.pool import ThreadPool
 try:
     import numpy
 except:
     numpy = None
 
-
-def _save_data(filename, data):
+# job args that reference a shared value in the blob folder have this prefix
+_BLOB_PREFIX = '_pygrid_blob_'
+# values smaller than this number of bytes are stored with every job
+_BLOB_MIN_SIZE = 1024
+# numpy arrays with at least this number of bytes are memory mapped by jobs
+_MMAP_MIN_SIZE = 1 << 20
+# new folders keep the files of every this many job or task ids in a
+# subfolder of shards, so that no folder holds millions of files
+_SHARD_SIZE = 1000
+# with stage=True, shared inputs are copied to /tmp of the nodes. $TMPDIR is
+# not used, because schedulers like gridengine give every task its own one.
+# copies that were not used for a day are removed, and the least recently
+# used ones when there are more than 10GB
+_STAGE_POLICY = {'folder': '/tmp', 'max_age': 24 * 3600,
+                 'max_size': 10 << 30}
+# the number of threads that read, write or delete the files of a folder at
+# once. on network file systems, most of the time of a file operation is spent
+# waiting for the server
+IO_THREADS = 16
+# the columns of the metrics file. times are in seconds and sizes in bytes
+_METRICS_FIELDS = ['id', 'status', 'host', 'load_wall', 'load_cpu',
+                   'import_wall', 'import_cpu', 'compute_wall', 'compute_cpu',
+                   'save_wall', 'save_cpu', 'peak_rss', 'args_size',
+                   'result_size']
+
+
+def _dump_data(f, data):
     if numpy:
-        with open(filename, 'w') as f:
-            if type(data) == dict:
-                numpy.savez(f, **data)
-            else:
-                numpy.save(f, data)
+        if type(data) == dict:
+            numpy.savez(f, **data)
+        else:
+            numpy.save(f, data)
     else:
-        with open(filename, 'w') as f:
-            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
 
 
-def _load_data(filename):
+def _read_data(f):
     if numpy:
-        data = numpy.load(filename)
+        data = numpy.load(f)
         if hasattr(data, 'files'):
             return dict(data)
         else:
             return data
     else:
-        with open(filename) as f:
-            return pickle.load(f)
+        return pickle.load(f)
+
+
+def _save_data(filename, data):
+    # write to a hidden temporary file first and rename it, so that nobody
+    # reads a half written file. the hostname and pid make the name unique
+    # across jobs that write the same file at the same time
+    folder, name = os.path.split(filename)
+    temp_filename = pjoin(folder, '.' + name + '.' + socket.gethostname() +
+                          '.' + str(os.getpid()))
+    with open(temp_filename, 'wb') as f:
+        _dump_data(f, data)
+    os.rename(temp_filename, filename)
+
+
+def _save_first(filename, data):
+    # like _save_data, but an existing file is not replaced. returns False if
+    # the file was already written by someone else
+    folder, name = os.path.split(filename)
+    temp_filename = pjoin(folder, '.' + name + '.' + socket.gethostname() +
+                          '.' + str(os.getpid()))
+    with open(temp_filename, 'wb') as f:
+        _dump_data(f, data)
+    try:
+        os.link(temp_filename, filename)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    finally:
+        os.remove(temp_filename)
+    return True
+
+
+def _load_data(filename, mmap_mode=None):
+    if numpy and mmap_mode is not None:
+        # numpy ignores mmap_mode for npz files
+        data = numpy.load(filename, mmap_mode=mmap_mode)
+        if hasattr(data, 'files'):
+            return dict(data)
+        else:
+            return data
+    with open(filename, 'rb') as f:
+        return _read_data(f)
+
+
+def _dumps_data(data):
+    f = StringIO()
+    _dump_data(f, data)
+    return f.getvalue()
+
+
+def _loads_data(record):
+    return _read_data(StringIO(record))
+
+
+def _map_io(function, items, threads=None):
+    # calls function for each item in a pool of threads and returns the
+    # results in the order of items
+    if threads is None:
+        threads = IO_THREADS
+    if threads <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        # waiting with a timeout keeps the main thread responsive to Ctrl-C
+        return pool.map_async(function, items).get(1 << 31)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def _create_folder(temp_folder):
     os.makedirs(temp_folder)
 
 
-def delete_folder(temp_folder):
+def _create_shards(temp_folder, njobs, shard):
+    # the shards are created with the folder, so that jobs do not have to.
+    # shards of earlier waves exist already
+    for i in range(njobs // shard + 1):
+        if not pexists(pjoin(temp_folder, 'shards', str(i))):
+            os.makedirs(pjoin(temp_folder, 'shards', str(i)))
+
+
+def _get_name(name, number, shard=None):
+    # the path of the file name_number relative to the temp folder. folders
+    # without shard, e.g. of older versions, keep all files at the top
+    if shard is None:
+        return name + '_' + str(number)
+    return pjoin('shards', str(number // shard), name + '_' + str(number))
+
+
+def _get_path(temp_folder, name, number, shard=None):
+    return pjoin(temp_folder, _get_name(name, number, shard))
+
+
+def delete_folder(temp_folder, threads=None):
     """ Deletes a PyGrid folder
 
     If the folder exists, it must have a ``is_pygrid`` file to avoid accidental
@@ -53,10 +173,18 @@ def delete_folder(temp_folder):
     ----------
     temp_folder : string
         The temporary folder that was given when the job was submitted first.
+    threads : int, optional
+        The number of files that are deleted at once. Default is None, which
+        uses ``pygrid.file_handling.IO_THREADS``.
     """
     if os.path.exists(temp_folder):
         if os.path.isdir(temp_folder):
             if os.path.exists(os.path.join(temp_folder, 'is_pygrid')):
+                # the files are deleted in parallel, the empty folders by
+                # rmtree
+                _map_io(os.remove, [pjoin(root, name) for root, dirs, files
+                                    in os.walk(temp_folder) for name in
+                                    files], threads)
                 shutil.rmtree(temp_folder)
             else:
                 raise ValueError('`' + temp_folder + '` is not a PyGrid ' +
@@ -66,14 +194,29 @@ def delete_folder(temp_folder):
 
 
 def _write_info(temp_folder, function_name, path, module, cluster_params,
-                njobs):
+                njobs, chunksize=1, **options):
+    # options holds the settings of optional features, e.g. the cache folder
+    info = {'function_name': function_name,
+            'path': path,
+            'module': module,
+            'cluster_params': cluster_params,
+            'chunksize': chunksize,
+            'timestamp': time.time(),
+            'njobs': njobs}
+    info.update(options)
     with open(pjoin(temp_folder, 'info'), 'w') as f:
-        pickle.dump({'function_name': function_name,
-                     'path': path,
-                     'module': module,
-                     'cluster_params': cluster_params,
-                     'timestamp': time.time(),
-                     'njobs': njobs}, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(info, f, pickle.HIGHEST_PROTOCOL)
+
+
+def _set_njobs(temp_folder, njobs):
+    # the number of jobs grows when map writes the args in waves. the info
+    # file is replaced at once, so that running jobs never read half of it
+    info = _get_info(temp_folder)
+    info['njobs'] = njobs
+    filename = pjoin(temp_folder, 'info')
+    with open(filename + '.tmp', 'w') as f:
+        pickle.dump(info, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
 
 
 def _get_info(temp_folder):
@@ -81,72 +224,539 @@ def _get_info(temp_folder):
         return pickle.load(f)
 
 
-def _write_files(temp_folder, args):
-    # find args that are common for every job
+def _get_last_stage(temp_folder):
+    # the folder of the last stage of a pipeline folder, or temp_folder for
+    # folders of a single map
+    info = _get_info(temp_folder)
+    if info.get('kind') != 'pipeline':
+        return temp_folder
+    return pjoin(temp_folder, 'stage_' + str(info['nstages'] - 1))
+
+
+def _write_files(temp_folder, args, value_hashes=None, blobs=None,
+                 append=False):
+    # the values are compared by a hash of their content. the hashes are kept
+    # by the id of the value, so each object is only hashed once. with
+    # append, args is the next wave of jobs and its records are added to the
+    # packed file. blobs holds the blob names of the earlier waves
+    if value_hashes is None:
+        value_hashes = {}
+    if blobs is None:
+        blobs = {}
+    shard = _get_info(temp_folder).get('shard')
+    # the blob files are written together by a pool of threads
+    writes = []
+    hashes = []
+    counts = {}
+    for arg in args:
+        arg_hashes = {}
+        for key, value in arg.items():
+            if id(value) not in value_hashes:
+                value_hashes[id(value)] = _hash_value(value)
+            arg_hashes[key] = value_hashes[id(value)]
+            counts[arg_hashes[key]] = counts.get(arg_hashes[key], 0) + 1
+        hashes.append(arg_hashes)
+
+    # find args that are the same for every job. the args of later waves are
+    # not known yet when they are written in waves
     common_args = {}
-    for key in args[0]:
-        if all(key in arg and id(args[0][key]) == id(arg[key]) for
-                arg in args):
+    for key in ([] if append else args[0]):
+        if all(hashes[0][key] == arg_hashes.get(key) for arg_hashes in hashes):
             common_args[key] = args[0][key]
-    for key in common_args:
-        for arg in args:
-            del arg[key]
 
-    # write common args
+    # write common args. large arrays are written to the blob folder, so
+    # that the jobs can memory map them
     if len(common_args) > 0:
-        _save_data(pjoin(temp_folder, 'common_args'), common_args)
-
-    # write individual args
-    for i, arg in enumerate(args):
-        if len(arg) > 0:
-            _save_data(pjoin(temp_folder, 'args_' + str(i)), arg)
+        stored_args = {}
+        for key, value in common_args.items():
+            if _is_large_array(value):
+                stored_args[_BLOB_PREFIX + key] = _get_blob(
+                    temp_folder, blobs, hashes[0][key], value, writes, shard)
+            else:
+                stored_args[key] = value
+        _save_data(pjoin(temp_folder, 'common_args'), stored_args)
+
+    # values that are shared by some of the jobs are written once to the blob
+    # folder and the jobs only store a reference. small values are cheaper to
+    # store in every job
+    job_args = []
+    for arg, arg_hashes in zip(args, hashes):
+        job_arg = {}
+        for key, value in arg.items():
+            if key in common_args:
+                continue
+            h = arg_hashes[key]
+            if (h in blobs or _is_large_array(value) or
+                    (counts[h] > 1 and _value_size(value) >= _BLOB_MIN_SIZE)):
+                job_arg[_BLOB_PREFIX + key] = _get_blob(temp_folder, blobs, h,
+                                                        value, writes, shard)
+            else:
+                job_arg[key] = value
+        job_args.append(job_arg)
+    args = job_args
+    _map_io(lambda (filename, data): _save_data(filename, data), writes)
+
+    # write individual args into one packed file. the index file holds the
+    # offset of each record, jobs without individual args get an empty record.
+    # the index is written after the records, so jobs only find records that
+    # are complete
+    new = not append or not pexists(pjoin(temp_folder, 'args_index'))
+    offsets = [0] if new else []
+    offset = 0 if new else os.path.getsize(pjoin(temp_folder, 'args'))
+    with open(pjoin(temp_folder, 'args'), 'wb' if new else 'ab') as f:
+        for arg in args:
+            if len(arg) > 0:
+                record = _dumps_data(arg)
+                f.write(record)
+                offset += len(record)
+            offsets.append(offset)
+    with open(pjoin(temp_folder, 'args_index'), 'wb' if new else 'ab') as f:
+        f.write(struct.pack('<%dQ' % len(offsets), *offsets))
 
     # touch is_pygrid file
     open(pjoin(temp_folder, 'is_pygrid'), 'w').close()
 
 
-def get_results(temp_folder):
+def get_results(temp_folder, mmap_mode=None, threads=None):
     """ Returns the job results
 
     Parameters
     ----------
     temp_folder : string
         The temporary folder that was given when the job was submitted first.
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional
+        If not None, results that are a single numpy array are memory mapped
+        with the given mode instead of being read into memory. See
+        ``numpy.load``. Default is None.
+    threads : int, optional
+        The number of results that are read at once. Default is None, which
+        uses ``pygrid.file_handling.IO_THREADS``.
 
     Returns
     -------
     output : list
         A list with the results for each job. Each item in the list corresponds
         to the item in the ``args`` list from input. If the job failed or was
-        not finished, the value will be None.
+        not finished, the value will be None. Use :py:class:`~pygrid.Results`
+        to load the results only when they are accessed.
     """
 
     if not os.path.exists(temp_folder):
         return None
 
+    temp_folder = _get_last_stage(temp_folder)
     info = _get_info(temp_folder)
-    results = []
-    for i in range(info['njobs']):
-        try:
-            results.append(_load_data(pjoin(temp_folder, 'result_' + str(i))))
-        except IOError:
-            results.append(None)
-    return results
+    return _map_io(lambda i: _get_result(temp_folder, i, mmap_mode,
+                                         info.get('shard')),
+                   range(info['njobs']), threads)
+
+
+def _get_result(temp_folder, id, mmap_mode=None, shard=None):
+    try:
+        return _load_data(_get_path(temp_folder, 'result', id, shard),
+                          mmap_mode)
+    except IOError:
+        return None
+
+
+def _list_finished(temp_folder, shard=None):
+    # get jobs for which result files are found
+    if shard is None:
+        folders = [temp_folder]
+    else:
+        folders = [pjoin(temp_folder, 'shards', name) for name in
+                   os.listdir(pjoin(temp_folder, 'shards'))]
+    return [int(f.split('_')[1]) for folder in folders for f in
+            os.listdir(folder) if f.startswith('result_')]
+
+
+def _append_journal(temp_folder, records):
+    # append (id, status, duration) records for jobs that finished or failed
+    # to the journal. the lock keeps records of jobs on different hosts from
+    # mixing on NFS
+    _append_lines(pjoin(temp_folder, 'journal'),
+                  ''.join(['%d %s %.3f\n' % record for record in records]))
+
+
+@contextlib.contextmanager
+def _submit_lock(temp_folder):
+    # keeps processes that watch the same folder from resubmitting the same
+    # jobs at once
+    fd = os.open(pjoin(temp_folder, 'submit.lock'), os.O_RDWR | os.O_CREAT,
+                 0o644)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _append_lines(filename, data):
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def _read_journal(temp_folder, offset=0):
+    # returns the complete records after offset as (id, status, duration, end)
+    # tuples, where end is the offset after the record, and the offset after
+    # the last complete record
+    if not pexists(pjoin(temp_folder, 'journal')):
+        return [], offset
+    with open(pjoin(temp_folder, 'journal'), 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    # a record that is being written has no line break yet
+    data = data[:data.rfind('\n') + 1]
+    records = []
+    for line in data.splitlines(True):
+        offset += len(line)
+        id, status, duration = line.split()
+        records.append((int(id), status, float(duration), offset))
+    return records, offset
+
+
+def _append_metrics(temp_folder, metrics):
+    # append the metrics of a job as one line with the _METRICS_FIELDS
+    values = []
+    for field in _METRICS_FIELDS:
+        value = metrics[field]
+        values.append('%.6f' % value if type(value) == float else str(value))
+    _append_lines(pjoin(temp_folder, 'metrics'), ' '.join(values) + '\n')
+
+
+def _read_metrics(temp_folder):
+    # returns a dict with the metrics of the last run of each job
+    metrics = {}
+    if not pexists(pjoin(temp_folder, 'metrics')):
+        return metrics
+    with open(pjoin(temp_folder, 'metrics'), 'rb') as f:
+        data = f.read()
+    for line in data[:data.rfind('\n') + 1].splitlines():
+        record = dict(zip(_METRICS_FIELDS, line.split()))
+        for field in _METRICS_FIELDS:
+            if field not in ['status', 'host']:
+                record[field] = float(record[field])
+        record['id'] = int(record['id'])
+        metrics[record['id']] = record
+    return metrics
+
+
+def _get_speculated(temp_folder):
+    # the ids of jobs that were submitted a second time because they took
+    # long. the first result of such a job is kept
+    if not pexists(pjoin(temp_folder, 'speculated')):
+        return set()
+    with open(pjoin(temp_folder, 'speculated')) as f:
+        return set(int(id) for id in f.read().split())
+
+
+def _add_speculated(temp_folder, ids):
+    _append_lines(pjoin(temp_folder, 'speculated'),
+                  ''.join([str(id) + '\n' for id in ids]))
+
+
+def _get_pending(temp_folder):
+    # the ids of the jobs that were not submitted yet because their chunksize
+    # is calibrated on the first jobs
+    if not pexists(pjoin(temp_folder, 'pending')):
+        return []
+    with open(pjoin(temp_folder, 'pending')) as f:
+        return [int(id) for id in f.read().split()]
+
+
+def _write_pending(temp_folder, ids):
+    filename = pjoin(temp_folder, 'pending')
+    with open(filename + '.tmp', 'w') as f:
+        f.write(' '.join([str(id) for id in ids]))
+    os.rename(filename + '.tmp', filename)
 
 
-def _get_job_args(temp_folder, id, common_args):
-        if pexists(pjoin(temp_folder, 'args_' + str(id))):
-            return dict(_load_data(pjoin(temp_folder, 'args_' + str(id))),
-                        **common_args)
+# journal offset, finished jobs, last statuses with the offset after their
+# record, start times and durations for each temp folder that was read before
+_journals = {}
+
+
+def _get_journal(temp_folder):
+    # reads the journal from where the last call stopped and returns the state
+    # of the folder. the state must not be changed by the caller. the folder
+    # is listed once per session to recover results without journal record,
+    # e.g. from older versions
+    info = _get_info(temp_folder)
+    key = os.path.abspath(temp_folder)
+    if (key not in _journals or
+            _journals[key]['timestamp'] != info['timestamp']):
+        _journals[key] = {'timestamp': info['timestamp'], 'offset': 0,
+                          'finished': set(_list_finished(
+                              temp_folder, info.get('shard'))),
+                          'statuses': {}, 'starts': {}, 'durations': []}
+    journal = _journals[key]
+    records, journal['offset'] = _read_journal(temp_folder, journal['offset'])
+    for id, status, value, end in records:
+        journal['statuses'][id] = (status, end)
+        if status == 'started':
+            journal['starts'][id] = value
+        elif status == 'ok':
+            journal['finished'].add(id)
+            journal['durations'].append(value)
+    if len(records) > 0:
+        # the durations are mostly sorted already, so this is cheap
+        journal['durations'].sort()
+    return journal
+
+
+def _get_finished(temp_folder):
+    # get jobs that are finished
+    return set(_get_journal(temp_folder)['finished'])
+
+
+def _hash_value(value):
+    # content hash of an argument value. numpy arrays are hashed from their
+    # memory to avoid pickling them
+    if (numpy and isinstance(value, numpy.ndarray) and
+            value.dtype != numpy.object_):
+        h = hashlib.sha1(value.dtype.str + str(value.shape))
+        h.update(numpy.ascontiguousarray(value).data)
+        return h.hexdigest()
+    return hashlib.sha1(pickle.dumps(value,
+                                     pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+
+def _get_cache_key(temp_folder, id):
+    # the cache_keys file holds one 40 character key per line
+    with open(pjoin(temp_folder, 'cache_keys'), 'rb') as f:
+        f.seek(41 * id)
+        return f.read(40)
+
+
+def _cache_path(cache_folder, key):
+    return pjoin(cache_folder, key[:2], key)
+
+
+def _cache_store(cache_folder, key, filename):
+    # add a copy of a result file to the cache. a hard link would share the
+    # data, so that writing to a memory mapped result changes the cache
+    path = _cache_path(cache_folder, key)
+    if not pexists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # created by another job in the meantime
+            pass
+    _copy_file(filename, path)
+
+
+def _copy_file(source, filename):
+    # like _save_data, the copy is written to a hidden temporary file first
+    folder, name = os.path.split(filename)
+    temp_filename = pjoin(folder, '.' + name + '.' + socket.gethostname() +
+                          '.' + str(os.getpid()))
+    shutil.copyfile(source, temp_filename)
+    os.rename(temp_filename, filename)
+
+
+def _value_size(value):
+    if numpy and isinstance(value, numpy.ndarray):
+        return value.nbytes
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _is_large_array(value):
+    return (numpy is not None and isinstance(value, numpy.ndarray) and
+            value.dtype != numpy.object_ and value.nbytes >= _MMAP_MIN_SIZE)
+
+
+def _get_blob(temp_folder, blobs, h, value, writes, shard=None):
+    # returns the name of the blob file for a value. the first time, the file
+    # name and its data are added to writes. large arrays are saved as npy
+    # files, so that they can be memory mapped. with shard, the blobs are
+    # numbered in the order they are found and kept in the shards like the
+    # results, and the name is the path in the folder. folders without shard
+    # keep the blobs in one folder
+    if h not in blobs:
+        if shard is None:
+            name = h
+            folder = pjoin(temp_folder, 'blobs')
         else:
-            return common_args
+            name = _get_name('blob', len(blobs), shard) + '_' + h
+            folder = pjoin(temp_folder, os.path.dirname(name))
+        if not pexists(folder):
+            os.makedirs(folder)
+        if _is_large_array(value):
+            blobs[h] = name + '.npy'
+            writes.append((_get_blob_path(temp_folder, blobs[h]), value))
+        else:
+            blobs[h] = name
+            writes.append((_get_blob_path(temp_folder, blobs[h]),
+                           {'value': value}))
+    return blobs[h]
+
+
+def _get_blob_path(temp_folder, name):
+    if os.path.dirname(name) == '':
+        return pjoin(temp_folder, 'blobs', name)
+    return pjoin(temp_folder, name)
 
 
-def _get_common_args(temp_folder):
-    if pexists(pjoin(temp_folder, 'common_args')):
-        return _load_data(pjoin(temp_folder, 'common_args'))
+def _get_stage_policy(stage):
+    # resolve the stage option of map to a policy dict or None
+    if stage is None or stage is False:
+        return None
+    policy = dict(_STAGE_POLICY)
+    if stage is not True:
+        unknown = set(stage) - set(_STAGE_POLICY)
+        if len(unknown) > 0:
+            raise ValueError('Unknown keys in `stage`: ' +
+                             ', '.join(sorted(unknown)) + '.')
+        policy.update(stage)
+    return policy
+
+
+def _stage_file(source, key, stage):
+    # returns the path of a copy of source in the node-local folder of the
+    # stage policy. the first process on a node copies the file under a lock
+    # while the others wait for it. key has to change with the content of
+    # source. every user has an own folder, which other users can not change
+    folder = pjoin(stage['folder'], 'pygrid_stage_' + str(os.getuid()))
+    filename = pjoin(folder, key)
+    try:
+        # the time of the last use decides which copies are evicted
+        os.utime(filename, None)
+        return filename
+    except OSError:
+        # not copied yet or evicted in the meantime
+        pass
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder, 0o700)
+        except OSError:
+            # created by another process
+            pass
+    fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        copied = not pexists(filename)
+        if copied:
+            shutil.copyfile(source, filename + '.tmp')
+            os.rename(filename + '.tmp', filename)
+    finally:
+        os.close(fd)
+    if copied:
+        _evict_staged(folder, stage, filename)
+    return filename
+
+
+def _load_staged(source, key, stage, load):
+    # loads the node-local copy of source with load. if the copy can not be
+    # made or another process evicted it before it was opened, the shared
+    # file is loaded instead
+    if stage is None:
+        return load(source)
+    try:
+        return load(_stage_file(source, key, stage))
+    except (IOError, OSError):
+        return load(source)
+
+
+def _evict_staged(folder, stage, keep):
+    # removes the copies that were not used for max_age seconds and then the
+    # least recently used ones until at most max_size bytes are left. the
+    # lock files are kept, because other processes may wait for them
+    now = time.time()
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.lock') or name.endswith('.tmp'):
+            continue
+        try:
+            st = os.stat(pjoin(folder, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, pjoin(folder, name)))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if path == keep:
+            continue
+        if now - mtime > stage['max_age'] or total > stage['max_size']:
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def _resolve_blobs(temp_folder, arg, stage=None):
+    # replace blob references in the args of a job with their values. every
+    # job loads its own blobs, so that a job that changes one in place does
+    # not change it for the next jobs of the process. npy blobs are memory
+    # mapped copy-on-write, so that loading them is cheap and jobs on the same
+    # node still share the page cache. the names of the blobs end with their
+    # content hash, so staged copies are shared between folders
+    for key in arg.keys():
+        if key.startswith(_BLOB_PREFIX):
+            name = str(arg.pop(key))
+            if name.endswith('.npy'):
+                load = lambda path: numpy.load(path, mmap_mode='c')
+            else:
+                load = lambda path: _load_data(path)['value']
+            arg[key[len(_BLOB_PREFIX):]] = _load_staged(
+                _get_blob_path(temp_folder, name),
+                os.path.basename(name).split('_')[-1], stage, load)
+    return arg
+
+
+def _get_job_args(temp_folder, id, common_args, stage=None):
+    if pexists(pjoin(temp_folder, 'args_index')):
+        # read the record boundaries and then only this record
+        with open(pjoin(temp_folder, 'args_index'), 'rb') as f:
+            f.seek(8 * id)
+            start, end = struct.unpack('<2Q', f.read(16))
+        if end == start:
+            return common_args
+        with open(pjoin(temp_folder, 'args'), 'rb') as f:
+            f.seek(start)
+            arg = _resolve_blobs(temp_folder,
+                                 _loads_data(f.read(end - start)), stage)
+            return dict(arg, **common_args)
+    elif pexists(pjoin(temp_folder, 'args_' + str(id))):
+        # folders written by older versions have one file per job
+        return dict(_load_data(pjoin(temp_folder, 'args_' + str(id))),
+                    **common_args)
     else:
+        return common_args
+
+
+def _get_args_size(temp_folder, id):
+    # the number of bytes of the stored args of a job without the common args
+    # and shared values
+    if pexists(pjoin(temp_folder, 'args_index')):
+        with open(pjoin(temp_folder, 'args_index'), 'rb') as f:
+            f.seek(8 * id)
+            start, end = struct.unpack('<2Q', f.read(16))
+        return end - start
+    elif pexists(pjoin(temp_folder, 'args_' + str(id))):
+        return os.path.getsize(pjoin(temp_folder, 'args_' + str(id)))
+    return 0
+
+
+def _read_common_args(temp_folder, stage=None, timestamp=None):
+    # the common args with the references to their blobs. with a stage
+    # policy, they are read from a node-local copy. the folder and its
+    # timestamp tell apart the common args of different folders
+    filename = pjoin(temp_folder, 'common_args')
+    if not pexists(filename):
         return {}
+    key = hashlib.sha1(os.path.abspath(temp_folder) + str(timestamp))
+    return _load_staged(filename, key.hexdigest() + '_common_args', stage,
+                        _load_data)
+
+
+def _get_common_args(temp_folder, stage=None, timestamp=None):
+    return _resolve_blobs(temp_folder,
+                          _read_common_args(temp_folder, stage, timestamp),
+                          stage)
 
 
 def get_args(temp_folder):
@@ -165,25 +775,184 @@ def get_args(temp_folder):
 
     info = _get_info(temp_folder)
     common_args = _get_common_args(temp_folder)
+    if not pexists(pjoin(temp_folder, 'args_index')):
+        # folders written by older versions have one file per job
+        return _map_io(lambda i: _get_job_args(temp_folder, i, common_args),
+                       range(info['njobs']))
+
+    # read all records in one pass through the packed file
+    with open(pjoin(temp_folder, 'args_index'), 'rb') as f:
+        index = f.read()
+    offsets = struct.unpack('<%dQ' % (len(index) // 8), index)
     args = []
-    for i in range(info['njobs']):
-        args.append(_get_job_args(temp_folder, i, common_args))
+    with open(pjoin(temp_folder, 'args'), 'rb') as f:
+        for i in range(info['njobs']):
+            record = f.read(offsets[i + 1] - offsets[i])
+            if len(record) > 0:
+                arg = _resolve_blobs(temp_folder, _loads_data(record))
+                args.append(dict(arg, **common_args))
+            else:
+                args.append(common_args)
     return args
 
 
-def _write_job_map(temp_folder, qid, ids):
-    # write file that maps the cluster job tasks to jobs from the args list
-    with open(os.path.join(temp_folder, 'submit_map_' + qid), 'w') as f:
+def _write_job_map(temp_folder, qid, ids, chunksize=1):
+    # write file that maps the cluster job tasks to jobs from the args list.
+    # the second line holds the number of consecutive ids each task runs
+    # the map is only known after the submission, so tasks may already wait
+    # for it. it is renamed into place to never be read half written
+    filename = os.path.join(temp_folder, 'submit_map_' + qid)
+    with open(filename + '.tmp', 'w') as f:
         f.write(' '.join([str(id) for id in ids]))
+        f.write('\n' + str(chunksize))
+    os.rename(filename + '.tmp', filename)
 
 
 def _get_job_map(temp_folder, qid):
-    # write file that maps the cluster job tasks to jobs from the args list
+    # read file that maps the cluster job tasks to jobs from the args list.
+    # returns a list with the job ids for each task
     with open(os.path.join(temp_folder, 'submit_map_' + qid)) as f:
-        return [int(id) for id in f.read().split()]
+        lines = f.read().split('\n')
+    ids = [int(id) for id in lines[0].split()]
+    # folders written by older versions have no chunksize line
+    chunksize = int(lines[1]) if len(lines) > 1 else 1
+    return [ids[i:i + chunksize] for i in range(0, len(ids), chunksize)]
+
+
+def _get_offsets(temp_folder, ntasks):
+    # the size of the journal and of the error logs of tasks 1 to ntasks
+    # before a submission. the journal and the logs of earlier submissions
+    # with the same task ids are appended to, so the sizes tell which records
+    # and output belong to the submission. the logs are only looked at if
+    # there were earlier submissions
+    journal = pjoin(temp_folder, 'journal')
+    journal_size = os.path.getsize(journal) if pexists(journal) else 0
+    log_sizes = {}
+    if len(_get_qids(temp_folder)) > 0:
+        shard = _get_info(temp_folder).get('shard')
+        for task_id in range(1, ntasks + 1):
+            try:
+                log_sizes[task_id] = os.path.getsize(_get_path(
+                    temp_folder, 'log_error', task_id, shard))
+            except OSError:
+                continue
+    return journal_size, log_sizes
+
+
+def _write_submit_offsets(temp_folder, qid, offsets):
+    # write the sizes from _get_offsets. the second line holds task:size
+    # pairs of the logs that existed
+    journal_size, log_sizes = offsets
+    filename = os.path.join(temp_folder, 'submit_offsets_' + qid)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(str(journal_size) + '\n')
+        f.write(' '.join(['%d:%d' % item for item in
+                          sorted(log_sizes.items())]))
+    os.rename(filename + '.tmp', filename)
+
+
+def _get_submit_offsets(temp_folder, qid):
+    # returns the journal size and the log sizes before the submission of
+    # qid. folders written by older versions have no offsets
+    filename = os.path.join(temp_folder, 'submit_offsets_' + qid)
+    if not pexists(filename):
+        return 0, {}
+    with open(filename) as f:
+        lines = f.read().split('\n')
+    log_sizes = dict([int(value) for value in item.split(':')] for item in
+                     lines[1].split())
+    return int(lines[0]), log_sizes
+
+
+def _write_reduce_map(temp_folder, qid, tasks):
+    # write the (inputs, output) file names of each reduction task
+    filename = os.path.join(temp_folder, 'reduce_map_' + qid)
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(tasks, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+
+
+def _get_reduce_map(temp_folder, qid):
+    with open(os.path.join(temp_folder, 'reduce_map_' + qid), 'rb') as f:
+        return pickle.load(f)
+
+
+def _fill_queue(temp_folder, ids):
+    # the work queue has an empty file for each job that is not claimed yet
+    for folder in ['queue', 'claimed']:
+        if not pexists(pjoin(temp_folder, folder)):
+            os.makedirs(pjoin(temp_folder, folder))
+    for id in ids:
+        open(pjoin(temp_folder, 'queue', str(id)), 'w').close()
+
+
+def _list_queue(temp_folder):
+    if not pexists(pjoin(temp_folder, 'queue')):
+        return []
+    return [int(name) for name in os.listdir(pjoin(temp_folder, 'queue'))]
+
+
+def _get_claims(temp_folder):
+    # returns (id, qid, task_id) for all jobs that are claimed by a worker
+    if not pexists(pjoin(temp_folder, 'claimed')):
+        return []
+    claims = []
+    for name in os.listdir(pjoin(temp_folder, 'claimed')):
+        id, qid, task_id = name.split('_')
+        claims.append((int(id), qid, int(task_id)))
+    return claims
+
+
+def _requeue(temp_folder, id, qid, task_id):
+    # return the claim of a worker that is gone to the queue
+    try:
+        os.rename(pjoin(temp_folder, 'claimed', '%d_%s_%s' % (id, qid,
+                                                              task_id)),
+                  pjoin(temp_folder, 'queue', str(id)))
+    except OSError:
+        # the worker finished the job in the meantime
+        pass
+
+
+def _claim_jobs(temp_folder, qid, task_id):
+    # yields job ids from the queue until it is empty. a job is claimed by
+    # renaming its queue file, which succeeds for only one of the workers.
+    # the claim is removed when the next job is requested
+    while True:
+        ids = _list_queue(temp_folder)
+        if len(ids) == 0:
+            # a rename that was reported as failed might still have succeeded
+            # on NFS. return such claims, so that the jobs do not get lost
+            own = [id for id, claim_qid, claim_task_id in
+                   _get_claims(temp_folder) if
+                   (claim_qid, claim_task_id) == (qid, int(task_id))]
+            if len(own) == 0:
+                break
+            for id in own:
+                _requeue(temp_folder, id, qid, task_id)
+            continue
+
+        # try the jobs in random order to avoid collisions with other workers
+        random.shuffle(ids)
+        for id in ids:
+            claim = pjoin(temp_folder, 'claimed', '%d_%s_%s' % (id, qid,
+                                                                task_id))
+            try:
+                os.rename(pjoin(temp_folder, 'queue', str(id)), claim)
+            except OSError:
+                continue
+            yield id
+            try:
+                os.remove(claim)
+            except OSError:
+                # the claim was returned to the queue by get_progress
+                pass
 
 
 def _get_qids(temp_folder):
+    # the qids file does not exist if no job was submitted to the cluster
+    if not pexists(pjoin(temp_folder, 'qids')):
+        return []
     with open(os.path.join(temp_folder, 'qids')) as f:
         return f.read().split()
 
@@ -207,6 +976,9 @@ def delete_all_folders(root):
         if 'is_pygrid' in files:
             info = _get_info(folder)
             folders.append((folder, info['timestamp']))
+            # the files of the jobs and the stages of a pipeline are not
+            # searched
+            dirs[:] = []
     folders.sort(key=lambda (folder, timestamp): timestamp)
 
     delete = []
@@ -4,29 +4,51 @@
 # License: BSD
 
 import os
+import time
 import inspect
 
 from .file_handling import get_results, _write_files, _write_info, _get_info
 from .file_handling import delete_folder, _create_folder
-from .progress import get_progress, _disp_progress
-from .run import _submit_jobs, _simulate_jobs
+from .progress import get_progress, _disp_progress, _iter_results
+from .run import _submit_jobs, _simulate_jobs, _check_chunksize, _wait_local
+from .run import _get_adaptive_policy, _get_wave_policy
+from .file_handling import _write_pending, _get_finished, _get_name
+from .file_handling import _create_shards, _SHARD_SIZE, _get_stage_policy
+from .file_handling import _set_njobs, _get_pending, _submit_lock
+from .cache import _get_cache_folder, _get_job_keys, _write_cache_keys
+from .cache import _get_cached
+from .backends import _get_backend
+from .snapshot import _write_snapshot
+from .retry import _get_retry_policy
+from .speculation import _get_speculate_policy
+from .reduce import _get_reduced, _combine
+
+# the number of seconds between progress checks while a wave waits for the
+# jobs of earlier waves
+_WAVE_POLL_INTERVAL = 5
 
 
 def map(function, args, temp_folder='temp_pygrid', use_cluster=True,
-        cluster_params=None, interactive=True, nest=False):
+        cluster_params=None, interactive=True, nest=False, chunksize=1,
+        max_workers=None, on_result=None, cache=None, workers=None,
+        backend='sge', profile=False, snapshot=False, retry=None,
+        speculate=None, stage=None, waves=None):
     """ Submits jobs to gridengine and returns results
 
     Parameters
     ----------
     function :  callable
         The function that gets run with different input parameters.
-    args : list
+    args : list or iterable
         A list of dictionaries where each dictionary in the list is for one
         function call. The dictionary keys must match the function parameters.
+        Any other iterable, e.g. a generator, is written and submitted in
+        waves, see ``waves``.
 
         If the function has default parameters, the values do not have to be
-        provided in args. PyGrid will check if any parameter values are the
-        same for all function calls and save them only once.
+        provided in args. PyGrid compares the parameter values by content and
+        saves values that are the same for several function calls only once.
+        The dictionaries in ``args`` are not changed.
 
         If an argument value is a numpy array, saving and loading is efficient
         (with numpy.savez and numpy.load).
@@ -38,9 +60,9 @@ def map(function, args, temp_folder='temp_pygrid', use_cluster=True,
         will ask before overwriting or reusing a folder. The folder is not
         deleted by default. Default is ``'temp_pygrid'``.
     use_cluster : bool, optional
-        If set to false, the run will be simulated to make debugging easier.
-        That means that all computations are done in serial in the current
-        session. Default is True.
+        If set to false, the jobs are run on the local machine instead of the
+        cluster. This is useful for debugging and for machines with many
+        cores. Default is True.
     cluster_params : list, optional
         A list of strings with additional parameters to use when submitting the
         job. E.g. ``['-l h_vmem=10G']`` to set a limit of 10Gb per job. Default
@@ -52,6 +74,106 @@ def map(function, args, temp_folder='temp_pygrid', use_cluster=True,
         Allows to nest PyGrid jobs when set to True. Otherwise an exception is
         thrown when pygrid.map gets called inside a PyGrid job. Default is
         False.
+    chunksize : int, 'auto', 'adaptive' or dict, optional
+        The number of jobs that are run one after another in a single cluster
+        task. Larger values avoid scheduler and interpreter startup overhead
+        for many short jobs. With ``'auto'``, the jobs are packed into at most
+        1000 tasks. With ``'adaptive'``, 10 jobs are submitted first to
+        measure their runtime. The other jobs are submitted in waves by
+        :py:meth:`~pygrid.get_progress` whenever no task is waiting in the
+        queue, packed so that a task runs for about 10 minutes according to
+        the jobs that finished so far. A dict like ``{'target': 300,
+        'calibration': 20}`` sets the target runtime in seconds and the number
+        of first jobs. Progress and results are still reported per job.
+        Default is 1.
+    max_workers : int, optional
+        The number of worker processes that run the jobs in parallel when
+        ``use_cluster`` is False. Default is None, which uses one worker per
+        CPU core.
+    on_result : callable, optional
+        A function that gets called as ``on_result(index, result)`` for every
+        finished job as soon as its result is available, where ``index`` is
+        the position of the job in ``args``. It is not called for failed jobs
+        and not called when ``interactive`` is False and the jobs run on the
+        cluster. Default is None.
+    cache : bool or string, optional
+        If set, results are kept in a cache folder that is shared between
+        runs. Jobs whose function source and arguments match a cached result
+        are not submitted again. With True, the folder ``~/.pygrid_cache`` is
+        used, a string gives another folder. Use the functions in
+        ``pygrid.cache`` to delete old results. Default is None.
+    workers : int, optional
+        If set, this number of long-running cluster tasks is submitted
+        instead of one task per job. Each task takes jobs from a queue in
+        ``temp_folder`` until the queue is empty, which balances the load if
+        the runtimes of the jobs differ a lot. If a task dies, its current
+        job is put back into the queue. ``chunksize`` is ignored. Default is
+        None.
+    backend : string, optional
+        The name of the scheduler backend that submits, monitors and cancels
+        the jobs: ``'sge'`` for gridengine, ``'slurm'``, ``'local'`` to run
+        the tasks as processes on this machine, or ``'fake'`` to simulate a
+        scheduler with queue delays and failures. See ``pygrid.backends``.
+        Default is ``'sge'``.
+    profile : bool, optional
+        If set to True, every job is run with cProfile and the statistics are
+        saved to the file ``profile_<index>`` in ``temp_folder``. Load them
+        with the ``pstats`` module. Timing and memory metrics are recorded for
+        all jobs, see :py:meth:`~pygrid.get_stats`. Default is False.
+    snapshot : bool, optional
+        If set to True, the bytecode of ``function`` and of the functions of
+        its module that it calls is saved together with the other global
+        values it uses. The jobs copy this snapshot to the node-local folder
+        of ``stage``, also if ``stage`` is not set, and do not import the
+        module of ``function``, so code at the top level of the module is
+        not run by every job. Modules that are imported from the folder of
+        the calling file are included in the snapshot. If ``function`` uses
+        classes of its module or values that can not be pickled, the module
+        is still imported. Default is False.
+    retry : bool or dict, optional
+        If set, failed jobs are resubmitted automatically whenever the
+        progress is checked, e.g. by the progress display or
+        :py:meth:`~pygrid.get_progress`. The reason of a failure is found
+        in the error logs and the scheduler accounting, see
+        :py:meth:`~pygrid.get_failures`. With True, jobs that ran out of
+        memory or time are resubmitted with twice the memory or runtime limit
+        in ``cluster_params``, jobs that failed because of their node or
+        for an unknown reason are resubmitted unchanged and jobs that raised
+        an exception are not resubmitted. Every job is run at most 3 times. A
+        dict changes this policy: its keys are ``'memory'``, ``'timeout'``,
+        ``'node'``, ``'unknown'`` and ``'exception'`` with the factor for the
+        limit, True to resubmit unchanged or False to not resubmit, and
+        ``'max_attempts'``. Default is None.
+    speculate : bool or dict, optional
+        If set, jobs that run much longer than the others are submitted a
+        second time when the progress is checked, so that a slow or
+        overloaded node does not hold up the last jobs. The result of the
+        copy that finishes first is kept and the task of the other one is
+        cancelled. With True, a job is copied once 90% of the jobs are
+        finished, if it runs three times longer than the median of the
+        finished jobs and at least 60 seconds. A dict with the keys
+        ``'min_finished'``, ``'factor'`` and ``'min_time'`` changes these
+        values. Ignored with ``workers``. Default is None.
+    stage : bool or dict, optional
+        If set, the first task on each node copies the arguments that are
+        shared by the jobs to a node-local folder, and the other tasks on the
+        node read the copy instead of the temp folder. With True, the copies
+        are kept in ``/tmp/pygrid_stage_<uid>``, copies that were not used
+        for a day are removed, and the least recently used ones when the
+        copies take more than 10GB. A dict with the keys ``'folder'``,
+        ``'max_age'`` in seconds and ``'max_size'`` in bytes changes these
+        values. Use a node-local folder that is kept between tasks, not the
+        ``$TMPDIR`` that gridengine gives each task. Default is None.
+    waves : bool or dict, optional
+        If set, ``args`` is written and submitted in waves of 1000 jobs, so
+        that only one wave is kept in memory and the first jobs start before
+        the last args are known. A wave waits until it fits into 10000 jobs
+        that are queued or running, or locally until the earlier wave is
+        done. A dict with the keys ``'size'`` and ``'max_in_flight'``
+        changes these values. Args that are the same for all jobs are not
+        stored separately. The jobs keep the index of their args. Used with
+        True if ``args`` is not a list. Can not be used with ``workers``.
+        Default is None.
 
     Returns
     -------
@@ -65,6 +187,252 @@ def map(function, args, temp_folder='temp_pygrid', use_cluster=True,
     See examples directory.
     """
 
+    call_file = os.path.abspath(inspect.stack()[1][1])
+    if on_result is not None and not hasattr(on_result, '__call__'):
+        raise ValueError('`on_result` has to be callable.')
+    local = _start(function, args, temp_folder, use_cluster, cluster_params,
+                   nest, chunksize, max_workers, cache, workers, backend,
+                   profile, snapshot, retry, speculate, stage, waves,
+                   None, call_file)
+
+    if not use_cluster:
+        if on_result is not None:
+            for id, result in _iter_results(temp_folder, ordered=False,
+                                            failed=False, local=local):
+                on_result(id, result)
+        else:
+            _wait_local(local)
+        return get_results(temp_folder)
+    elif interactive:
+        _disp_progress(temp_folder, on_result)
+        return get_results(temp_folder)
+    else:
+        return None
+
+
+def imap(function, args, temp_folder='temp_pygrid', use_cluster=True,
+         cluster_params=None, nest=False, chunksize=1, max_workers=None,
+         cache=None, workers=None, backend='sge', profile=False,
+         snapshot=False, retry=None, speculate=None, stage=None, waves=None,
+         poll_interval=1):
+    """ Submits jobs to gridengine and iterates over the results
+
+    The jobs are submitted when ``imap`` is called. The returned iterator
+    waits for the result files of the jobs and loads each result only when it
+    is its turn, so the results do not have to fit into memory at once.
+
+    Parameters
+    ----------
+    function :  callable
+        The function that gets run with different input parameters.
+    args : list or iterable
+        A list of dictionaries where each dictionary in the list is for one
+        function call. See :py:meth:`~pygrid.map`.
+    temp_folder : string, optional
+        A path to a folder where PyGrid will save the temporary files. Default
+        is ``'temp_pygrid'``.
+    use_cluster : bool, optional
+        If set to false, the jobs are run on the local machine. Default is
+        True.
+    cluster_params : list, optional
+        A list of strings with additional parameters to use when submitting the
+        job. Default is None.
+    nest : bool, optional
+        Allows to nest PyGrid jobs when set to True. Default is False.
+    chunksize : int, 'auto', 'adaptive' or dict, optional
+        The number of jobs that are run in a single cluster task. See
+        :py:meth:`~pygrid.map`. Default is 1.
+    max_workers : int, optional
+        The number of local worker processes when ``use_cluster`` is False.
+        Default is None, which uses one worker per CPU core.
+    cache : bool or string, optional
+        The result cache folder. See :py:meth:`~pygrid.map`. Default is None.
+    workers : int, optional
+        The number of long-running cluster tasks that take jobs from a queue.
+        See :py:meth:`~pygrid.map`. Default is None.
+    backend : string, optional
+        The name of the scheduler backend. See :py:meth:`~pygrid.map`.
+        Default is ``'sge'``.
+    profile : bool, optional
+        If set to True, every job is run with cProfile. See
+        :py:meth:`~pygrid.map`. Default is False.
+    snapshot : bool, optional
+        If set to True, the jobs load ``function`` from a snapshot instead of
+        importing its module. See :py:meth:`~pygrid.map`. Default is False.
+    retry : bool or dict, optional
+        The policy to resubmit failed jobs automatically. See
+        :py:meth:`~pygrid.map`. Default is None.
+    speculate : bool or dict, optional
+        The policy to submit slow jobs a second time. See
+        :py:meth:`~pygrid.map`. Default is None.
+    stage : bool or dict, optional
+        The policy to copy shared arguments to the nodes. See
+        :py:meth:`~pygrid.map`. Default is None.
+    waves : bool or dict, optional
+        The policy to write and submit ``args`` in waves. See
+        :py:meth:`~pygrid.map`. Default is None.
+    poll_interval : float, optional
+        The number of seconds to wait between checks for new results. Default
+        is 1.
+
+    Returns
+    -------
+    results : iterator
+        An iterator over ``(index, result)`` tuples in the order of ``args``.
+        ``index`` is the position of the job in ``args``. If a job failed, its
+        result is None.
+    """
+    call_file = os.path.abspath(inspect.stack()[1][1])
+    local = _start(function, args, temp_folder, use_cluster, cluster_params,
+                   nest, chunksize, max_workers, cache, workers, backend,
+                   profile, snapshot, retry, speculate, stage, waves,
+                   None, call_file)
+    return _iter_results(temp_folder, ordered=True, local=local,
+                         poll_interval=poll_interval)
+
+
+def imap_unordered(function, args, temp_folder='temp_pygrid',
+                   use_cluster=True, cluster_params=None, nest=False,
+                   chunksize=1, max_workers=None, cache=None, workers=None,
+                   backend='sge', profile=False, snapshot=False, retry=None,
+                   speculate=None, stage=None, waves=None,
+                   poll_interval=1):
+    """ Submits jobs to gridengine and iterates over the results as they come
+
+    Same as :py:meth:`~pygrid.imap`, but the ``(index, result)`` tuples are
+    returned as soon as a job is finished, regardless of the order of
+    ``args``. The results of failed jobs are returned as None at the end.
+    """
+    call_file = os.path.abspath(inspect.stack()[1][1])
+    local = _start(function, args, temp_folder, use_cluster, cluster_params,
+                   nest, chunksize, max_workers, cache, workers, backend,
+                   profile, snapshot, retry, speculate, stage, waves,
+                   None, call_file)
+    return _iter_results(temp_folder, ordered=False, local=local,
+                         poll_interval=poll_interval)
+
+
+def map_reduce(function, args, reducer, temp_folder='temp_pygrid',
+               use_cluster=True, cluster_params=None, interactive=True,
+               nest=False, chunksize=1, max_workers=None, fanin=16,
+               cache=None, workers=None, backend='sge', profile=False,
+               snapshot=False, retry=None, speculate=None, stage=None,
+               waves=None, poll_interval=2):
+    """ Submits jobs to gridengine and reduces their results on the cluster
+
+    The results are combined by reduction tasks on the cluster as they
+    arrive, so only the final value is read by this machine. Each reduction
+    task combines ``fanin`` results or values of earlier reduction tasks into
+    one value, until a single value is left. Use
+    :py:meth:`~pygrid.get_reduced` to get the value later or to reduce the
+    results that arrived so far.
+
+    Parameters
+    ----------
+    function :  callable
+        The function that gets run with different input parameters.
+    args : list or iterable
+        A list of dictionaries where each dictionary in the list is for one
+        function call. See :py:meth:`~pygrid.map`.
+    reducer : callable
+        A function that combines two values into one, e.g. the sum of two
+        arrays. The results are combined in no particular order, so
+        ``reducer(a, b)`` has to be associative and commutative. It is
+        imported by the reduction tasks from its module, like ``function``.
+    temp_folder : string, optional
+        A path to a folder where PyGrid will save the temporary files. Default
+        is ``'temp_pygrid'``.
+    use_cluster : bool, optional
+        If set to false, the jobs are run on the local machine and the results
+        are reduced by this process. Default is True.
+    cluster_params : list, optional
+        A list of strings with additional parameters to use when submitting the
+        jobs and the reduction tasks. Default is None.
+    interactive : bool, optional
+        When set to False, there will be no progress information printed and
+        ``None`` will be returned without waiting for the jobs. The reduction
+        tasks are submitted when the progress is checked, e.g. by
+        :py:meth:`~pygrid.get_reduced`. Default is True.
+    nest : bool, optional
+        Allows to nest PyGrid jobs when set to True. Default is False.
+    chunksize : int, 'auto', 'adaptive' or dict, optional
+        The number of jobs that are run in a single cluster task. See
+        :py:meth:`~pygrid.map`. Default is 1.
+    max_workers : int, optional
+        The number of local worker processes when ``use_cluster`` is False.
+        Default is None, which uses one worker per CPU core.
+    fanin : int, optional
+        The number of values that a reduction task combines. Default is 16.
+    cache : bool or string, optional
+        The result cache folder. See :py:meth:`~pygrid.map`. Default is None.
+    workers : int, optional
+        The number of long-running cluster tasks that take jobs from a queue.
+        See :py:meth:`~pygrid.map`. Default is None.
+    backend : string, optional
+        The name of the scheduler backend. See :py:meth:`~pygrid.map`.
+        Default is ``'sge'``.
+    profile : bool, optional
+        If set to True, every job is run with cProfile. See
+        :py:meth:`~pygrid.map`. Default is False.
+    snapshot : bool, optional
+        If set to True, the jobs load ``function`` from a snapshot instead of
+        importing its module. See :py:meth:`~pygrid.map`. Default is False.
+    retry : bool or dict, optional
+        The policy to resubmit failed jobs automatically. See
+        :py:meth:`~pygrid.map`. Default is None.
+    speculate : bool or dict, optional
+        The policy to submit slow jobs a second time. See
+        :py:meth:`~pygrid.map`. Default is None.
+    stage : bool or dict, optional
+        The policy to copy shared arguments to the nodes. See
+        :py:meth:`~pygrid.map`. Default is None.
+    waves : bool or dict, optional
+        The policy to write and submit ``args`` in waves. See
+        :py:meth:`~pygrid.map`. Default is None.
+    poll_interval : float, optional
+        The number of seconds to wait between checks for the reduction
+        tasks after the jobs are done. Default is 2.
+
+    Returns
+    -------
+    output : object
+        The reduction of the results of all jobs that did not fail, or None if
+        no job finished or ``interactive`` is False.
+    """
+    call_file = os.path.abspath(inspect.stack()[1][1])
+    if not hasattr(reducer, '__call__'):
+        raise ValueError('`reducer` has to be callable.')
+    if type(fanin) != int or fanin < 2:
+        raise ValueError('`fanin` must be an integer of at least 2.')
+    local = _start(function, args, temp_folder, use_cluster, cluster_params,
+                   nest, chunksize, max_workers, cache, workers, backend,
+                   profile, snapshot, retry, speculate, stage, waves,
+                   (reducer, fanin), call_file)
+
+    if not use_cluster:
+        _wait_local(local)
+        shard = _get_info(temp_folder).get('shard')
+        names = [_get_name('result', id, shard) for id in
+                 sorted(_get_finished(temp_folder))]
+        return _combine(temp_folder, reducer, names) if names else None
+    elif interactive:
+        _disp_progress(temp_folder)
+        # the last reduction tasks run after the jobs are done
+        while os.path.exists(temp_folder):
+            done, value = _get_reduced(temp_folder)
+            if done:
+                return value
+            time.sleep(poll_interval)
+    return None
+
+
+def _start(function, args, temp_folder, use_cluster, cluster_params, nest,
+           chunksize, max_workers, cache, workers, backend, profile,
+           snapshot, retry, speculate, stage, waves, reduction, call_file):
+    # checks the input, writes the temp folder and submits the jobs. returns
+    # the AsyncResult of the local workers when the jobs are run locally.
+    # reduction is None or the (reducer, fanin) of map_reduce
+
     # test if pygrid map is called inside a pygrid map instance
     if not nest and os.environ.get('PYGRID') == 1:
         raise Exception('PyGrid called itself inside a PyGrid instance. ' +
@@ -73,74 +441,201 @@ def map(function, args, temp_folder='temp_pygrid', use_cluster=True,
     # input tests
     if not hasattr(function, '__call__'):
         raise ValueError('`function` has to be callable.')
-    if not os.path.exists(os.path.abspath(inspect.stack()[1][1])):
-        #raise Exception('Can not find the file from which `map` was called.')
-        pass
-    if not type(args) == list and all(type(arg) == dict for arg in args):
+    if not hasattr(args, '__iter__') or (type(args) == list and not all(
+            type(arg) == dict for arg in args)):
         raise ValueError('`args` has to be a list of dicts.')
-    if cluster_params is None:
-        cluster_params = []
-    elif type(cluster_params) == str:
-        cluster_params = [cluster_params]
-    elif not hasattr(cluster_params, '__iter__'):
-        # TODO: do more testing here
-        raise ValueError('`cluster_params` must be a list of parameters')
+    waves = _get_wave_policy(waves, args)
+    cluster_params = _get_cluster_params(cluster_params)
+    _check_chunksize(chunksize)
+    if _get_adaptive_policy(chunksize) is not None:
+        chunksize = _get_adaptive_policy(chunksize)
+    if workers is not None and (type(workers) != int or workers < 1):
+        raise ValueError('`workers` must be a positive integer.')
+    _get_backend(backend)
+    retry = _get_retry_policy(retry)
+    speculate = _get_speculate_policy(speculate)
+    stage = _get_stage_policy(stage)
+    if not use_cluster:
+        workers = None
+    if waves is not None and workers is not None:
+        raise ValueError('`waves` can not be used with `workers`.')
+
+    if _check_temp_folder(temp_folder, None):
+        return _write_and_submit(function, args, temp_folder, use_cluster,
+                                 cluster_params, chunksize, max_workers, cache,
+                                 workers, backend, profile, snapshot,
+                                 retry, speculate, stage, waves, reduction,
+                                 call_file)
+    return None
+
 
-    # handle existing temp_folder
+def _check_temp_folder(temp_folder, kind):
+    # returns if the files of temp_folder have to be written. an existing
+    # folder is deleted or continued after asking. kind is 'pipeline' for
+    # pipeline folders and None for map folders
     if os.path.exists(temp_folder):
         a = raw_input('Path `' + os.path.abspath(temp_folder) +
                       '` exists. Delete? y/[n]: ')
         if len(a) > 0 and a[0].lower() == 'y':
             delete_folder(temp_folder)
-            write = True
+            return True
         elif os.path.exists(os.path.join(temp_folder, 'is_pygrid')):
+            if _get_info(temp_folder).get('kind') != kind:
+                raise ValueError('Can not continue with temp_folder `' +
+                                 temp_folder + '`, it was written by ' +
+                                 ('pipeline.' if kind is None else 'map.'))
             print('Path is pygrid folder, continuing.')
-            write = False
+            return False
         else:
             raise ValueError('Can not continue with temp_folder `' +
                              temp_folder + '`.')
-    else:
-        write = True
-
-    if write:
-        _create_folder(temp_folder)
-        _write_files(temp_folder, args)
-        function_name = function.__name__
-        call_file = os.path.abspath(inspect.stack()[1][1])
-        # check if we can find the function file. the function might have been
-        # defined in an ipython instance
-        if not os.path.exists(call_file):
-            print('Warning: Can not find the file from which `map` was called. '
-                  'Trying to eval function source.')
-            path = os.path.abspath(temp_folder)
-            module = 'function'
-            with open(os.path.join(temp_folder, 'function.py'), 'w') as f:
-                f.write(inspect.getsource(function))
-        else:
-            module = function.__module__
-            if module == '__main__':
-                module = os.path.splitext(os.path.split(call_file)[1])[0]
-            path = os.path.split(call_file)[0]
-        _write_info(temp_folder, function_name, path, module, cluster_params,
-                    len(args))
-
-        if use_cluster:
-            res = _submit_jobs(temp_folder, range(len(args)), cluster_params)
-            if res is not True:
-                raise Exception('Could not submit job: ' + res)
-        else:
-            _simulate_jobs(temp_folder, range(len(args)))
+    return True
 
-    if not use_cluster:
-        return get_results(temp_folder)
-    elif interactive:
-        _disp_progress(temp_folder)
-        return get_results(temp_folder)
+
+def _get_cluster_params(cluster_params):
+    if cluster_params is None:
+        return []
+    elif type(cluster_params) == str:
+        return [cluster_params]
+    elif not hasattr(cluster_params, '__iter__'):
+        # TODO: do more testing here
+        raise ValueError('`cluster_params` must be a list of parameters')
+    return cluster_params
+
+
+def _write_and_submit(function, args, temp_folder, use_cluster,
+                      cluster_params, chunksize, max_workers, cache, workers,
+                      backend, profile, snapshot, retry, speculate, stage,
+                      waves, reduction, call_file, hold=None, inputs=None):
+    # writes the files of a new temp folder and submits the jobs. returns the
+    # AsyncResult of the local workers when the jobs are run locally. with a
+    # wave policy, the args are written and submitted in waves. hold and
+    # inputs are set for the later stages of a pipeline
+    _create_folder(temp_folder)
+    function_name = function.__name__
+    # check if we can find the function file. the function might have been
+    # defined in an ipython instance
+    if not os.path.exists(call_file):
+        print('Warning: Can not find the file from which `map` was called. '
+              'Trying to eval function source.')
+        path = os.path.abspath(temp_folder)
+        module = 'function'
+        with open(os.path.join(temp_folder, 'function.py'), 'w') as f:
+            f.write(inspect.getsource(function))
     else:
+        module = function.__module__
+        if module == '__main__':
+            module = os.path.splitext(os.path.split(call_file)[1])[0]
+        path = os.path.split(call_file)[0]
+    # the reducer is imported by the reduction tasks like the function.
+    # local runs are reduced by map_reduce itself
+    reduce_info = None
+    if reduction is not None and use_cluster:
+        reducer, fanin = reduction
+        reducer_module = reducer.__module__
+        if reducer_module == '__main__':
+            reducer_module = os.path.splitext(os.path.split(call_file)[1])[0]
+        reduce_info = {'function_name': reducer.__name__,
+                       'module': reducer_module, 'fanin': fanin}
+    cache_folder = _get_cache_folder(cache)
+    _write_info(temp_folder, function_name, path, module, cluster_params,
+                len(args) if waves is None else 0, chunksize,
+                cache=cache_folder, workers=workers, backend=backend,
+                profile=profile, snapshot=snapshot, retry=retry,
+                speculate=speculate, stage=stage, waves=waves,
+                reduce=reduce_info, inputs=inputs, shard=_SHARD_SIZE)
+    if snapshot:
+        _write_snapshot(temp_folder, function, module, path)
+
+    local = None
+    njobs = 0
+    blobs = {}
+    for wave in [args] if waves is None else _iter_waves(args, waves['size']):
+        if waves is not None:
+            if not all(type(arg) == dict for arg in wave):
+                raise ValueError('`args` has to be an iterable of dicts.')
+            local = _wait_for_wave(temp_folder, waves, len(wave), local)
+        # the content hashes of the values are used for the cache keys and
+        # to find values that are shared between jobs. the ids of the values
+        # are only unique while the wave is kept
+        value_hashes = {}
+        if cache_folder is not None:
+            keys = _get_job_keys(function, wave, value_hashes)
+        _write_files(temp_folder, wave, value_hashes, blobs,
+                     append=waves is not None)
+        ids = range(njobs, njobs + len(wave))
+        njobs += len(wave)
+        _create_shards(temp_folder, njobs, _SHARD_SIZE)
+        if waves is not None:
+            _set_njobs(temp_folder, njobs)
+
+        # jobs with cached results are not submitted
+        if cache_folder is not None:
+            _write_cache_keys(temp_folder, keys, append=ids[0] > 0)
+            ids = _get_cached(temp_folder, cache_folder, keys, ids[0])
+            print('Found ' + str(len(wave) - len(ids)) + ' of ' +
+                  str(len(wave)) + ' results in the cache.')
+        local = _submit_wave(temp_folder, ids, use_cluster, cluster_params,
+                             chunksize, max_workers, workers, hold)
+    return local
+
+
+def _iter_waves(args, size):
+    # yields lists of the next size args. only one wave is kept in memory
+    wave = []
+    for arg in args:
+        wave.append(arg)
+        if len(wave) == size:
+            yield wave
+            wave = []
+    if len(wave) > 0:
+        yield wave
+
+
+def _wait_for_wave(temp_folder, waves, size, local):
+    # waits until the next wave of size jobs fits into max_in_flight. local
+    # waves run one after another. checking the progress also resubmits
+    # failed jobs and submits the held back jobs of an adaptive chunksize
+    if local is not None:
+        _wait_local(local)
+        return None
+    if not os.path.exists(os.path.join(temp_folder, 'qids')):
+        return None
+    while True:
+        jobs = get_progress(temp_folder)
+        in_flight = len(jobs['running']) + len(jobs['waiting'])
+        if in_flight == 0 or in_flight + size <= waves['max_in_flight']:
+            return None
+        time.sleep(_WAVE_POLL_INTERVAL)
+
+
+def _submit_wave(temp_folder, ids, use_cluster, cluster_params, chunksize,
+                 max_workers, workers, hold=None):
+    # submits the jobs of a wave or runs them locally. returns the
+    # AsyncResult of the local workers
+    if len(ids) == 0:
         return None
+    if not use_cluster:
+        return _simulate_jobs(temp_folder, ids, chunksize, max_workers,
+                              wait=False)
+    policy = _get_adaptive_policy(chunksize)
+    if policy is not None and workers is None:
+        # the first jobs calibrate the chunksize, get_progress submits
+        # the others
+        with _submit_lock(temp_folder):
+            pending = _get_pending(temp_folder)
+            if os.path.exists(os.path.join(temp_folder, 'qids')):
+                _write_pending(temp_folder, pending + ids)
+                return None
+            _write_pending(temp_folder, ids[policy['calibration']:])
+        ids = ids[:policy['calibration']]
+    res = _submit_jobs(temp_folder, ids, cluster_params, chunksize, hold)
+    if res is not True:
+        raise Exception('Could not submit job: ' + res)
+    return None
 
 
-def restart(temp_folder, cluster_params=None):
+def restart(temp_folder, cluster_params=None, chunksize=None):
     """ Restarts all failed jobs.
 
     Parameters
@@ -151,10 +646,20 @@ def restart(temp_folder, cluster_params=None):
         A list of strings with new parameters to use when submitting the
         job. E.g. ``['-l h_vmem=10G']`` to set a limit of 10Gb per job. Default
         is None.
+    chunksize : int, 'auto', 'adaptive' or dict, optional
+        The number of failed jobs to run in a single cluster task. See
+        :py:meth:`~pygrid.map`. Default is None, which uses the chunksize the
+        jobs were submitted with.
     """
     jobs = get_progress(temp_folder)
+    info = _get_info(temp_folder)
     if cluster_params is None:
-        params = _get_info(temp_folder)['cluster_params']
-    res = _submit_jobs(temp_folder, jobs['failed'], params)
+        params = info['cluster_params']
+    else:
+        params = cluster_params
+    if chunksize is None:
+        chunksize = info.get('chunksize', 1)
+    _check_chunksize(chunksize)
+    res = _submit_jobs(temp_folder, jobs['failed'], params, chunksize)
     if res is not True:
         raise Exception('Could not submit job: ' + res)
@@ -0,0 +1,152 @@
+""" Implements pipelines of pygrid maps whose jobs depend on each other """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+from os.path import join as pjoin
+import inspect
+
+from .file_handling import get_results, _get_qids, _write_info, _SHARD_SIZE
+from .map import _write_and_submit, _check_temp_folder, _get_cluster_params
+from .progress import _disp_progress
+from .run import _check_chunksize, _get_adaptive_policy, _wait_local
+from .backends import _get_backend
+
+
+def pipeline(functions, args, temp_folder='temp_pygrid', use_cluster=True,
+             cluster_params=None, interactive=True, nest=False, chunksize=1,
+             max_workers=None, backend='sge'):
+    """ Submits a chain of maps where each job uses one result of the last
+
+    The first function is run with ``args`` as with :py:meth:`~pygrid.map`.
+    Every other function is run once for each job of the function before it,
+    with the result of that job as its first parameter. All stages are
+    submitted at once, and each task of a stage waits only for the task with
+    the same jobs of the stage before it, e.g. with ``-hold_jid_ad`` on
+    gridengine. So a job of the last stage can finish while other jobs of the
+    first stage are still running. If a job fails, the jobs that depend on it
+    fail as well.
+
+    Parameters
+    ----------
+    functions : list
+        The functions of the stages in the order they are run. All functions
+        but the first need a first parameter for the result, their other
+        parameters use their default values.
+    args : list
+        A list of dictionaries with the arguments of the first function for
+        each job. See :py:meth:`~pygrid.map`.
+    temp_folder : string, optional
+        A path to a folder where PyGrid will save the temporary files. Each
+        stage is a PyGrid folder ``stage_<index>`` in it, e.g. use
+        :py:meth:`~pygrid.get_progress` or :py:meth:`~pygrid.get_results` with
+        ``temp_pygrid/stage_0`` for the first stage. With ``temp_folder``
+        itself, they return the progress and results of the last stage.
+        Default is ``'temp_pygrid'``.
+    use_cluster : bool, optional
+        If set to false, the stages are run one after another on the local
+        machine. Default is True.
+    cluster_params : list, optional
+        A list of strings with additional parameters to use when submitting
+        the jobs of all stages. Default is None.
+    interactive : bool, optional
+        When set to False, there will be no progress information printed and
+        ``None`` will be returned without waiting for results. The progress
+        display shows the last stage. Default is True.
+    nest : bool, optional
+        Allows to nest PyGrid jobs when set to True. Default is False.
+    chunksize : int or 'auto', optional
+        The number of jobs that are run in a single cluster task. It is the
+        same for all stages, so that their tasks run the same jobs. See
+        :py:meth:`~pygrid.map`. Default is 1.
+    max_workers : int, optional
+        The number of local worker processes when ``use_cluster`` is False.
+        Default is None, which uses one worker per CPU core.
+    backend : string, optional
+        The name of the scheduler backend. See :py:meth:`~pygrid.map`.
+        Default is ``'sge'``.
+
+    Returns
+    -------
+    results : list
+        A list with the results of the last function for each job. If a job
+        of any stage failed or was not finished, the value will be None.
+
+    Examples
+    --------
+    >>> def simulate(seed):
+    ...     return numpy.random.RandomState(seed).rand(100)
+    >>> def analyze(data):
+    ...     return data.mean()
+    >>> pygrid.pipeline([simulate, analyze], [{'seed': i} for i in range(10)])
+    """
+
+    call_file = os.path.abspath(inspect.stack()[1][1])
+
+    # test if pygrid is called inside a pygrid map instance
+    if not nest and os.environ.get('PYGRID') == 1:
+        raise Exception('PyGrid called itself inside a PyGrid instance. ' +
+                        'Read the tutorial on how to avoid this.')
+
+    # input tests
+    if type(functions) != list or len(functions) == 0:
+        raise ValueError('`functions` has to be a non-empty list.')
+    if not all(hasattr(function, '__call__') for function in functions):
+        raise ValueError('`functions` has to contain callables.')
+    names = [_get_first_parameter(function) for function in functions[1:]]
+    if type(args) != list or not all(type(arg) == dict for arg in args):
+        raise ValueError('`args` has to be a list of dicts.')
+    cluster_params = _get_cluster_params(cluster_params)
+    _check_chunksize(chunksize)
+    if _get_adaptive_policy(chunksize) is not None:
+        raise ValueError('`chunksize` must be a positive integer or `auto`.')
+    _get_backend(backend)
+
+    folders = [pjoin(temp_folder, 'stage_' + str(i)) for i in
+               range(len(functions))]
+    if _check_temp_folder(temp_folder, 'pipeline'):
+        os.makedirs(temp_folder)
+        # the info of the pipeline folder tells that its results are those
+        # of the last stage
+        _write_info(temp_folder, None, None, None, cluster_params, len(args),
+                    chunksize, kind='pipeline', nstages=len(functions),
+                    backend=backend)
+        open(pjoin(temp_folder, 'is_pygrid'), 'w').close()
+        # the jobs of a stage read the result files of the stage before it.
+        # every stage holds its tasks on the tasks of the stage before it
+        hold = None
+        inputs = None
+        for i, function in enumerate(functions):
+            if i > 0:
+                inputs = {'folder': pjoin('..', 'stage_' + str(i - 1)),
+                          'name': names[i - 1], 'shard': _SHARD_SIZE}
+            local = _write_and_submit(
+                function, args if i == 0 else [{} for arg in args],
+                folders[i], use_cluster, cluster_params, chunksize,
+                max_workers, None, None, backend, False, False, None, None,
+                None, None, None, call_file, hold, inputs)
+            if not use_cluster:
+                _wait_local(local)
+            elif len(args) > 0:
+                hold = _get_qids(folders[i])[-1]
+
+    if not use_cluster:
+        return get_results(folders[-1])
+    elif interactive:
+        _disp_progress(folders[-1])
+        return get_results(folders[-1])
+    else:
+        return None
+
+
+def _get_first_parameter(function):
+    # the name of the parameter that gets the result of the stage before
+    try:
+        parameters = inspect.getargspec(function).args
+    except TypeError:
+        parameters = []
+    if len(parameters) == 0:
+        raise ValueError('The functions of the later stages need a parameter '
+                         'for the result, `' + str(function) + '` has none.')
+    return parameters[0]
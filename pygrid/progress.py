@@ -4,14 +4,20 @@
 # License: BSD
 
 import os
-import subprocess
 import time
 import termios
 import fcntl
 import sys
 
 from .file_handling import _get_job_map, _get_info, _get_qids, delete_folder
-from .run import _submit_jobs
+from .file_handling import _get_finished, _get_result, _get_claims
+from .file_handling import _list_queue, _requeue, _get_pending
+from .file_handling import _write_pending, _get_last_stage
+from .run import _submit_jobs, _wait_local, _submit_pending
+from .backends import _get_backend
+from .retry import _retry_failed
+from .speculation import _speculate
+from .reduce import _reduce, _get_reduce_qids
 
 
 def get_progress(temp_folder):
@@ -31,56 +37,148 @@ def get_progress(temp_folder):
         - running
         - failed
         - finished
-        
+
+        If the jobs were submitted with ``retry``, failed jobs are resubmitted
+        according to the policy and are returned as waiting. With
+        ``speculate``, slow jobs are submitted a second time. With an
+        adaptive ``chunksize``, the next jobs are submitted when the queue
+        runs empty.
+
     """
-    jobs = {}
-    jobs['all'] = range(_get_info(temp_folder)['njobs'])
-
-    qids = _get_qids(temp_folder)
-
-    # get job maps
-    job_maps = {}
-    for qid in qids:
-        job_maps[qid] = _get_job_map(temp_folder, qid)
-
-    # get jobs running and waiting
-    output = subprocess.Popen(
-        ['qstat', '-g', 'd'],
-        stdout=subprocess.PIPE).communicate()[0].split(os.linesep)
-    first = output[0]
-    status_marker = first.find('state')
-    jobs['running'] = []
-    jobs['waiting'] = []
-    for line in output[2:]:
-        if line == '':
-            break
-        qid = line.split()[0]
-        if qid in qids:
-            task_id = int(line.split()[-1])
-            id = job_maps[qid][task_id - 1]
-            status = line[status_marker:status_marker + 2]
-            if status == 'r ':
-                jobs['running'].append(id)
-            elif status == 'qw':
-                jobs['waiting'].append(id)
-            else:
-                # consider all these jobs (dr, t, ...) as done
-                pass
+    # the progress of a pipeline is the progress of its last stage
+    temp_folder = _get_last_stage(temp_folder)
+    task_states = _get_task_states(
+        _get_qids(temp_folder), _get_info(temp_folder).get('backend', 'sge'))
+    jobs = _get_progress(temp_folder, task_states)
+    # failed and slow jobs are resubmitted if map was called with retry or
+    # speculate
+    jobs = _retry_failed(temp_folder, jobs)
+    jobs = _submit_pending(temp_folder, jobs, task_states)
+    jobs = _speculate(temp_folder, jobs, task_states)
+    # results of map_reduce are reduced as they arrive
+    return _reduce(temp_folder, jobs)
+
+
+def _get_progress(temp_folder, task_states):
+    # computes the progress from the task states of the folder's qids. the
+    # task states of several folders can be queried at once
+    info = _get_info(temp_folder)
+    njobs = info['njobs']
+    if info.get('workers') is not None:
+        running, waiting = _get_worker_jobs(temp_folder, task_states)
+    else:
+        # only the job maps of submissions that still have tasks in the
+        # queue are read
+        running = set()
+        waiting = set()
+        for qid, (running_tasks, waiting_tasks) in task_states.items():
+            if len(running_tasks) + len(waiting_tasks) == 0:
+                continue
+            job_map = _get_job_map(temp_folder, qid)
+            for task_id in running_tasks:
+                running.update(job_map[task_id - 1])
+            for task_id in waiting_tasks:
+                waiting.update(job_map[task_id - 1])
+        # jobs held back by an adaptive chunksize wait for their submission
+        waiting.update(_get_pending(temp_folder))
 
     # get jobs for which result files are found
-    files = os.listdir(temp_folder)
-    jobs['finished'] = [int(f.split('_')[1]) for f in files if
-                        f.startswith('result_')]
+    finished = _get_finished(temp_folder)
+
+    # jobs of a running chunk that are already done are not running anymore
+    running -= finished
+
+    jobs = {}
+    jobs['all'] = range(njobs)
+    jobs['finished'] = sorted(finished)
+    jobs['running'] = sorted(running)
+    jobs['waiting'] = sorted(waiting)
 
     # compute which jobs have failed
-    jobs['failed'] = [id for id in jobs['all'] if
-                      id not in jobs['finished'] and
-                      id not in jobs['running'] and id not in jobs['waiting']]
+    jobs['failed'] = sorted(set(jobs['all']) - finished - running - waiting)
 
     return jobs
 
 
-def _disp_progress(temp_folder):
+def _get_worker_jobs(temp_folder, task_states):
+    # returns the running and waiting jobs of a folder with workers. claims of
+    # workers that are gone are returned to the queue. the queued jobs are
+    # only waiting if there are workers left to run them
+    running = set()
+    for id, qid, task_id in _get_claims(temp_folder):
+        if qid in task_states and (task_id in task_states[qid][0] or
+                                   task_id in task_states[qid][1]):
+            running.add(id)
+        else:
+            _requeue(temp_folder, id, qid, task_id)
+    if any(len(running_tasks) + len(waiting_tasks) > 0 for
+           running_tasks, waiting_tasks in task_states.values()):
+        waiting = set(_list_queue(temp_folder))
+    else:
+        waiting = set()
+    return running, waiting
+
+
+def _get_task_states(qids, backend='sge'):
+    # returns the running and waiting task ids for each of the qids
+    return _get_backend(backend).get_task_states(qids)
+
+
+def _cancel_jobs(temp_folder):
+    # cancels all jobs of the folder with one scheduler call
+    qids = _get_qids(temp_folder) + _get_reduce_qids(temp_folder)
+    if len(qids) > 0:
+        _get_backend(_get_info(temp_folder).get('backend', 'sge')).cancel(qids)
+
+
+def _iter_results(temp_folder, ordered=True, failed=True, local=None,
+                  poll_interval=1):
+    # yields (id, result) tuples as the result files appear. when local is
+    # the AsyncResult of local workers, the jobs are done when it is ready,
+    # otherwise when no job is left running or waiting on the cluster. with
+    # failed set, None is yielded for jobs that are done without result
+    info = _get_info(temp_folder)
+    pending = set(range(info['njobs']))
+    ready = set()
+    next_id = 0
+    while len(pending) > 0:
+        # check if the jobs are done before looking for results, so that no
+        # result written in between is missed
+        if local is None:
+            jobs = get_progress(temp_folder)
+            done = len(jobs['running']) + len(jobs['waiting']) == 0
+            ready.update(pending.intersection(jobs['finished']))
+        else:
+            done = local.ready()
+            ready.update(pending.intersection(_get_finished(temp_folder)))
+
+        if ordered:
+            ids = []
+            while next_id in pending and (next_id in ready or done):
+                ids.append(next_id)
+                next_id += 1
+        elif done:
+            ids = sorted(ready) + sorted(pending - ready)
+        else:
+            ids = sorted(ready)
+
+        for id in ids:
+            pending.discard(id)
+            if id in ready:
+                ready.discard(id)
+                yield id, _get_result(temp_folder, id, None,
+                                      info.get('shard'))
+            elif failed:
+                yield id, None
+
+        if len(pending) > 0:
+            time.sleep(poll_interval)
+
+    if local is not None:
+        _wait_local(local)
+
+
+def _disp_progress(temp_folder, on_result=None):
 
     fd = sys.stdin.fileno()
     oldterm = termios.tcgetattr(fd)
@@ -97,6 +195,7 @@ def _disp_progress(temp_folder):
     abort = False
     confirm = None
     cluster_params = ''
+    reported = set()
     print('')
     try:
         while abort is False:
@@ -110,19 +209,16 @@ def _disp_progress(temp_folder):
                 elif confirm is not None and c == 'y':
                     # action was confirmed
                     if confirm == 'a':
-                        qids = _get_qids(temp_folder)
-                        for qid in qids:
-                            p = subprocess.Popen(['qdel', qid],
-                                                 stdout=subprocess.PIPE,
-                                                 stderr=subprocess.PIPE)
-                            p.communicate()
+                        _cancel_jobs(temp_folder)
                         abort = True
                     elif confirm == 'c':
                         abort = True
                     elif confirm == 'r':
                         jobs = get_progress(temp_folder)
                         params = cluster_params.split(';')
-                        res = _submit_jobs(temp_folder, jobs['failed'], params)
+                        res = _submit_jobs(temp_folder, jobs['failed'], params,
+                                           _get_info(temp_folder).get(
+                                               'chunksize', 1))
                         if res is False:
                             extra_lines = ['Could not submit job. Are your ' +
                                            ' `cluster_params` valid?']
@@ -133,28 +229,21 @@ def _disp_progress(temp_folder):
                         jobs = get_progress(temp_folder)
 
                         # kill old jobs
-                        qids = _get_qids(temp_folder)
-                        for qid in qids:
-                            p = subprocess.Popen(['qdel', qid],
-                                                 stdout=subprocess.PIPE,
-                                                 stderr=subprocess.PIPE)
-                            p.communicate()
+                        _cancel_jobs(temp_folder)
+                        _write_pending(temp_folder, [])
 
                         # start new jobs
                         params = cluster_params.split(';')
-                        res = _submit_jobs(temp_folder, jobs['all'], params)
+                        res = _submit_jobs(temp_folder, jobs['all'], params,
+                                           _get_info(temp_folder).get(
+                                               'chunksize', 1))
                         if res is True:
                             extra_lines = ['Could not submit job. Are your ' +
                                            ' `cluster_params` valid?']
                         else:
                             extra_lines = None
                     elif confirm == 'q':
-                        qids = _get_qids(temp_folder)
-                        for qid in qids:
-                            p = subprocess.Popen(['qdel', qid],
-                                                 stdout=subprocess.PIPE,
-                                                 stderr=subprocess.PIPE)
-                            p.communicate()
+                        _cancel_jobs(temp_folder)
                         delete_folder(temp_folder)
                         abort = True
                     confirm = None
@@ -227,6 +316,14 @@ def _disp_progress(temp_folder):
                     jobs = get_progress(temp_folder)
                     if set(jobs['all']) == set(set(jobs['finished'])):
                         abort = True
+
+                    # pass new results on while the other jobs are running
+                    if on_result is not None:
+                        shard = _get_info(temp_folder).get('shard')
+                        for id in sorted(set(jobs['finished']) - reported):
+                            reported.add(id)
+                            on_result(id, _get_result(temp_folder, id, None,
+                                                      shard))
                     l = ('%d Jobs: %d Finished / %d Running / %d Failed / %d'
                          ' in Queue (press ? for help)' % (
                              len(jobs['all']),
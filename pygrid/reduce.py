@@ -0,0 +1,212 @@
+""" Implements the reduction of job results on the cluster """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import sys
+from os.path import join as pjoin
+from os.path import exists as pexists
+import cPickle as pickle
+
+from .file_handling import _get_info, _submit_lock, _load_data
+from .file_handling import _write_reduce_map, _get_name
+from .run import _write_script
+from .backends import _get_backend
+
+# no more reduction tasks are submitted after this many failed
+_MAX_FAILURES = 3
+
+
+def get_reduced(temp_folder, partial=False):
+    """ Returns the reduced result of :py:meth:`~pygrid.map_reduce`
+
+    Checks the progress of the jobs first, which submits reduction tasks for
+    the results that arrived.
+
+    Parameters
+    ----------
+    temp_folder : string
+        The temporary folder that was given when the job was submitted first.
+    partial : bool, optional
+        If set to True, the results of the jobs that finished so far are
+        reduced, including the ones that reduction tasks are still working
+        on. The partial reductions that are done are used, so only the
+        remaining values are combined on this machine. Default is False.
+
+    Returns
+    -------
+    output : object
+        The reduction of the results of all finished jobs. Failed jobs are
+        left out. None if jobs or reduction tasks are still running, or if no
+        job finished.
+    """
+    return _get_reduced(temp_folder, partial)[1]
+
+
+def _get_reduced(temp_folder, partial=False):
+    # returns if the reduction is done and the value of get_reduced
+    from .progress import get_progress
+    jobs = get_progress(temp_folder)
+    info = _get_info(temp_folder)
+    if info.get('reduce') is None:
+        raise ValueError('`' + temp_folder + '` was not written by '
+                         'map_reduce.')
+    with _submit_lock(temp_folder):
+        state = _load_state(temp_folder)
+    if state['failures'] >= _MAX_FAILURES:
+        raise Exception('Reduction tasks failed ' + str(state['failures']) +
+                        ' times. See the error logs in `' + temp_folder +
+                        '`.')
+    available = _get_available(state, jobs, info.get('shard'))
+
+    done = (len(jobs['running']) + len(jobs['waiting']) +
+            len(state['tasks']) == 0 and len(available) <= 1)
+
+    if partial:
+        # the inputs of running reduction tasks are not removed
+        for qid, task_id, inputs in state['tasks'].values():
+            available.extend(inputs)
+    elif not done:
+        return done, None
+    if len(available) == 0:
+        return done, None
+    return done, _combine(temp_folder, _import_reducer(info), available)
+
+
+def _import_reducer(info):
+    # imports the reducer as the jobs do
+    if info['path'] not in sys.path:
+        sys.path.append(info['path'])
+    module = __import__(info['reduce']['module'])
+    return getattr(module, info['reduce']['function_name'])
+
+
+def _combine(temp_folder, reducer, names):
+    # reduces the files with the given names in temp_folder one at a time
+    value = _load_data(pjoin(temp_folder, names[0]))
+    for name in names[1:]:
+        value = reducer(value, _load_data(pjoin(temp_folder, name)))
+    return value
+
+
+def _load_state(temp_folder):
+    # the reduce file holds the running reduction tasks as a dict from their
+    # output to (qid, task id, inputs), the ids of the results that were
+    # given to a task, the outputs that were not given to a task yet, the
+    # number of the next output and the number of failed tasks
+    if not pexists(pjoin(temp_folder, 'reduce')):
+        return {'tasks': {}, 'reduced': set(), 'partials': set(), 'next': 0,
+                'failures': 0}
+    with open(pjoin(temp_folder, 'reduce'), 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_state(temp_folder, state):
+    filename = pjoin(temp_folder, 'reduce')
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+
+
+def _get_reduce_qids(temp_folder):
+    return sorted(set(qid for qid, task_id, inputs in
+                      _load_state(temp_folder)['tasks'].values()))
+
+
+def _get_available(state, jobs, shard=None):
+    # the results and partial reductions that no task was given yet
+    return ([_get_name('result', id, shard) for id in jobs['finished'] if
+             id not in state['reduced']] +
+            sorted(state['partials'], key=_get_number))
+
+
+def _get_number(name):
+    return int(name.rsplit('_', 1)[1])
+
+
+def _is_result(name):
+    return os.path.basename(name).startswith('result_')
+
+
+def _update_tasks(temp_folder, backend, state):
+    # the output of tasks that left the queue can be reduced further. the
+    # inputs of tasks that left without output are reduced again
+    qids = sorted(set(qid for qid, task_id, inputs in
+                      state['tasks'].values()))
+    task_states = backend.get_task_states(qids)
+    for output, (qid, task_id, inputs) in list(state['tasks'].items()):
+        running, waiting = task_states.get(qid, (set(), set()))
+        if task_id in running or task_id in waiting:
+            continue
+        if pexists(pjoin(temp_folder, output)):
+            state['partials'].add(output)
+        else:
+            _give_back(state, inputs)
+            state['failures'] += 1
+        del state['tasks'][output]
+
+
+def _give_back(state, names):
+    for name in names:
+        if _is_result(name):
+            state['reduced'].discard(_get_number(name))
+        else:
+            state['partials'].add(name)
+
+
+def _reduce(temp_folder, jobs):
+    # submits a reduction task for every fanin values that are available.
+    # when no job is left, the rest is reduced in a smaller group once the
+    # running reduction tasks are done, until a single value is left
+    info = _get_info(temp_folder)
+    if info.get('reduce') is None:
+        return jobs
+    fanin = info['reduce']['fanin']
+    backend = _get_backend(info.get('backend', 'sge'))
+
+    with _submit_lock(temp_folder):
+        state = _load_state(temp_folder)
+        if len(state['tasks']) > 0:
+            _update_tasks(temp_folder, backend, state)
+        available = _get_available(state, jobs, info.get('shard'))
+        groups = [available[i:i + fanin] for i in
+                  range(0, len(available) - fanin + 1, fanin)]
+        rest = available[len(groups) * fanin:]
+        if (len(jobs['running']) + len(jobs['waiting']) == 0 and
+                len(state['tasks']) + len(groups) == 0 and len(rest) > 1):
+            groups.append(rest)
+        if len(groups) > 0 and state['failures'] < _MAX_FAILURES:
+            res = _submit_reductions(temp_folder, backend, info, state,
+                                     groups)
+            if res is not True:
+                print('Could not submit reduction tasks: ' + res)
+        _save_state(temp_folder, state)
+    return jobs
+
+
+def _submit_reductions(temp_folder, backend, info, state, groups):
+    # submits one array task for each group of input files. returns True or
+    # the output of the scheduler if the submission failed
+    script = _write_script(temp_folder, backend, len(groups),
+                           info['cluster_params'], 'reduce')
+    try:
+        qid = backend.submit(temp_folder, script, len(groups))
+    except Exception as e:
+        return str(e)
+    tasks = []
+    for task_no, group in enumerate(groups):
+        output = _get_name('partial', state['next'], info.get('shard'))
+        state['next'] += 1
+        # retried reductions can count beyond the shards of the jobs
+        if not os.path.isdir(os.path.dirname(pjoin(temp_folder, output))):
+            os.makedirs(os.path.dirname(pjoin(temp_folder, output)))
+        state['tasks'][output] = (qid, task_no + 1, group)
+        for name in group:
+            if _is_result(name):
+                state['reduced'].add(_get_number(name))
+            else:
+                state['partials'].discard(name)
+        tasks.append((group, output))
+    _write_reduce_map(temp_folder, qid, tasks)
+    return True
@@ -0,0 +1,188 @@
+""" Implements a lazy sequence of the results of pygrid jobs """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import threading
+from collections import OrderedDict
+
+from .file_handling import _get_info, _get_result, _get_path
+from .file_handling import _get_last_stage
+
+
+class Results(object):
+    """ A sequence of the job results that loads them when they are accessed
+
+    Unlike :py:meth:`~pygrid.get_results`, the results are read from
+    ``temp_folder`` when they are accessed, and only the recently used ones
+    are kept in memory. ``Results`` supports ``len``, indexing, slicing and
+    iteration. Slices are ``Results`` as well and share the cache. As with
+    :py:meth:`~pygrid.get_results`, the result of a job that failed or is not
+    finished is None.
+
+    Parameters
+    ----------
+    temp_folder : string
+        The temporary folder that was given when the job was submitted first.
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional
+        If not None, results that are a single numpy array are memory mapped
+        with the given mode. See :py:meth:`~pygrid.get_results`. Default is
+        None.
+    cache_size : int, optional
+        The number of bytes of results that are kept in memory, measured by
+        the size of their files. Default is 256MB.
+
+    Examples
+    --------
+    >>> results = pygrid.Results('temp_pygrid')
+    >>> results.prefetch()
+    >>> total = sum(result.sum() for result in results)
+    """
+
+    def __init__(self, temp_folder, mmap_mode=None, cache_size=1 << 28):
+        # the results of a pipeline are those of its last stage
+        temp_folder = _get_last_stage(temp_folder)
+        self._temp_folder = temp_folder
+        self._mmap_mode = mmap_mode
+        info = _get_info(temp_folder)
+        self._shard = info.get('shard')
+        self._ids = range(info['njobs'])
+        self._cache = _Cache(cache_size)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            view = object.__new__(Results)
+            view.__dict__.update(self.__dict__)
+            view._ids = self._ids[index]
+            return view
+        return self._load(self._ids[index])
+
+    def __iter__(self):
+        for id in self._ids:
+            yield self._load(id)
+
+    def __repr__(self):
+        return ('<Results of ' + str(len(self._ids)) + ' jobs in `' +
+                self._temp_folder + '`>')
+
+    def prefetch(self, start=0, stop=None):
+        """ Loads results in the background for a sequential scan
+
+        A thread loads the results from position ``start`` to ``stop`` in
+        order, as long as the results that it loaded and that were not
+        accessed yet fit into ``cache_size``. Another call stops the previous
+        prefetch of the sequence and its slices.
+
+        Parameters
+        ----------
+        start : int, optional
+            The position of the first result. Default is 0.
+        stop : int, optional
+            The position after the last result. Default is None, which loads
+            until the end.
+        """
+        ids = self._ids[start:stop]
+        stop_event = threading.Event()
+        with self._cache.condition:
+            if self._cache.prefetching is not None:
+                self._cache.prefetching.set()
+            self._cache.prefetching = stop_event
+        thread = threading.Thread(target=self._prefetch,
+                                  args=(ids, stop_event))
+        thread.daemon = True
+        thread.start()
+
+    def _prefetch(self, ids, stop_event):
+        for id in ids:
+            nbytes = self._get_size(id)
+            if nbytes is None or self._cache.contains(id):
+                continue
+            self._cache.wait_for_space(nbytes, stop_event)
+            if stop_event.is_set():
+                return
+            self._cache.put(id, _get_result(self._temp_folder, id,
+                                            self._mmap_mode, self._shard),
+                            nbytes, True)
+
+    def _get_size(self, id):
+        # the size of the result file or None if the job is not finished
+        try:
+            return os.path.getsize(_get_path(self._temp_folder, 'result', id,
+                                             self._shard))
+        except OSError:
+            return None
+
+    def _load(self, id):
+        found, value = self._cache.get(id)
+        if found:
+            return value
+        nbytes = self._get_size(id)
+        if nbytes is None:
+            return None
+        value = _get_result(self._temp_folder, id, self._mmap_mode,
+                            self._shard)
+        self._cache.put(id, value, nbytes)
+        return value
+
+
+class _Cache(object):
+    # a least recently used cache of results with a budget of bytes. results
+    # that were prefetched and not accessed yet are not evicted, and the
+    # prefetch waits while they fill the budget
+
+    def __init__(self, size):
+        self.size = size
+        self.values = OrderedDict()
+        self.nbytes = 0
+        self.unread = {}
+        self.unread_bytes = 0
+        self.prefetching = None
+        self.condition = threading.Condition()
+
+    def contains(self, id):
+        with self.condition:
+            return id in self.values
+
+    def get(self, id):
+        # returns if the id was found and its value
+        with self.condition:
+            if id not in self.values:
+                return False, None
+            value, nbytes = self.values.pop(id)
+            self.values[id] = (value, nbytes)
+            if id in self.unread:
+                self.unread_bytes -= self.unread.pop(id)
+                self.condition.notify_all()
+            return True, value
+
+    def put(self, id, value, nbytes, unread=False):
+        with self.condition:
+            if id in self.values:
+                return
+            for old in list(self.values):
+                if self.nbytes + nbytes <= self.size:
+                    break
+                if old not in self.unread:
+                    self.nbytes -= self.values.pop(old)[1]
+            # a value that does not fit is not kept, unless it was prefetched
+            if self.nbytes + nbytes > self.size and not unread:
+                return
+            self.values[id] = (value, nbytes)
+            self.nbytes += nbytes
+            if unread:
+                self.unread[id] = nbytes
+                self.unread_bytes += nbytes
+
+    def wait_for_space(self, nbytes, stop_event):
+        # blocks until the prefetched results that were not accessed leave
+        # room for nbytes. a single result larger than the budget is loaded
+        # when it is the only one
+        with self.condition:
+            while (self.unread_bytes > 0 and
+                   self.unread_bytes + nbytes > self.size and
+                   not stop_event.is_set()):
+                self.condition.wait(1)
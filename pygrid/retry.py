@@ -0,0 +1,212 @@
+""" Implements the classification and automatic resubmission of failed jobs """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+from os.path import join as pjoin
+from os.path import exists as pexists
+import cPickle as pickle
+
+from .file_handling import _get_info, _get_qids, _get_job_map, _get_journal
+from .file_handling import _submit_lock, _get_path, _get_submit_offsets
+from .run import _submit_jobs
+from .backends import _get_backend
+
+# with retry=True, jobs that ran out of memory or time are resubmitted with
+# twice the limit, jobs that failed because of their node are resubmitted
+# unchanged and exceptions are not retried. every job runs at most 3 times
+DEFAULT_POLICY = {'memory': 2, 'timeout': 2, 'node': True, 'unknown': True,
+                  'exception': False, 'max_attempts': 3}
+
+# messages in the error logs that tell why a task was killed
+_LOG_PATTERNS = [
+    ('memory', ['MemoryError', 'h_vmem', 'Out of memory', 'out of memory',
+                'oom-kill', 'OUT_OF_MEMORY', 'Cannot allocate memory',
+                'std::bad_alloc', 'Exceeded job memory limit']),
+    ('timeout', ['h_rt', 'DUE TO TIME LIMIT', 'CPU time limit exceeded']),
+    ('node', ['NODE FAILURE', 'NODE_FAIL', 'Stale file handle',
+              'Input/output error'])]
+# the number of bytes that are read from the end of an error log
+_LOG_TAIL = 1 << 16
+
+
+def _get_retry_policy(retry):
+    # resolve the retry option of map to a policy dict or None
+    if retry is None or retry is False:
+        return None
+    policy = dict(DEFAULT_POLICY)
+    if retry is not True:
+        unknown = set(retry) - set(DEFAULT_POLICY)
+        if len(unknown) > 0:
+            raise ValueError('Unknown keys in `retry`: ' +
+                             ', '.join(sorted(unknown)) + '.')
+        policy.update(retry)
+    return policy
+
+
+def get_failures(temp_folder, ids=None):
+    """ Returns why jobs failed
+
+    The reason is found in the records of the jobs, the scheduler accounting
+    and the error logs in ``temp_folder``.
+
+    Parameters
+    ----------
+    temp_folder : string
+        The temporary folder that was given when the job was submitted first.
+    ids : list, optional
+        The indices of the jobs. Default is None, which uses the jobs that
+        failed according to :py:meth:`~pygrid.get_progress`.
+
+    Returns
+    -------
+    output : dict
+        A dict with the reason for each job:
+
+        - memory: the job ran out of memory
+        - timeout: the job reached its runtime limit
+        - exception: the function raised an exception
+        - node: the job could not run on its node
+        - unknown: the job stopped without a known reason
+
+    """
+    if ids is None:
+        from .progress import get_progress
+        ids = get_progress(temp_folder)['failed']
+    return _classify(temp_folder, ids, _load_attempts(temp_folder))
+
+
+def _classify(temp_folder, ids, attempts):
+    info = _get_info(temp_folder)
+    backend = _get_backend(info.get('backend', 'sge'))
+
+    # jobs whose last record in the journal says that they failed raised an
+    # exception. only the new records of the journal are read
+    statuses = _get_journal(temp_folder)['statuses']
+
+    # find the task that ran each job last. with workers, the task of a job
+    # is not known
+    tasks = {}
+    if info.get('workers') is None:
+        for qid in _get_qids(temp_folder):
+            if not pexists(pjoin(temp_folder, 'submit_map_' + qid)):
+                continue
+            for task_no, task_ids in enumerate(_get_job_map(temp_folder,
+                                                            qid)):
+                for id in task_ids:
+                    tasks[id] = (qid, task_no + 1)
+
+    # only the journal records and the output that were written after the
+    # last submission of a job tell why it failed this time
+    failures = {}
+    offsets = {}
+    reasons = {}
+    for id in ids:
+        qid, task_id = tasks.get(id, (None, None))
+        if qid is not None and qid not in failures:
+            params = attempts['params'].get(qid, info['cluster_params'])
+            failures[qid] = backend.get_failures(qid, params)
+            offsets[qid] = _get_submit_offsets(temp_folder, qid)
+        journal_size, log_sizes = offsets.get(qid, (0, {}))
+        status, end = statuses.get(id, (None, 0))
+        log = (_read_log(temp_folder, task_id, info.get('shard'),
+                         log_sizes.get(task_id, 0)) if
+               task_id is not None else '')
+        if qid is not None and task_id in failures[qid]:
+            reasons[id] = failures[qid][task_id]
+        elif status == 'failed' and end > journal_size:
+            reasons[id] = 'memory' if 'MemoryError' in log else 'exception'
+        else:
+            reasons[id] = 'unknown'
+            for reason, patterns in _LOG_PATTERNS:
+                if any(pattern in log for pattern in patterns):
+                    reasons[id] = reason
+                    break
+    return reasons
+
+
+def _read_log(temp_folder, task_id, shard=None, offset=0):
+    # the end of the error log of a task after offset. the logs of tasks with
+    # the same number of different submissions are written to the same file,
+    # offset is its size before the submission
+    filename = _get_path(temp_folder, 'log_error', task_id, shard)
+    if not pexists(filename):
+        return ''
+    with open(filename, 'rb') as f:
+        f.seek(max(offset, os.path.getsize(filename) - _LOG_TAIL))
+        return f.read()
+
+
+def _load_attempts(temp_folder):
+    # the attempts file holds the failures of each job, the parameters of the
+    # submissions and the jobs that are not retried anymore with the number
+    # of submissions at that time
+    if not pexists(pjoin(temp_folder, 'attempts')):
+        return {'jobs': {}, 'params': {}, 'given_up': {}}
+    with open(pjoin(temp_folder, 'attempts'), 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_attempts(temp_folder, attempts):
+    filename = pjoin(temp_folder, 'attempts')
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(attempts, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
+
+
+def _retry_failed(temp_folder, jobs):
+    # resubmits the failed jobs of jobs according to the retry policy of the
+    # folder and returns jobs with them moved to waiting. jobs that are not
+    # retried are only classified again after they were restarted by hand
+    policy = _get_info(temp_folder).get('retry')
+    if policy is None or len(jobs['failed']) == 0:
+        return jobs
+
+    # only one process may resubmit the jobs of a folder
+    with _submit_lock(temp_folder):
+        attempts = _load_attempts(temp_folder)
+        nqids = len(_get_qids(temp_folder))
+        ids = [id for id in jobs['failed'] if
+               attempts['given_up'].get(id) != nqids]
+        if len(ids) == 0:
+            return jobs
+        info = _get_info(temp_folder)
+        backend = _get_backend(info.get('backend', 'sge'))
+        reasons = _classify(temp_folder, ids, attempts)
+
+        # jobs with the same new parameters are submitted together
+        groups = {}
+        given_up = []
+        for id in ids:
+            history = attempts['jobs'].setdefault(id, [])
+            params = history[-1][1] if len(history) > 0 else list(
+                info['cluster_params'])
+            action = policy.get(reasons[id], False)
+            if action is False or len(history) + 1 >= policy['max_attempts']:
+                given_up.append(id)
+                continue
+            if action is not True and reasons[id] in ['memory', 'timeout']:
+                params = backend.scale_params(params, reasons[id], action)
+            history.append((reasons[id], params))
+            groups.setdefault(tuple(params), []).append(id)
+
+        resubmitted = set()
+        for params, group in sorted(groups.items()):
+            res = _submit_jobs(temp_folder, group, list(params),
+                               info.get('chunksize', 1))
+            if res is True:
+                attempts['params'][_get_qids(temp_folder)[-1]] = list(params)
+                resubmitted.update(group)
+            else:
+                for id in group:
+                    attempts['jobs'][id].pop()
+        nqids = len(_get_qids(temp_folder))
+        for id in given_up:
+            attempts['given_up'][id] = nqids
+        _save_attempts(temp_folder, attempts)
+
+    jobs = dict(jobs)
+    jobs['failed'] = [id for id in jobs['failed'] if id not in resubmitted]
+    jobs['waiting'] = sorted(set(jobs['waiting']) | resubmitted)
+    return jobs
@@ -4,13 +4,135 @@
 # License: BSD
 
 import os
+import sys
 import inspect
-import subprocess
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
 
-from .file_handling import _write_job_map
+from .file_handling import _write_job_map, _get_info, _fill_queue
+from .file_handling import _read_metrics, _get_pending, _write_pending
+from .file_handling import _submit_lock, _get_offsets, _write_submit_offsets
+from .backends import _get_backend
 
+# with chunksize='auto' jobs are packed so that no more than this many array
+# tasks are submitted at once
+_AUTO_MAX_TASKS = 1000
+# with chunksize='adaptive' a calibration wave of single job tasks is
+# submitted first. later waves pack the jobs so that a task runs for about
+# target seconds
+_ADAPTIVE_POLICY = {'target': 600, 'calibration': 10}
+# args that are not a list are written and submitted in waves of size jobs.
+# a wave waits while more than max_in_flight jobs would be queued or running
+_WAVE_POLICY = {'size': 1000, 'max_in_flight': 10000}
+
+
+def _get_adaptive_policy(chunksize):
+    # resolve an adaptive chunksize option to a policy dict or None
+    if chunksize == 'adaptive':
+        return dict(_ADAPTIVE_POLICY)
+    if not isinstance(chunksize, dict):
+        return None
+    unknown = set(chunksize) - set(_ADAPTIVE_POLICY)
+    if len(unknown) > 0:
+        raise ValueError('Unknown keys in `chunksize`: ' +
+                         ', '.join(sorted(unknown)) + '.')
+    policy = dict(_ADAPTIVE_POLICY)
+    policy.update(chunksize)
+    return policy
+
+
+def _get_wave_policy(waves, args):
+    # resolve the waves option of map to a policy dict or None. args that are
+    # not a list can only be written in waves
+    if waves is None or waves is False:
+        if type(args) == list:
+            return None
+        waves = True
+    policy = dict(_WAVE_POLICY)
+    if waves is not True:
+        unknown = set(waves) - set(_WAVE_POLICY)
+        if len(unknown) > 0:
+            raise ValueError('Unknown keys in `waves`: ' +
+                             ', '.join(sorted(unknown)) + '.')
+        policy.update(waves)
+    if type(policy['size']) != int or policy['size'] < 1:
+        raise ValueError('The `size` of `waves` must be a positive integer.')
+    return policy
+
+
+def _get_chunksize(chunksize, njobs, temp_folder=None):
+    # resolve the chunksize option to the number of jobs per array task
+    if chunksize == 'auto':
+        return max(1, (njobs + _AUTO_MAX_TASKS - 1) // _AUTO_MAX_TASKS)
+    policy = _get_adaptive_policy(chunksize)
+    if policy is not None:
+        if temp_folder is None:
+            return 1
+        return _estimate_chunksize(_read_metrics(temp_folder),
+                                   policy['target'])
+    return chunksize
+
+
+def _estimate_chunksize(metrics, target):
+    # the number of jobs that take about target seconds together, from the
+    # mean wall clock time of the jobs with metrics. the first job of a task
+    # also pays for the imports, so single job tasks give a low estimate
+    if len(metrics) == 0:
+        return 1
+    total = sum(record['load_wall'] + record['import_wall'] +
+                record['compute_wall'] + record['save_wall'] for record in
+                metrics.values())
+    return max(1, int(target * len(metrics) / max(total, 1e-6)))
+
+
+def _check_chunksize(chunksize):
+    if _get_adaptive_policy(chunksize) is not None:
+        return
+    if chunksize != 'auto' and (type(chunksize) != int or chunksize < 1):
+        raise ValueError('`chunksize` must be a positive integer, `auto` or '
+                         '`adaptive`.')
+
+
+def _submit_jobs(temp_folder, ids, cluster_params, chunksize=1, hold=None):
+    # writes the sh file and submits it with the backend of the folder.
+    # returns True or the output of the scheduler if the submission failed.
+    # with hold, each task waits for the same task of the qid hold
+    info = _get_info(temp_folder)
+    workers = info.get('workers')
+    if workers is not None:
+        # long-lived workers take the jobs from a queue, the queue has to be
+        # filled before they start
+        _fill_queue(temp_folder, ids)
+        ntasks = min(workers, len(ids))
+    else:
+        chunksize = _get_chunksize(chunksize, len(ids), temp_folder)
+        ntasks = (len(ids) + chunksize - 1) // chunksize
+
+    backend = _get_backend(info.get('backend', 'sge'))
+    script = _write_script(temp_folder, backend, ntasks, cluster_params)
+    offsets = _get_offsets(temp_folder, ntasks)
+
+    # submit the jobs and save the qid
+    try:
+        if hold is None:
+            qid = backend.submit(temp_folder, script, ntasks)
+        else:
+            qid = backend.submit(temp_folder, script, ntasks, hold)
+    except Exception as e:
+        return str(e)
+    _write_submit_offsets(temp_folder, qid, offsets)
+    with open(os.path.join(temp_folder, 'qids'), 'a') as f:
+        f.write(qid + ' ')
+
+    if workers is None:
+        _write_job_map(temp_folder, qid, ids, chunksize)
+    return True
+
+
+def _write_script(temp_folder, backend, ntasks, cluster_params, mode=None):
+    # writes the next sh file that runs execute_job.py in ntasks array tasks
+    # and returns its name. mode is passed on to execute_job.py
 
-def _submit_jobs(temp_folder, ids, cluster_params):
     # find file that does not exist yet
     file_no = 1
     while os.path.exists(os.path.join(temp_folder, 'submit_' + str(file_no) +
@@ -18,52 +140,194 @@ def _submit_jobs(temp_folder, ids, cluster_params):
         file_no += 1
 
     # write sh file
-    with open(os.path.join(temp_folder, 'submit_' + str(file_no) + '.sh'),
-              'w') as f:
+    shard = _get_info(temp_folder).get('shard')
+    script = 'submit_' + str(file_no) + '.sh'
+    with open(os.path.join(temp_folder, script), 'w') as f:
         f.write('#!/bin/bash\n')
-        f.write('#$ -cwd\n')
-        f.write('#$ -t 1-' + str(len(ids)) + '\n')
-        f.write('#$ -e log_error_$TASK_ID\n')
-        f.write('#$ -o log_output_$TASK_ID\n')
-        f.write('#$ -S /bin/bash\n')
-        for p in cluster_params:
-            f.write('#$ ' + p + '\n')
+        backend.write_header(f, ntasks, cluster_params, shard is None)
         f.write('\n')
         f.write('export PYGRID=1\n')  # set PYGRID to avoid accidental nesting
         f.write('')
+        if shard is not None:
+            # the scheduler can not put the logs into the shard of the task
+            task_id = backend.task_id_variable
+            folder = 'shards/$((' + task_id + ' / ' + str(shard) + '))/'
+            f.write('exec >> ' + folder + 'log_output_' + task_id + ' 2>> ' +
+                    folder + 'log_error_' + task_id + '\n')
         current_dir = os.path.split(os.path.abspath(inspect.stack()[0][1]))[0]
         f.write('python ' + os.path.join(current_dir, 'execute_job.py') +
-                ' ${JOB_ID} ${SGE_TASK_ID}\n')
+                ' ' + backend.job_id_variable + ' ' +
+                backend.task_id_variable +
+                ('' if mode is None else ' ' + mode) + '\n')
+    return script
 
-    # submit the jobs
-    output = subprocess.Popen(
-        ['qsub', 'submit_' + str(file_no) + '.sh'],
-        stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-        cwd=temp_folder).communicate()[0]
 
-    # save the qid
-    # output should be Your job-array 1234.1-...
-    try:
-        ref, qid_string = output.split(' job-array ')
-    except ValueError:
-        return output
-    if ref != 'Your' or '.' not in qid_string:
-        return output
-    qid = qid_string.split('.')[0]
-    with open(os.path.join(temp_folder, 'qids'), 'a') as f:
-        f.write(qid + ' ')
+def _submit_pending(temp_folder, jobs, task_states):
+    # submits the next wave of the jobs that map held back to calibrate an
+    # adaptive chunksize. a wave is only submitted when no task of the folder
+    # is waiting in the queue, and the first one when the calibration jobs
+    # are done, so every wave uses the runtimes of the jobs that finished
+    # before. a wave holds as many jobs as were submitted before, but at
+    # least `calibration` tasks
+    info = _get_info(temp_folder)
+    policy = _get_adaptive_policy(info.get('chunksize'))
+    if (policy is None or
+            not os.path.exists(os.path.join(temp_folder, 'pending')) or
+            any(len(waiting) > 0 for running, waiting in
+                task_states.values())):
+        return jobs
+
+    with _submit_lock(temp_folder):
+        pending = _get_pending(temp_folder)
+        if len(pending) == 0:
+            return jobs
+        metrics = _read_metrics(temp_folder)
+        nsubmitted = info['njobs'] - len(pending)
+        if (len(metrics) < min(policy['calibration'], nsubmitted) and
+                any(len(running) > 0 for running, waiting in
+                    task_states.values())):
+            return jobs
+        chunksize = _estimate_chunksize(metrics, policy['target'])
+        size = max(nsubmitted, policy['calibration'] * chunksize)
+        res = _submit_jobs(temp_folder, pending[:size], info['cluster_params'],
+                           chunksize)
+        if res is not True:
+            print('Could not submit the next jobs: ' + res)
+            return jobs
+        _write_pending(temp_folder, pending[size:])
+    return jobs
+
+
+# the queue of a local worker that tells which worker started a task
+_started = None
 
-    _write_job_map(temp_folder, qid, ids)
-    return True
 
+def _init_local_worker(started):
+    # set PYGRID to avoid accidental nesting, as in the sh file
+    global _started
+    os.environ['PYGRID'] = '1'
+    _started = started
 
-def _simulate_jobs(temp_folder, ids):
+
+def _run_local_task(task):
+    from .execute_job import _run_jobs
+    temp_folder, task_no, ntasks, ids = task
+    # the put is written before it returns, so it is not lost if the worker
+    # dies during the task
+    _started.put((task_no, os.getpid()))
+    if len(ids) == 1:
+        print('Starting job with id ' + str(ids[0]) + ' (' + str(task_no) +
+              '/' + str(ntasks) + ')')
+    else:
+        print('Starting jobs with ids ' + str(ids[0]) + '-' + str(ids[-1]) +
+              ' (' + str(task_no) + '/' + str(ntasks) + ')')
+    return _run_jobs(temp_folder, ids)
+
+
+def _simulate_jobs(temp_folder, ids, chunksize=1, max_workers=None,
+                   wait=True):
     qid = '000'  # dummy id
-    _write_job_map(temp_folder, qid, ids)
+    chunksize = _get_chunksize(chunksize, len(ids))
+    _write_job_map(temp_folder, qid, ids, chunksize)
 
-    for i, id in enumerate(ids):
-        print('Starting job with id ' + str(id) + ' (' + str(i) + '/' +
-              str(len(ids)) + ')')
-        current_dir = os.path.split(os.path.abspath(inspect.stack()[0][1]))[0]
-        subprocess.call(['python', os.path.join(
-            current_dir, 'execute_job.py'), qid, str(i + 1)], cwd=temp_folder)
+    # run the tasks in a pool of worker processes. the workers stay alive
+    # for all tasks, so the function module is only imported once per worker
+    temp_folder = os.path.abspath(temp_folder)
+    ntasks = (len(ids) + chunksize - 1) // chunksize
+    tasks = [(temp_folder, i, ntasks, ids[i * chunksize:(i + 1) * chunksize])
+             for i in range(ntasks)]
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    local = _LocalRun(tasks, min(max_workers, max(ntasks, 1)))
+
+    if wait:
+        _wait_local(local)
+    return local
+
+
+class _LocalRun(object):
+    # the tasks of a local run in a pool of worker processes, with the
+    # interface of an AsyncResult. the pool replaces a worker that died, e.g.
+    # by os._exit, a segfault or the OOM killer, but never finishes its task.
+    # such a task is given up, so that its jobs fail instead of blocking
+
+    def __init__(self, tasks, nworkers):
+        self.tasks = tasks
+        self.started = SimpleQueue()
+        self.pool = multiprocessing.Pool(nworkers,
+                                         initializer=_init_local_worker,
+                                         initargs=(self.started,))
+        self.results = [self.pool.apply_async(_run_local_task, (task,)) for
+                        task in tasks]
+        # the workers exit by themselves when all tasks are done
+        self.pool.close()
+        self.workers = {}
+        self.lost = set()
+        self.failed = set()
+
+    def _find_lost(self):
+        # tasks that are not done although their worker is gone
+        while not self.started.empty():
+            task_no, pid = self.started.get()
+            self.workers[task_no] = pid
+        # the pool has no public list of its workers
+        alive = set(process.pid for process in self.pool._pool if
+                    process.is_alive())
+        for task_no, pid in self.workers.items():
+            if (task_no not in self.lost and pid not in alive and
+                    not self.results[task_no].ready()):
+                self.lost.add(task_no)
+                ids = self.tasks[task_no][3]
+                sys.stderr.write('The worker of the jobs with ids ' +
+                                 str(ids[0]) + '-' + str(ids[-1]) +
+                                 ' died.\n')
+
+    def ready(self):
+        self._find_lost()
+        done = all(result.ready() or task_no in self.lost for
+                   task_no, result in enumerate(self.results))
+        if done and len(self.lost) > 0:
+            # the pool waits for the lost tasks forever
+            self.pool.terminate()
+        return done
+
+    def wait(self, timeout):
+        for result in self.results:
+            if not result.ready():
+                result.wait(timeout)
+                return
+
+    def get(self):
+        # an error in a task is reported once and its jobs show up as failed,
+        # the results of the other tasks are kept
+        results = []
+        for task_no, result in enumerate(self.results):
+            if task_no in self.lost:
+                continue
+            try:
+                results.append(result.get())
+            except Exception as e:
+                if task_no not in self.failed:
+                    self.failed.add(task_no)
+                    ids = self.tasks[task_no][3]
+                    sys.stderr.write('The task of the jobs with ids ' +
+                                     str(ids[0]) + '-' + str(ids[-1]) +
+                                     ' failed: ' + repr(e) + '\n')
+                results.append(False)
+        return results
+
+
+def _wait_local(local):
+    # wait for the local workers to finish. waiting with a timeout keeps the
+    # main process responsive to Ctrl-C
+    if local is None:
+        return
+    try:
+        while not local.ready():
+            local.wait(1)
+        local.get()
+    except KeyboardInterrupt:
+        local.pool.terminate()
+        raise
+    finally:
+        local.pool.join()
@@ -0,0 +1,169 @@
+""" Implements function snapshots for pygrid
+
+A snapshot holds the bytecode of the job function and of the functions of its
+module that it uses, together with the other global values it refers to. It
+is written as a zip file to the temp folder. The jobs copy it to node-local
+scratch space and load the function from there, so the module of the function
+is not imported by the jobs.
+
+This file is imported by execute_job.py as a script and must not use relative
+imports.
+"""
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import sys
+import types
+import marshal
+import zipfile
+import hashlib
+import cPickle as pickle
+
+from file_handling import _stage_file, _get_stage_policy
+
+# the name of the file in the zip that describes the function
+_SPEC_NAME = '__pygrid_snapshot__'
+
+
+def _get_names(code):
+    # global names used by the code and by the nested functions in it
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_get_names(const))
+    return names
+
+
+def _is_local(filename, path):
+    return (filename is not None and
+            os.path.realpath(filename).startswith(os.path.realpath(path) +
+                                                  os.sep))
+
+
+def _is_importable(value):
+    # if the value can be found by its module and name
+    module = sys.modules.get(getattr(value, '__module__', None))
+    name = getattr(value, '__name__', None)
+    return (module is not None and name is not None and
+            getattr(module, name, None) is value)
+
+
+def _snapshot_globals(function, module, spec):
+    # adds the globals that function refers to to spec. functions of the
+    # module are added as bytecode, modules and objects of other modules by
+    # name and other values are pickled. everything else is taken from the
+    # module, which then has to be imported by the jobs
+    for name in _get_names(function.__code__):
+        if name in spec or name not in function.__globals__:
+            continue
+        value = function.__globals__[name]
+        if isinstance(value, types.ModuleType):
+            spec[name] = ('module', value.__name__)
+        elif (isinstance(value, types.FunctionType) and
+                value.__module__ == function.__module__ and
+                value.__closure__ is None):
+            spec[name] = ('function', (marshal.dumps(value.__code__),
+                                       pickle.dumps(value.__defaults__),
+                                       value.__name__))
+            _snapshot_globals(value, module, spec)
+        elif (_is_importable(value) and
+                value.__module__ not in [function.__module__, '__main__']):
+            spec[name] = ('attr', (value.__module__, value.__name__))
+        else:
+            try:
+                data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                data = None
+            # classes and objects of the module are pickled as references to
+            # it, which could not be loaded without importing it
+            if (data is None or _is_importable(value) or
+                    'c' + function.__module__ + '\n' in data):
+                spec[name] = ('attr', (module, name))
+            else:
+                spec[name] = ('value', data)
+
+
+def _write_snapshot(temp_folder, function, module, path):
+    # writes the snapshot of function to the zip file snapshot in temp_folder.
+    # module is the name under which the jobs would import the function and
+    # path the folder of the calling file. the modules that are loaded from
+    # below path are added as bytecode, so the jobs do not need to read them
+    # from the shared file system
+    if function.__closure__ is not None:
+        raise ValueError('Can not snapshot functions with closures.')
+    spec = {}
+    _snapshot_globals(function, module, spec)
+    spec[function.__name__] = ('function', (
+        marshal.dumps(function.__code__), pickle.dumps(function.__defaults__),
+        function.__name__))
+
+    filename = os.path.join(temp_folder, 'snapshot')
+    f = zipfile.PyZipFile(filename + '.tmp', 'w')
+    try:
+        f.writestr(_SPEC_NAME, pickle.dumps(
+            {'function_name': function.__name__, 'module': module,
+             'globals': spec}, pickle.HIGHEST_PROTOCOL))
+        for name, loaded in sorted(sys.modules.items()):
+            if (loaded is None or '.' in name or name == '__main__' or
+                    name == function.__module__ or
+                    not _is_local(getattr(loaded, '__file__', None), path)):
+                continue
+            source = os.path.splitext(loaded.__file__)[0] + '.py'
+            if os.path.basename(source) == '__init__.py':
+                # the whole package with its submodules
+                f.writepy(os.path.dirname(source))
+            elif os.path.exists(source):
+                f.writepy(source)
+    finally:
+        f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+def _stage_snapshot(temp_folder, timestamp, stage=None):
+    # copies the snapshot to node-local scratch space once per node and
+    # returns the local path. the copies are evicted like the staged args,
+    # with the stage policy of the folder or the default one. the timestamp
+    # of the info file tells apart snapshots of folders that were deleted and
+    # written again. if no copy can be made, the snapshot in the temp folder
+    # is used
+    source = os.path.join(temp_folder, 'snapshot')
+    key = hashlib.sha1(os.path.abspath(temp_folder) + str(timestamp))
+    try:
+        return _stage_file(source, 'snapshot_' + key.hexdigest() + '.zip',
+                           stage or _get_stage_policy(True))
+    except (IOError, OSError):
+        return source
+
+
+def _load_snapshot(temp_folder, timestamp, stage=None):
+    # returns the job function from the snapshot. its modules are imported
+    # from the local copy of the zip file with zipimport
+    filename = _stage_snapshot(temp_folder, timestamp, stage)
+    if filename not in sys.path:
+        sys.path.insert(0, filename)
+    f = zipfile.ZipFile(filename)
+    try:
+        snapshot = pickle.loads(f.read(_SPEC_NAME))
+    finally:
+        f.close()
+
+    # the functions share one globals dict, as in their module
+    function_globals = {'__name__': snapshot['module'],
+                        '__builtins__': __builtins__}
+    for name, (kind, data) in snapshot['globals'].items():
+        if kind == 'module':
+            __import__(data)
+            function_globals[name] = sys.modules[data]
+        elif kind == 'attr':
+            __import__(data[0])
+            function_globals[name] = getattr(sys.modules[data[0]], data[1])
+        elif kind == 'value':
+            function_globals[name] = pickle.loads(data)
+        else:
+            code, defaults, function_name = data
+            function_globals[name] = types.FunctionType(
+                marshal.loads(code), function_globals, function_name,
+                pickle.loads(defaults))
+    return function_globals[snapshot['function_name']]
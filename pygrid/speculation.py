@@ -0,0 +1,109 @@
+""" Implements the speculative resubmission of straggling jobs """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+import os
+import time
+from os.path import join as pjoin
+from os.path import exists as pexists
+
+from .file_handling import _get_info, _get_qids, _get_job_map, _get_journal
+from .file_handling import _submit_lock, _get_speculated, _add_speculated
+from .run import _submit_jobs
+from .backends import _get_backend
+
+# with speculate=True, jobs that run three times longer than the median job
+# and at least a minute are submitted a second time, once 90% of the jobs
+# are finished
+DEFAULT_POLICY = {'min_finished': 0.9, 'factor': 3, 'min_time': 60}
+
+# the speculated jobs whose other copy was cancelled, for the absolute path
+# of each temp folder
+_cancelled = {}
+
+
+def _get_speculate_policy(speculate):
+    # resolve the speculate option of map to a policy dict or None
+    if speculate is None or speculate is False:
+        return None
+    policy = dict(DEFAULT_POLICY)
+    if speculate is not True:
+        unknown = set(speculate) - set(DEFAULT_POLICY)
+        if len(unknown) > 0:
+            raise ValueError('Unknown keys in `speculate`: ' +
+                             ', '.join(sorted(unknown)) + '.')
+        policy.update(speculate)
+    return policy
+
+
+def _get_tasks(temp_folder, ids):
+    # returns the (qid, task id) of all tasks that run each of the jobs
+    tasks = dict((id, []) for id in ids)
+    for qid in _get_qids(temp_folder):
+        if not pexists(pjoin(temp_folder, 'submit_map_' + qid)):
+            continue
+        for task_no, task_ids in enumerate(_get_job_map(temp_folder, qid)):
+            for id in task_ids:
+                if id in tasks:
+                    tasks[id].append((qid, task_no + 1, task_ids))
+    return tasks
+
+
+def _speculate(temp_folder, jobs, task_states):
+    # submits copies of straggling jobs and cancels the tasks of copies that
+    # lost. the jobs write a started record to the journal when the folder
+    # uses speculation
+    info = _get_info(temp_folder)
+    policy = info.get('speculate')
+    if policy is None or info.get('workers') is not None:
+        return jobs
+
+    speculated = _get_speculated(temp_folder)
+    finished = set(jobs['finished'])
+    cancelled = _cancelled.setdefault(os.path.abspath(temp_folder), set())
+
+    # the slower copy of a finished job is cancelled if its task has no other
+    # jobs to do
+    won = (speculated & finished) - cancelled
+    if len(won) > 0:
+        backend = _get_backend(info.get('backend', 'sge'))
+        for id, tasks in _get_tasks(temp_folder, won).items():
+            for qid, task_id, task_ids in tasks:
+                running, waiting = task_states.get(qid, (set(), set()))
+                if ((task_id in running or task_id in waiting) and
+                        finished.issuperset(task_ids)):
+                    backend.cancel([qid], task_id, task_id)
+            cancelled.add(id)
+
+    if len(finished) < policy['min_finished'] * info['njobs']:
+        return jobs
+
+    # the started records tell how long the running jobs take. the durations
+    # of the finished jobs do not include loading args and saving results.
+    # only the new records of the journal are read
+    journal = _get_journal(temp_folder)
+    starts = journal['starts']
+    durations = journal['durations']
+    if len(durations) == 0:
+        return jobs
+    limit = max(policy['factor'] * durations[len(durations) // 2],
+                policy['min_time'])
+    now = time.time()
+    stragglers = [id for id in jobs['running'] if id not in speculated and
+                  id in starts and now - starts[id] > limit]
+    if len(stragglers) == 0:
+        return jobs
+
+    with _submit_lock(temp_folder):
+        # another process may have submitted them in the meantime
+        stragglers = sorted(set(stragglers) - _get_speculated(temp_folder))
+        if len(stragglers) > 0:
+            # the jobs have to know that they are speculated before the
+            # copies start
+            _add_speculated(temp_folder, stragglers)
+            res = _submit_jobs(temp_folder, stragglers,
+                               info['cluster_params'], 1)
+            if res is not True:
+                print('Could not submit copies of slow jobs: ' + res)
+    return jobs
@@ -0,0 +1,105 @@
+""" Implements functions that summarize the metrics of pygrid jobs """
+
+# Copyright (c) 2013 Felix Brockherde
+# License: BSD
+
+from .file_handling import _read_metrics
+
+# the phases of a job. each has a wall clock and a cpu time
+_PHASES = ['load', 'import', 'compute', 'save']
+# outliers take at least this many seconds longer than the median job
+_OUTLIER_MIN_SECONDS = 1.
+
+
+def get_stats(temp_folder):
+    """ Returns statistics about the runtime and memory use of the jobs
+
+    Every job records how much time it spent on loading its arguments,
+    importing the function module, computing and saving the result, how much
+    memory it used and where it ran. Jobs that run one after another in a
+    task add the loading of the common arguments and the import to the first
+    job.
+
+    Parameters
+    ----------
+    temp_folder : string
+        The temporary folder that was given when the job was submitted first.
+
+    Returns
+    -------
+    output : dict
+        A dict with the keys:
+
+        - njobs: the number of jobs with metrics, including failed jobs
+        - wall: a dict with a summary of the wall clock times in seconds for
+          each phase ``'load'``, ``'import'``, ``'compute'``, ``'save'`` and
+          their ``'total'``
+        - cpu: the same for the cpu times
+        - peak_rss: a summary of the peak resident memory in bytes of the
+          processes
+        - args_size: a summary of the size in bytes of the stored individual
+          arguments of the jobs
+        - result_size: a summary of the size in bytes of the result files
+        - hosts: a dict with the number of jobs for each host
+        - outliers: the ids of the jobs whose total wall clock time is more
+          than twice the median, at least a second longer than the median and
+          more than three interquartile ranges above the upper quartile
+
+        Each summary is a dict with the keys ``'min'``, ``'p50'``, ``'p90'``,
+        ``'p99'``, ``'max'`` and ``'mean'``.
+
+    """
+    metrics = _read_metrics(temp_folder)
+    ids = sorted(metrics)
+    records = [metrics[id] for id in ids]
+
+    stats = {'njobs': len(records), 'wall': {}, 'cpu': {}, 'hosts': {}}
+    for clock in ['wall', 'cpu']:
+        totals = [0.] * len(records)
+        for phase in _PHASES:
+            values = [record[phase + '_' + clock] for record in records]
+            stats[clock][phase] = _summarize(values)
+            totals = [total + value for total, value in zip(totals, values)]
+        stats[clock]['total'] = _summarize(totals)
+        if clock == 'wall':
+            wall_totals = totals
+    for field in ['peak_rss', 'args_size', 'result_size']:
+        stats[field] = _summarize([record[field] for record in records])
+    for record in records:
+        stats['hosts'][record['host']] = (
+            stats['hosts'].get(record['host'], 0) + 1)
+
+    # tukey's fence for far out values. the runtimes of short jobs vary a
+    # lot, so only jobs that took clearly longer than the median count
+    stats['outliers'] = []
+    if len(records) > 0:
+        values = sorted(wall_totals)
+        q1 = _percentile(values, 25)
+        q3 = _percentile(values, 75)
+        median = _percentile(values, 50)
+        limit = max(q3 + 3 * (q3 - q1), 2 * median,
+                    median + _OUTLIER_MIN_SECONDS)
+        stats['outliers'] = [id for id, total in zip(ids, wall_totals) if
+                             total > limit]
+    return stats
+
+
+def _summarize(values):
+    if len(values) == 0:
+        return dict((key, None) for key in
+                    ['min', 'p50', 'p90', 'p99', 'max', 'mean'])
+    values = sorted(values)
+    return {'min': values[0],
+            'p50': _percentile(values, 50),
+            'p90': _percentile(values, 90),
+            'p99': _percentile(values, 99),
+            'max': values[-1],
+            'mean': sum(values) / float(len(values))}
+
+
+def _percentile(values, q):
+    # percentile of sorted values with linear interpolation, as numpy does
+    position = (len(values) - 1) * q / 100.
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
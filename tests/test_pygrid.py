@@ -5,6 +5,7 @@
 
 import time
 import os
+import sys
 
 
 def example_function(arg1, arg2=10):
@@ -44,6 +45,557 @@ def test_simple_parallel():
     run_simple(use_cluster=True)
 
 
+def test_chunked_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(5)]
+    pygrid.delete_folder('temp3')
+    res = pygrid.map(function=example_function, args=args, temp_folder='temp3',
+                     use_cluster=False, chunksize=2)
+    # the failing first job must not affect the other job in its chunk
+    assert(res[0] is None and all(res[i][1] == i for i in range(1, 5)))
+
+
+def test_imap_serial():
+    import pygrid
+    # the first job finishes last, but is returned first
+    args = ({'arg1': 0.2 if i == 1 else 0, 'arg2': i} for i in range(1, 5))
+    pygrid.delete_folder('temp23')
+    res = list(pygrid.imap(function=example_function, args=args,
+                           temp_folder='temp23', use_cluster=False,
+                           max_workers=2, poll_interval=0.1))
+    assert([id for id, result in res] == [0, 1, 2, 3])
+    assert([result[1] for id, result in res] == [1, 2, 3, 4])
+
+
+def test_imap_unordered_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(4)]
+    pygrid.delete_folder('temp24')
+    res = list(pygrid.imap_unordered(function=example_function, args=args,
+                                     temp_folder='temp24', use_cluster=False,
+                                     poll_interval=0.1))
+    # every job is returned once, the failed job with None at the end
+    assert(sorted(id for id, result in res) == [0, 1, 2, 3])
+    assert(res[-1] == (0, None))
+    assert(all(result[1] == id for id, result in res[:-1]))
+
+
+def test_on_result_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(4)]
+    calls = []
+    pygrid.delete_folder('temp25')
+    res = pygrid.map(function=example_function, args=args,
+                     temp_folder='temp25', use_cluster=False,
+                     on_result=lambda id, result: calls.append((id, result)))
+    # called once for every finished job, but not for the failed one
+    assert(sorted(id for id, result in calls) == [1, 2, 3])
+    assert(all(result[1] == res[id][1] for id, result in calls))
+
+
+def test_shards_serial():
+    import pygrid
+    from pygrid.file_handling import _get_path
+    args = [{'arg1': 0, 'arg2': i} for i in range(1, 5)]
+    pygrid.delete_folder('temp22')
+    res = pygrid.map(function=example_function, args=args,
+                     temp_folder='temp22', use_cluster=False)
+    assert([r[1] for r in res] == [1, 2, 3, 4])
+    # the result files are kept in the shard of their id, not at the top
+    assert(os.path.exists(os.path.join('temp22', 'shards', '0', 'result_3')))
+    assert(not any(name.startswith('result_')
+                   for name in os.listdir('temp22')))
+    assert(_get_path('temp22', 'result', 5, 2) ==
+           os.path.join('temp22', 'shards', '2', 'result_5'))
+    assert(_get_path('temp22', 'result', 5) ==
+           os.path.join('temp22', 'result_5'))
+
+
+def test_results_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(5)]
+    pygrid.delete_folder('temp21')
+    pygrid.map(function=example_function, args=args, temp_folder='temp21',
+               use_cluster=False)
+    # the cache is smaller than one result, so the results are evicted
+    results = pygrid.Results('temp21', cache_size=1)
+    results.prefetch(1)
+    assert(len(results) == 5 and results[0] is None)
+    assert([result[1] for result in results[1:]] == [1, 2, 3, 4])
+    assert(results[-1][1] == 4 and len(results[::2]) == 3)
+
+
+def test_threaded_io():
+    import pygrid
+    from pygrid.file_handling import _map_io
+    # the items are handled at the same time and returned in their order
+    start = time.time()
+    res = _map_io(lambda i: time.sleep(0.1 * (4 - i)) or i, range(4), 4)
+    assert(res == [0, 1, 2, 3] and time.time() - start < 0.9)
+    args = [{'arg1': 0, 'arg2': i} for i in range(20)]
+    pygrid.delete_folder('temp29')
+    pygrid.map(function=example_function, args=args, temp_folder='temp29',
+               use_cluster=False, chunksize=5)
+    res = pygrid.get_results('temp29', threads=8)
+    assert(res[0] is None and [r[1] for r in res[1:]] == range(1, 20))
+    assert([r[1] for r in pygrid.get_results('temp29', threads=1)[1:]] ==
+           range(1, 20))
+    pygrid.delete_folder('temp29', threads=8)
+    assert(not os.path.exists('temp29'))
+
+
+def test_stats_serial():
+    import socket
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(4)]
+    pygrid.delete_folder('temp20')
+    pygrid.map(function=example_function, args=args, temp_folder='temp20',
+               use_cluster=False, chunksize=2)
+    # the failed job has metrics, but no result
+    stats = pygrid.get_stats('temp20')
+    assert(stats['njobs'] == 4 and stats['hosts'] == {socket.gethostname(): 4})
+    assert(stats['result_size']['min'] == 0 and
+           stats['result_size']['max'] > 0)
+    assert(stats['peak_rss']['min'] > 0 and stats['wall']['total']['min'] >= 0)
+
+
+def test_unloadable_args_serial():
+    import numpy
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(4)]
+    # numpy does not load object arrays without pickle
+    args[0]['arg2'] = numpy.array([None], dtype=object)
+    pygrid.delete_folder('temp15')
+    res = pygrid.map(function=example_function, args=args,
+                     temp_folder='temp15', use_cluster=False, chunksize=4)
+    # the job whose args can not be loaded must not stop the other jobs
+    assert(res[0] is None and [r[1] for r in res[1:]] == [1, 2, 3])
+    assert(pygrid.get_stats('temp15')['njobs'] == 4)
+
+
+def incrementing_function(values, shared):
+    values += 1
+    shared += 1
+    return int(values.sum() + shared.sum())
+
+
+def test_args_copy_serial():
+    import numpy
+    import pygrid
+    # small arrays are stored with the args, large ones as memory mapped
+    # blobs. values is a common arg, shared is the same for every other job
+    for size in [1, 1 << 18]:
+        args = [{'values': numpy.zeros(size),
+                 'shared': numpy.zeros(size) + i % 2} for i in range(4)]
+        pygrid.delete_folder('temp11')
+        res = pygrid.map(function=incrementing_function, args=args,
+                         temp_folder='temp11', use_cluster=False, chunksize=4)
+        # a job that changes an arg must not change it for the next jobs
+        assert(res == [2 * size, 3 * size, 2 * size, 3 * size])
+
+
+def test_blobs_serial():
+    import glob
+    import numpy
+    import pygrid
+    # the shared arrays are written once as blobs into the shards
+    args = [{'values': numpy.zeros(1 << 18) + i % 2,
+             'shared': numpy.zeros(1 << 8) + i % 2} for i in range(4)]
+    pygrid.delete_folder('temp19')
+    res = pygrid.map(function=incrementing_function, args=args,
+                     temp_folder='temp19', use_cluster=False, chunksize=4)
+    assert(res == [(1 << 18) + (1 << 8), 2 * ((1 << 18) + (1 << 8))] * 2)
+    blobs = glob.glob(os.path.join('temp19', 'shards', '0', 'blob_*'))
+    assert(len(blobs) == 4 and not os.path.exists(os.path.join('temp19',
+                                                               'blobs')))
+
+
+def exiting_function(arg1):
+    if arg1 == 1:
+        os._exit(1)
+    if arg1 == 2:
+        sys.exit(1)
+    return arg1
+
+
+def test_dead_worker_serial():
+    import pygrid
+    args = [{'arg1': i} for i in range(4)]
+    pygrid.delete_folder('temp10')
+    res = pygrid.map(function=exiting_function, args=args,
+                     temp_folder='temp10', use_cluster=False, max_workers=2)
+    # the jobs of a worker that died and jobs that exit fail
+    assert(res == [0, None, None, 3])
+
+
+def unsaveable_function(arg1):
+    if arg1 == 1:
+        # a generator can not be pickled
+        return (i for i in range(arg1))
+    return arg1
+
+
+def test_task_error_serial():
+    import pygrid
+    args = [{'arg1': i} for i in range(3)]
+    pygrid.delete_folder('temp16')
+    res = pygrid.map(function=unsaveable_function, args=args,
+                     temp_folder='temp16', use_cluster=False, max_workers=2)
+    # a task that raises an error must not lose the results of the others
+    assert(res == [0, None, 2])
+
+
+def test_snapshot_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(3)]
+    pygrid.delete_folder('temp5')
+    res = pygrid.map(function=example_function, args=args, temp_folder='temp5',
+                     use_cluster=False, snapshot=True,
+                     stage={'folder': 'temp5_stage'})
+    assert(res[0] is None and res[1][1] == 1 and res[2][1] == 2)
+    # the snapshot is copied to the stage folder, where it is evicted
+    folder = os.path.join('temp5_stage', 'pygrid_stage_' + str(os.getuid()))
+    assert(any(name.startswith('snapshot_') for name in os.listdir(folder)))
+
+
+def test_staged_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': 5} for i in range(3)]
+    pygrid.delete_folder('temp7')
+    res = pygrid.map(function=example_function, args=args, temp_folder='temp7',
+                     use_cluster=False, stage={'folder': 'temp7_stage'})
+    assert(all(r[1] == 5 for r in res))
+    folder = os.path.join('temp7_stage', 'pygrid_stage_' + str(os.getuid()))
+    assert(len(os.listdir(folder)) > 0)
+
+    # the jobs read the temp folder if the copies can not be made
+    pygrid.delete_folder('temp7')
+    res = pygrid.map(function=example_function, args=args, temp_folder='temp7',
+                     use_cluster=False,
+                     stage={'folder': os.path.join(folder, os.listdir(
+                         folder)[0])})
+    assert(all(r[1] == 5 for r in res))
+
+
+def test_waves_serial():
+    import pygrid
+    args = ({'arg1': 0, 'arg2': i} for i in range(5))
+    pygrid.delete_folder('temp8')
+    res = pygrid.map(function=example_function, args=args, temp_folder='temp8',
+                     use_cluster=False, waves={'size': 2})
+    assert(res[0] is None and all(res[i][1] == i for i in range(1, 5)))
+    assert([arg['arg2'] for arg in pygrid.get_args('temp8')] == range(5))
+
+
+def second_stage(result, offset=1):
+    return result[1] + offset
+
+
+def test_pipeline_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(3)]
+    pygrid.delete_folder('temp9')
+    res = pygrid.pipeline([example_function, second_stage], args,
+                          temp_folder='temp9', use_cluster=False)
+    # the job that depends on the failing first job fails as well
+    assert(res[0] is None and res[1] == 2 and res[2] == 3)
+    assert(pygrid.get_results('temp9') == res)
+    assert(pygrid.get_progress('temp9')['failed'] == [0])
+
+
+def test_cache_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(1, 3)]
+    for temp in ['temp12', 'temp13']:
+        pygrid.delete_folder(temp)
+        res = pygrid.map(function=example_function, args=args,
+                         temp_folder=temp, use_cluster=False,
+                         cache='temp12_cache')
+        assert([r[1] for r in res] == [1, 2])
+        # writing to a result must not change the cache
+        result = os.path.join(temp, 'shards', '0', 'result_1')
+        assert(os.stat(result).st_nlink == 1)
+
+
+def test_executor_batches():
+    import shutil
+    import pygrid
+    if os.path.exists('temp14'):
+        shutil.rmtree('temp14')
+    # the two functions are submitted as two batches that run at once
+    with pygrid.GridExecutor(temp_folder='temp14', backend='local',
+                             batch_delay=0, poll_interval=0.5) as executor:
+        first = executor.submit(example_function, 0, arg2=1)
+        second = executor.submit(second_stage, (0, 5))
+        assert(first.result()[1] == 1 and second.result() == 6)
+
+
+def wait_for_jobs(temp_folder):
+    import pygrid
+    while True:
+        jobs = pygrid.get_progress(temp_folder)
+        if len(jobs['running']) + len(jobs['waiting']) == 0:
+            return jobs
+        time.sleep(0.5)
+
+
+def test_retry_fake():
+    import pygrid
+    from pygrid.backends import FakeBackend, register
+    # tasks are lost as with node failures and resubmitted unchanged
+    register('fake_retry', FakeBackend(delay=0, failure_rate=0.3, seed=1))
+    args = [{'arg1': 0, 'arg2': i} for i in range(6)]
+    pygrid.delete_folder('temp17')
+    pygrid.map(function=example_function, args=args, temp_folder='temp17',
+               backend='fake_retry', interactive=False,
+               retry={'max_attempts': 10})
+    jobs = wait_for_jobs('temp17')
+    assert(jobs['finished'] == [1, 2, 3, 4, 5] and jobs['failed'] == [0])
+    # the exception of the first job is not retried
+    history = pygrid.retry._load_attempts('temp17')['jobs']
+    assert(len(history) > 0 and all(reason == 'node' for attempts in
+                                    history.values() for reason, params in
+                                    attempts))
+
+
+def test_workers_local():
+    import pygrid
+    # two workers take the six jobs from the queue
+    args = [{'arg1': 0, 'arg2': i} for i in range(6)]
+    pygrid.delete_folder('temp26')
+    pygrid.map(function=example_function, args=args, temp_folder='temp26',
+               backend='local', interactive=False, workers=2)
+    jobs = wait_for_jobs('temp26')
+    assert(jobs['finished'] == [1, 2, 3, 4, 5] and jobs['failed'] == [0])
+    assert(os.listdir(os.path.join('temp26', 'queue')) == [])
+    assert(os.listdir(os.path.join('temp26', 'claimed')) == [])
+
+
+def test_workers_requeue():
+    import pygrid
+    from pygrid.file_handling import _fill_queue, _claim_jobs, _list_queue
+    from pygrid.progress import _get_worker_jobs
+    pygrid.delete_folder('temp27')
+    os.makedirs('temp27')
+    _fill_queue('temp27', range(3))
+    # every job is claimed by only one of the workers
+    first = _claim_jobs('temp27', '7', 1)
+    second = _claim_jobs('temp27', '7', 2)
+    claimed = [next(first), next(second)]
+    assert(len(set(claimed)) == 2 and len(_list_queue('temp27')) == 1)
+    # the claim of a running worker is kept, the other one is returned
+    running, waiting = _get_worker_jobs('temp27', {'7': (set([1]), set())})
+    assert(running == set([claimed[0]]) and len(waiting) == 2)
+    assert(sorted(_list_queue('temp27')) ==
+           sorted(set(range(3)) - set([claimed[0]])))
+    # the worker that is left finishes the other jobs
+    assert(sorted([claimed[0]] + list(first)) == [0, 1, 2])
+
+
+def straggling_function(marker):
+    # the first run of a job with a marker hangs, as on a slow node
+    if marker != '' and not os.path.exists(marker):
+        open(marker, 'w').close()
+        time.sleep(60)
+        return 'slow'
+    return 'fast'
+
+
+def test_speculate_local():
+    import pygrid
+    from pygrid.backends import LocalBackend, register
+    from pygrid.file_handling import _get_qids
+    from pygrid.progress import _get_task_states
+    # the copy needs a free slot while the slow task is running
+    register('local_speculate', LocalBackend(max_processes=2))
+    marker = os.path.abspath('temp28_marker')
+    if os.path.exists(marker):
+        os.remove(marker)
+    args = [{'marker': marker if i == 0 else ''} for i in range(4)]
+    pygrid.delete_folder('temp28')
+    pygrid.map(function=straggling_function, args=args, temp_folder='temp28',
+               backend='local_speculate', interactive=False,
+               speculate={'min_finished': 0.5, 'min_time': 1})
+    start = time.time()
+    jobs = wait_for_jobs('temp28')
+    # the copy of the slow job wins and the slow task is cancelled
+    assert(jobs['finished'] == [0, 1, 2, 3] and time.time() - start < 30)
+    assert(pygrid.get_results('temp28') == ['fast'] * 4)
+    qids = _get_qids('temp28')
+    states = _get_task_states(qids, 'local_speculate')
+    assert(len(qids) == 2 and 1 not in states[qids[0]][0])
+
+
+def test_fake_backend():
+    import pygrid
+    from pygrid.backends import FakeBackend, register
+    from pygrid.file_handling import _get_qids
+    from pygrid.progress import _get_task_states
+    args = [{'arg1': 0, 'arg2': i} for i in range(1, 4)]
+    # the tasks wait in the queue for the delay before they run
+    register('fake_delay', FakeBackend(delay=1))
+    pygrid.delete_folder('temp31')
+    start = time.time()
+    pygrid.map(function=example_function, args=args, temp_folder='temp31',
+               backend='fake_delay', interactive=False)
+    qid = _get_qids('temp31')[0]
+    assert(_get_task_states([qid], 'fake_delay')[qid][1] == set([1, 2, 3]))
+    assert(wait_for_jobs('temp31')['finished'] == [0, 1, 2])
+    assert(time.time() - start >= 1)
+    # all tasks are lost as with node failures
+    backend = FakeBackend(delay=0, failure_rate=1)
+    register('fake_lost', backend)
+    pygrid.delete_folder('temp32')
+    pygrid.map(function=example_function, args=args, temp_folder='temp32',
+               backend='fake_lost', interactive=False)
+    assert(wait_for_jobs('temp32')['failed'] == [0, 1, 2])
+    qid = _get_qids('temp32')[0]
+    assert(backend.get_failures(qid, []) == {1: 'node', 2: 'node', 3: 'node'})
+
+
+def failing_function(marker):
+    # fails with a MemoryError the first time and then without a message
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise MemoryError()
+    os._exit(1)
+
+
+def test_retry_stale_log():
+    import pygrid
+    marker = os.path.abspath('temp18_marker')
+    if os.path.exists(marker):
+        os.remove(marker)
+    pygrid.delete_folder('temp18')
+    pygrid.map(function=failing_function, args=[{'marker': marker}],
+               temp_folder='temp18', backend='local', interactive=False,
+               retry={'memory': 2, 'unknown': False})
+    wait_for_jobs('temp18')
+    # the log and the journal still tell about the MemoryError of the first
+    # run, but the second run failed for another reason
+    assert(pygrid.get_failures('temp18') == {0: 'unknown'})
+
+
+def add_results(a, b):
+    return a + b
+
+
+def test_map_reduce_serial():
+    import pygrid
+    args = [{'arg1': 0, 'arg2': i} for i in range(5)]
+    pygrid.delete_folder('temp6')
+    res = pygrid.map_reduce(function=example_function, args=args,
+                            reducer=add_results, temp_folder='temp6',
+                            use_cluster=False)
+    # the failing first job is left out
+    assert(list(res) == [0, 10])
+
+
+def test_packed_args():
+    import pygrid
+    from pygrid.file_handling import _write_files, _write_info, _get_job_args
+    args = [{'arg1': i, 'arg2': 5} if i % 2 else {} for i in range(5)]
+    pygrid.delete_folder('temp4')
+    os.makedirs('temp4')
+    _write_info('temp4', 'example_function', '', '', [], len(args))
+    _write_files('temp4', [dict(arg) for arg in args])
+    assert([dict(arg) for arg in pygrid.get_args('temp4')] == args)
+    assert(_get_job_args('temp4', 3, {}) == args[3])
+
+
+def test_journal():
+    import pygrid
+    from pygrid.file_handling import _write_info, _append_journal
+    from pygrid.file_handling import _read_journal, _get_journal
+    pygrid.delete_folder('temp30')
+    os.makedirs('temp30')
+    open(os.path.join('temp30', 'is_pygrid'), 'w').close()
+    _write_info('temp30', 'example_function', '', '', [], 4)
+    _append_journal('temp30', [(0, 'started', 5.), (0, 'ok', 2.),
+                               (1, 'failed', 1.)])
+    # a record that is being written is left for the next read
+    with open(os.path.join('temp30', 'journal'), 'a') as f:
+        f.write('2 ok')
+    records, offset = _read_journal('temp30')
+    assert([record[:3] for record in records] ==
+           [(0, 'started', 5.), (0, 'ok', 2.), (1, 'failed', 1.)])
+    assert(records[-1][3] == offset and offset < os.path.getsize(
+        os.path.join('temp30', 'journal')))
+    journal = _get_journal('temp30')
+    assert(journal['finished'] == set([0]) and journal['durations'] == [2.])
+    assert(journal['statuses'][1] == ('failed', offset))
+    # only the new records are read
+    with open(os.path.join('temp30', 'journal'), 'a') as f:
+        f.write(' 1.000\n')
+    assert(_read_journal('temp30', offset)[0] ==
+           [(2, 'ok', 1., offset + len('2 ok 1.000\n'))])
+    journal = _get_journal('temp30')
+    assert(journal['finished'] == set([0, 2]) and
+           journal['durations'] == [1., 2.] and journal['starts'] == {0: 5.})
+
+
+def test_parse_qstat_xml():
+    from StringIO import StringIO
+    from pygrid.backends import _parse_qstat_xml
+    xml = ('<?xml version="1.0"?><job_info><queue_info>'
+           '<job_list state="running"><JB_job_number>11</JB_job_number>'
+           '<state>r</state><tasks>3</tasks></job_list></queue_info>'
+           '<job_info><job_list state="pending">'
+           '<JB_job_number>11</JB_job_number><state>qw</state>'
+           '<tasks>4-5000:1</tasks></job_list>'
+           '<job_list state="pending"><JB_job_number>12</JB_job_number>'
+           '<state>qw</state><tasks>1-3:1</tasks></job_list>'
+           '</job_info></job_info>')
+    states = _parse_qstat_xml(StringIO(xml), ['11'])
+    assert(states['11'][0] == set([3]))
+    assert(states['11'][1] == set(range(4, 5001)))
+    assert('12' not in states)
+
+
+def test_parse_squeue():
+    from pygrid.backends import _parse_squeue
+    output = '11 3 R\n11 [4-5000%10] PD\n11 2 CG\n12 1-3 PD\n'
+    states = _parse_squeue(output, ['11'])
+    assert(states['11'][0] == set([3]))
+    assert(states['11'][1] == set(range(4, 5001)))
+    assert('12' not in states)
+
+
+def test_scale_params():
+    from pygrid.backends import SGEBackend, SlurmBackend
+    params = ['-l h_vmem=1.5G,h_rt=00:30:00', '-pe smp 4']
+    assert(SGEBackend().scale_params(params, 'memory', 2) ==
+           ['-l h_vmem=3G,h_rt=00:30:00', '-pe smp 4'])
+    assert(SGEBackend().scale_params(params, 'timeout', 2) ==
+           ['-l h_vmem=1.5G,h_rt=1:00:00', '-pe smp 4'])
+    assert(SlurmBackend().scale_params(['--mem=4000', '--time=30'], 'timeout',
+                                       2) ==
+           ['--mem=4000', '--time=0-01:00:00'])
+
+
+def test_estimate_chunksize():
+    from pygrid.run import _estimate_chunksize, _get_adaptive_policy
+    record = {'load_wall': 0.5, 'import_wall': 0., 'compute_wall': 2.,
+              'save_wall': 0.5}
+    assert(_estimate_chunksize({}, 600) == 1)
+    assert(_estimate_chunksize({0: record, 1: record}, 600) == 200)
+    assert(_estimate_chunksize({0: record}, 1) == 1)
+    assert(_get_adaptive_policy('adaptive')['target'] == 600)
+    assert(_get_adaptive_policy({'target': 60}) ==
+           {'target': 60, 'calibration': 10})
+    assert(_get_adaptive_policy(5) is None)
+
+
 def test_delete_all():
     import pygrid
     pygrid.delete_all_folders(os.getcwd())
+
+
+def test_delete_all_pipeline(monkeypatch):
+    import pygrid
+    pygrid.delete_folder('temp9')
+    pygrid.pipeline([example_function, second_stage], [{'arg1': 0}],
+                    temp_folder='temp9', use_cluster=False)
+    monkeypatch.setattr('__builtin__.raw_input', lambda prompt: 'y')
+    pygrid.delete_all_folders('temp9')
+    assert(not os.path.exists('temp9'))